@@ -0,0 +1,184 @@
+"""
+วัดเวลาและหน่วยความจำของแต่ละขั้นตอน (read_csv, transform ทั้ง 4 หน้า, export Excel/Excel รายหมอ/CSV ZIP/Parquet)
+ที่ขนาดข้อมูลต่าง ๆ – ใช้เทียบก่อน/หลังแก้โค้ดว่าเร็วขึ้นจริงหรือไม่
+
+- ข้อมูลสร้างจาก generate_patient_summary.py (seed คงที่ → เทียบข้ามรอบได้) และเก็บไว้ใช้ซ้ำใน --data-dir
+- แต่ละขั้นรันใน process ใหม่ หน่วยความจำของขั้นก่อนหน้าจึงไม่ปนกัน
+- peak_mb = RSS สูงสุดระหว่างขั้นนั้น ลบ RSS ก่อนเริ่ม (Linux reset ค่า peak ได้ → แม่นยำ,
+  OS อื่นใช้ ru_maxrss → เป็นค่าประมาณ)
+
+ตัวอย่าง:
+    python bench/bench_transforms.py                              # 10k, 100k, 1M ทุกขั้น
+    python bench/bench_transforms.py --sizes 10000 100000 --stages stats stats_excel
+    python bench/bench_transforms.py --sizes 100000 --json before.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import doctor_stats_core as ds
+from generate_patient_summary import generate
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+TRANSFORM_NAMES = ["stats", "round", "refer", "clean"]
+STAGES = (
+    ["read_csv"]
+    + TRANSFORM_NAMES
+    + [f"{name}_excel" for name in TRANSFORM_NAMES]
+    + [f"{name}_excel_streaming" for name in TRANSFORM_NAMES]
+    + [f"{name}_zip" for name in TRANSFORM_NAMES]
+    + [f"{name}_workbooks" for name in TRANSFORM_NAMES]
+    + [f"{name}_parquet" for name in TRANSFORM_NAMES]
+)
+
+# =========================
+# Memory
+# =========================
+
+class PeakMemory:
+    """with PeakMemory() as mem: ... → mem.delta_mb, mem.exact"""
+
+    def __enter__(self):
+        self.exact = ds._reset_peak() and ds._proc_status_kb("VmHWM") is not None
+        self.start_kb = ds._proc_status_kb("VmRSS") if self.exact else ds._maxrss_kb()
+        return self
+
+    def __exit__(self, *exc):
+        peak_kb = ds._proc_status_kb("VmHWM") if self.exact else ds._maxrss_kb()
+        self.delta_mb = max(peak_kb - self.start_kb, 0) / 1024
+        return False
+
+# =========================
+# Child process: 1 ขั้นตอน
+# =========================
+
+def _prepare_and_measure(stage: str, csv_path: str) -> dict:
+    import warnings
+    warnings.filterwarnings("ignore")
+
+    with open(csv_path, "rb") as fh:
+        data = fh.read()
+    name = stage.split("_", 1)[0]
+    spec = ds.TRANSFORMS.get(name)
+
+    # อ่านแบบเดียวกับ normalized tables ของหน้าเว็บ (เฉพาะคอลัมน์ที่ใช้)
+    if stage == "read_csv":
+        fn = lambda: ds.read_uploaded_csv(data, columns=ds.INGEST_COLUMNS)
+        rows_in = None
+    else:
+        df = ds.read_uploaded_csv(data, columns=ds.INGEST_COLUMNS)
+        rows_in = len(df)
+        build = lambda: spec["build"](df)
+        if stage == name:
+            fn = build
+        else:
+            result = build()
+            rows_in = len(result)
+            if spec["key"]:
+                sheets = lambda: ds.doctor_sheets(result, spec["key"], all_sheet=spec["all_sheet"])
+            else:
+                sheets = lambda: [(spec["all_sheet"], result)]
+            out_path = os.path.join(tempfile.gettempdir(), f"bench_{os.getpid()}")
+            if stage.endswith("_streaming"):
+                fn = lambda: ds.write_xlsx_streaming(out_path + ".xlsx", sheets())
+            elif stage.endswith("_zip"):
+                fn = lambda: ds.write_csv_zip(out_path + ".zip", sheets())
+            elif stage.endswith("_workbooks"):
+                fn = lambda: ds.write_workbook_zip(out_path + ".zip", sheets(), all_sheet=spec["all_sheet"])
+            elif stage.endswith("_parquet"):
+                fn = lambda: ds.write_parquet(out_path + ".parquet", ds.parquet_groups(result, spec["key"]))
+            else:
+                fn = lambda: ds.sheets_to_excel(sheets())
+
+    with PeakMemory() as mem:
+        started = time.perf_counter()
+        out = fn()
+        elapsed = time.perf_counter() - started
+
+    if isinstance(out, str) and os.path.exists(out):
+        os.remove(out)
+    rows_out = len(out) if hasattr(out, "columns") else None
+    return {
+        "stage": stage,
+        "seconds": round(elapsed, 3),
+        "peak_mb": round(mem.delta_mb, 1),
+        "exact_memory": mem.exact,
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+    }
+
+def run_stage(stage: str, csv_path: str, timeout: int = None) -> dict:
+    """รัน 1 ขั้นใน process ใหม่ คืน dict ผลวัด (ถ้าล้มเหลว → มี key error)"""
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", stage, csv_path]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"stage": stage, "error": f"timeout > {timeout}s"}
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines() or ["exit code %d" % proc.returncode]
+        return {"stage": stage, "error": lines[-1]}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+# =========================
+# Main
+# =========================
+
+def dataset_path(data_dir: str, rows: int, seed: int) -> str:
+    path = os.path.join(data_dir, f"patient_summary_{rows}_s{seed}.csv")
+    if not os.path.exists(path):
+        print(f"… สร้างข้อมูล {rows:,} แถว → {path}", flush=True)
+        tmp = path + ".tmp"
+        generate(tmp, rows, seed=seed)
+        os.replace(tmp, path)
+    return path
+
+def format_row(size: int, res: dict) -> str:
+    if "error" in res:
+        return f"{size:>10,}  {res['stage']:<24}  ❌ {res['error']}"
+    rows = f"{res['rows_out']:,}" if res.get("rows_out") is not None else "-"
+    approx = "" if res.get("exact_memory") else " ~"
+    return (f"{size:>10,}  {res['stage']:<24}  {res['seconds']:>9.2f}s  "
+            f"{res['peak_mb']:>9.1f} MB{approx}  {rows:>12}")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark transform + Excel export")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "worldmed_bench"),
+                        help="ที่เก็บไฟล์ข้อมูลจำลอง (สร้างครั้งแรกแล้วใช้ซ้ำ)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=int, default=None, help="วินาทีสูงสุดต่อขั้น")
+    parser.add_argument("--json", help="บันทึกผลทั้งหมดเป็น JSON (ไว้เทียบก่อน/หลัง)")
+    parser.add_argument("--child", nargs=2, metavar=("STAGE", "CSV"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(_prepare_and_measure(*args.child)))
+        return 0
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = []
+    print(f"{'rows':>10}  {'stage':<24}  {'time':>10}  {'peak RSS Δ':>12}  {'rows out':>12}")
+    for size in args.sizes:
+        csv_path = dataset_path(args.data_dir, size, args.seed)
+        for stage in args.stages:
+            res = run_stage(stage, csv_path, timeout=args.timeout)
+            res["rows"] = size
+            results.append(res)
+            print(format_row(size, res), flush=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"seed": args.seed, "results": results}, fh, ensure_ascii=False, indent=2)
+    return 1 if any("error" in r for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+สร้างไฟล์ Patient_summary CSV จำลอง (ข้อมูลสุ่ม ไม่ใช่คนไข้จริง) สำหรับทดสอบความเร็ว
+
+- treatments / diagnosis / payment_status / rejects เป็น JSON ซ้อนแบบเดียวกับไฟล์จากระบบ
+- practice / order / doctor_asst มีทั้ง list หลายหมอ, string เดี่ยว, list ว่าง
+- ชื่อคนไข้/หมอภาษาไทยปนอังกฤษ, time เป็น ISO (UTC) ปนรูปแบบอื่นเล็กน้อย
+- เขียนทีละแถว ใช้หน่วยความจำคงที่ไม่ว่ากี่แถว
+
+ตัวอย่าง:
+    python bench/generate_patient_summary.py 100000 -o data/ps_100k.csv
+    python bench/generate_patient_summary.py 1000000 -o data/ps_1m.csv --month 2025-12 --seed 7
+"""
+import argparse
+import csv
+import datetime as dt
+import json
+import random
+
+COLUMNS = [
+    "time", "HN", "VN", "visit_type", "patientTitle", "patientName", "patientAge", "nationality",
+    "branch", "insurance_name", "assist_insurance", "concessionType", "ipd_status", "room",
+    "diagnosis", "medLog", "treatments", "payment_status", "billLog", "rejects", "retry", "note",
+    "referTo", "typeOfBoat", "shift", "onDuty", "onCall",
+]
+
+DOCTORS = [
+    "นพ. สมชาย ใจดี", "พญ. สุภาพร แสงทอง", "นพ. ธนากร วงศ์ใหญ่", "พญ. กมลวรรณ ศรีสุข",
+    "Dr. John Smith", "Dr. Anna Müller", "Dr. Kenji Sato", "Dr. Maria Rossi",
+    "นพ. ปิยะ รัตนโกสินทร์", "พญ. ณัฐธิดา พรหมมา", "Dr. A/B Clinic", "Dr. Lee [Night]",
+]
+FIRST_NAMES = ["สมศักดิ์", "วิภา", "อนันต์", "ศิริพร", "ประเสริฐ", "มาลี", "Tom", "Emma", "Lukas", "Sofia"]
+LAST_NAMES = ["ทองดี", "แก้วมณี", "สุขสวัสดิ์", "บุญมา", "Brown", "Schmidt", "Dubois", "Tanaka"]
+TITLES = ["นาย", "นาง", "นางสาว", "Mr.", "Mrs.", "Ms.", "ด.ช.", "ด.ญ."]
+NATIONALITIES = ["Thai", "British", "German", "French", "Japanese", "Russian", "Chinese", ""]
+BRANCHES = ["Phi Phi", "Lanta", "Ao Nang", "Koh Lipe"]
+INSURERS = ["AXA", "Allianz", "Bupa", "Cigna", "เมืองไทยประกันภัย", ""]
+TREATMENTS = [
+    ("Consultation", ["", "Head", "Chest"]),
+    ("Wound dressing", ["Arm", "Leg", "Foot", "Hand"]),
+    ("Suture", ["Arm", "Leg", "Face", "Scalp"]),
+    ("IV fluid", [""]),
+    ("X-ray", ["Chest", "Wrist", "Ankle"]),
+    ("Refer to hospital", [""]),
+    ("Refer by speed boat", [""]),
+    ("ทำแผล", ["แขน", "ขา"]),
+]
+DIAGNOSES = [
+    ("T14.1", "Open wound", "Injury"), ("A09", "Gastroenteritis", "Infection"),
+    ("J06.9", "Acute URI", "Respiratory"), ("R50.9", "ไข้", ""), ("T63.6", "Jellyfish sting", "Injury"),
+    ("S93.4", "Ankle sprain", "Injury"), ("H10.9", "Conjunctivitis", ""), ("L50.0", "Urticaria", "Skin"),
+]
+CASE_TYPES = ["insurance", "cash", "credit card"]
+REJECT_TYPES = ["insurance", "document", "price"]
+
+def doctor_field(rng: random.Random):
+    """practice/order: list หลายหมอเป็นส่วนใหญ่ บางแถวเป็น string เดี่ยว / list ว่าง / ไม่มี"""
+    r = rng.random()
+    if r < 0.70:
+        return rng.sample(DOCTORS, rng.choice((1, 1, 1, 2, 2, 3)))
+    if r < 0.80:
+        return rng.choice(DOCTORS)
+    if r < 0.90:
+        return []
+    return None
+
+def make_treatments(rng: random.Random) -> list:
+    items = []
+    for _ in range(rng.choice((0, 1, 1, 2, 2, 3, 4, 6))):
+        name, areas = rng.choice(TREATMENTS)
+        item = {"treatment": name, "area": rng.choice(areas), "unit": str(rng.randint(1, 3))}
+        for field in ("practice", "order"):
+            value = doctor_field(rng)
+            if value is not None:
+                item[field] = value
+        if rng.random() < 0.25:
+            item["doctor_asst"] = rng.sample(DOCTORS, 1)
+        items.append(item)
+    return items
+
+def make_row(i: int, rng: random.Random, month_start: dt.datetime, minutes: int) -> list:
+    when = month_start + dt.timedelta(minutes=rng.randrange(minutes), seconds=rng.randrange(60))
+    r = rng.random()
+    if r < 0.97:
+        time_s = when.strftime("%Y-%m-%dT%H:%M:%S.") + f"{rng.randrange(1000):03d}Z"
+    elif r < 0.995:
+        time_s = when.strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        time_s = ""
+
+    diagnosis = [
+        {"code": code, "title": title, "categoryLabel": cat}
+        for code, title, cat in rng.sample(DIAGNOSES, rng.choice((0, 1, 1, 1, 2, 2, 3)))
+    ]
+    case_type = rng.choice(CASE_TYPES)
+    payment = [{
+        "status": [rng.choice(["paid", "pending", "partial"])],
+        "invoice_id": f"INV{i:08d}",
+        "total_invoiced": [round(rng.uniform(500, 45000), 2)],
+        "case_type": case_type,
+        "reasonNotInsurance": "" if case_type == "insurance" else rng.choice(["", "no policy", "ไม่มีประกัน"]),
+    }] if rng.random() < 0.9 else []
+    rejects = [{
+        "reject": rng.choice(REJECT_TYPES),
+        "reason": rng.choice(["missing document", "over limit", "เอกสารไม่ครบ"]),
+        "problem": " see note ",
+    }] if rng.random() < 0.05 else []
+
+    treatments = make_treatments(rng)
+    is_refer = any("refer" in t["treatment"].lower() for t in treatments)
+    ipd = rng.random() < 0.15
+
+    return [
+        time_s,
+        f"{100000 + rng.randrange(i + 1):07d}",
+        f"VN{i:08d}",
+        "IPD" if ipd else "OPD",
+        rng.choice(TITLES),
+        f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        rng.randint(1, 90),
+        rng.choice(NATIONALITIES),
+        rng.choice(BRANCHES),
+        rng.choice(INSURERS),
+        rng.choice(["", "", "Assist Co."]),
+        rng.choice(["", "", "staff", "local"]),
+        rng.choice(["admit", "discharge"]) if ipd else "",
+        str(rng.randint(101, 120)) if ipd else "",
+        json.dumps(diagnosis, ensure_ascii=False),
+        json.dumps(rng.sample(["vital signs", "pain score", "allergy: none"], rng.randint(0, 2)), ensure_ascii=False),
+        json.dumps(treatments, ensure_ascii=False) if rng.random() < 0.98 else "",
+        json.dumps(payment, ensure_ascii=False),
+        json.dumps([f"bill {i}"] if rng.random() < 0.3 else []),
+        json.dumps(rejects, ensure_ascii=False),
+        json.dumps([]),
+        rng.choice(["", "", "follow up", "ส่งต่อ รพ."]),
+        rng.choice(["Krabi Hospital", "Bangkok Hospital Phuket"]) if is_refer else "",
+        rng.choice(["speed boat", "long tail"]) if is_refer else "",
+        rng.choice(["Day", "Night"]),
+        json.dumps(rng.sample(DOCTORS, 2), ensure_ascii=False),
+        json.dumps(rng.sample(DOCTORS, 1), ensure_ascii=False) if rng.random() < 0.8 else "",
+    ]
+
+def generate(path: str, rows: int, month: str = "2025-12", seed: int = 1) -> str:
+    """เขียน CSV จำลอง rows แถว (visit สุ่มภายในเดือน month) คืน path"""
+    rng = random.Random(seed)
+    month_start = dt.datetime.strptime(month, "%Y-%m")
+    minutes = 28 * 24 * 60
+    with open(path, "w", encoding="utf-8", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(COLUMNS)
+        for i in range(rows):
+            writer.writerow(make_row(i, rng, month_start, minutes))
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="สร้าง Patient_summary CSV จำลอง")
+    parser.add_argument("rows", type=int, help="จำนวนแถว (visit)")
+    parser.add_argument("-o", "--out", default="patient_summary_synthetic.csv")
+    parser.add_argument("--month", default="2025-12", help="เดือนของ visit (YYYY-MM)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    generate(args.out, args.rows, month=args.month, seed=args.seed)
+    print(f"✅ {args.out} ({args.rows:,} แถว)")
+
+if __name__ == "__main__":
+    main()
@@ -1,68 +1,372 @@
+"""
+Worldmed Monthly Tools – หน้า Streamlit (`streamlit run doctor_stats.py`)
+
+ไฟล์นี้มีแต่ UI: upload, preview, ปุ่มดาวน์โหลด, sidebar และ cache กลางของ process
+การแปลงข้อมูลทั้งหมดอยู่ใน doctor_stats_core (import ได้โดยไม่ต้องโหลด streamlit)
+"""
 import streamlit as st
 import pandas as pd
-import json
-import datetime as dt
-import pytz
-from io import BytesIO
+import os
+import functools
+import time
+
+from doctor_stats_core import (
+    CHUNK_ROWS, PREVIEW_ROWS, XLSX_MIME, ZIP_MIME, PARQUET_MIME, TRANSFORMS,
+    ResultCache, cache_key, file_digest,
+    SHARED_CACHE_MAX_ENTRIES, SHARED_CACHE_MAX_BYTES, SHARED_CACHE_SPILL_BYTES,
+    start_profiling, stop_profiling, profile_stage, profile_summary, add_profile_records,
+    submit_job,
+    normalized_tables, treatments_with_doctors,
+    incremental_store_path, store_stamp, store_lock, update_store, clear_store,
+    doctor_sheets, sheets_to_excel, export_path, write_xlsx_streaming, read_file_bytes,
+    write_csv_zip, write_workbook_zip, write_parquet, parquet_groups, summary_sheets, with_summary,
+    read_csv_head, run_chunked, concat_frames, ChunkSpool,
+    DATA_DIRS, list_data_files, resolve_data_path, map_file, path_digest,
+    build_doctor_stats_df, STATS_COLS, build_all_df_round, ROUND_REQUIRED_COLS,
+    expand_refer_rows, REFER_COLS, beautify_patient_summary, CLEAN_BASE_COLS,
+    run_transform_parallel,
+)
+
 # =========================
-# Global Config
+# Shared Cache
+# (เก็บผลลัพธ์ข้าม rerun และข้าม session, key = hash ไฟล์ + parameter
+#  คนที่สองที่เปิดไฟล์เดียวกันได้ผลทันที และใช้หน่วยความจำชุดเดียวกัน)
 # =========================
-st.set_page_config(page_title="Worldmed Tools – Doctor & Refer Stats", layout="wide")
 
-st.title("🩺 Worldmed Monthly Tools")
-st.markdown("เลือกเมนูจาก Sidebar ทางซ้ายเพื่อใช้งานแต่ละโปรแกรมได้เลย")
+_MISS = object()
+
+@st.cache_resource
+def get_result_cache() -> ResultCache:
+    """cache ตัวเดียวของ process – budget RAM รวมทุก session (WORLDMED_CACHE_MB) เกินแล้ว spill ลงดิสก์"""
+    return ResultCache(SHARED_CACHE_MAX_ENTRIES, SHARED_CACHE_MAX_BYTES,
+                       spill_max_bytes=SHARED_CACHE_SPILL_BYTES)
+
+def cached_step(step: str, digest: str, fn, **params):
+    """
+    เรียก fn() ครั้งแรก แล้วเก็บผลไว้ตาม (step, digest, params)
+    rerun ครั้งถัดไปที่ไฟล์ + parameter เหมือนเดิมจะได้ผลจาก cache ทันที
+    โหมดเบื้องหลัง: fn รันเป็น job (ดู run_job) – ระหว่างรอ script รอบนี้หยุดที่นี่
+    หมายเหตุ: ผลลัพธ์ที่ได้เป็น object ตัวเดียวกับใน cache ห้ามแก้ไข in-place
+    """
+    return cached_job(cache_key(step, digest, **params), fn)
+
+def cached_job(ck: tuple, fn, valid=None):
+    """
+    ผลของ fn() จาก cache กลางตาม key ck – ไม่มีใน cache จึงคำนวณผ่าน run_job
+    job เก็บผลลง cache เอง rerun ถัดไปจึงได้ผลจาก cache แล้วปล่อย job ที่เสร็จแล้วทิ้ง
+    valid(ผล) เป็นเท็จ (เช่นไฟล์ที่ผลชี้ไปถูกล้างแล้ว) → ทิ้ง entry เดิมแล้วคำนวณใหม่
+    """
+    cache = get_result_cache()
+    value = cache.get(ck, _MISS)
+    if value is not _MISS and valid is not None and not valid(value):
+        cache.discard(ck)
+        value = _MISS
+    if value is _MISS:
+        # session อื่นกำลังคำนวณ key เดียวกันอยู่ → รอผลชุดนั้นแทนการคำนวณซ้ำ
+        return run_job(ck, lambda: cache.get_or_compute(ck, fn))
+    forget_job(ck)
+    return value
+
+def cached_normalized(data: bytes, digest: str) -> dict:
+    """normalized tables ของไฟล์ (cache กลาง + cache บนดิสก์) ใช้ร่วมกันทุกหน้าและทุก session"""
+    return cached_step("normalized", digest, lambda: normalized_tables(data, digest))
+
+def incremental_store() -> str:
+    """ชื่อ store ที่เลือกใน sidebar ("" = ไม่ได้เปิดโหมด incremental)"""
+    if not st.session_state.get("incremental_mode", False):
+        return ""
+    return st.session_state.get("incremental_store", "").strip()
+
+def page_tables(data: bytes, digest: str) -> tuple:
+    """
+    normalized tables ที่หน้ารายงานใช้ + digest สำหรับ cache ขั้นถัดไป
+    โหมด incremental: รวมไฟล์เข้า store แล้วคืนตารางของ store (digest ผูกกับรุ่นของ store)
+    """
+    store = incremental_store()
+    if not store:
+        return cached_normalized(data, digest), digest
+
+    path = incremental_store_path(store)
+
+    def merge() -> tuple:
+        # stamp อ่านภายใต้ lock เดียวกัน → เป็นรุ่นของ store ที่ได้ tables ชุดนี้จริง
+        with store_lock(path):
+            tables, n_new = update_store(path, data)
+            stamp = store_stamp(path)
+        return tables, n_new, stamp
+
+    # ผลผูกกับรุ่นของ store: store ถูกเขียนทับ (ไฟล์อื่นรวมเข้ามา/ล้าง store) → รวมใหม่
+    tables, n_new, stamp = cached_job(cache_key("incremental", digest, store=path), merge,
+                                      valid=lambda hit: hit[2] == store_stamp(path))
+    store_digest = file_digest(f"{path}:{stamp}".encode())
+    st.caption(f"🔁 Incremental store `{store}`: parse ใหม่ {n_new:,} visit "
+               f"(ใน store ทั้งหมด {len(tables['visits']):,} visit)")
+    return tables, store_digest
 
 # =========================
-# Common Helpers
+# Background Jobs
+# (งานหนักรันใน thread pool กลางของ process ไม่ block script thread
+#  ออกจากหน้าแล้วกลับมางานยังเดินต่อ, ผลที่เสร็จแล้วเก็บลง session cache)
 # =========================
 
-def parse_time_to_bangkok_iso_str(t: str) -> str:
+JOB_POLL_SEC = 1.0
+JOB_KEEP_SEC = 30.0   # job ที่เสร็จแล้วแต่ไม่มีหน้าไหนมารับผล (เปลี่ยนหน้า/ตัวเลือกไปแล้ว) ปล่อยทิ้งหลังจากนี้
+
+def background_mode() -> bool:
+    return st.session_state.get("background_jobs", True)
+
+def session_jobs() -> dict:
+    """job ของ session นี้: cache key -> Job (อยู่ข้าม rerun / เปลี่ยนหน้า)"""
+    if "_jobs" not in st.session_state:
+        st.session_state["_jobs"] = {}
+    jobs = st.session_state["_jobs"]
+    now = time.time()
+    for ck, job in list(jobs.items()):
+        if job.status == "done" and now - job.finished > JOB_KEEP_SEC:
+            del jobs[ck]
+    return jobs
+
+def job_label(step: str) -> str:
+    if step == "normalized":
+        return "อ่านและ parse ไฟล์"
+    if step == "incremental":
+        return "รวมไฟล์เข้า incremental store"
+    if step.endswith("_chunked"):
+        return "ประมวลผลทีละ chunk"
+    if step.endswith("_multi"):
+        return "ประมวลผลหลายไฟล์"
+    if step.endswith("_excel") or step.endswith("_file"):
+        return "สร้างไฟล์ดาวน์โหลด"
+    return f"สร้างตาราง ({step})"
+
+def run_job(ck: tuple, fn):
     """
-    สำหรับ time ที่เป็น ISO string เช่น 2025-12-04T17:45:55.707Z
-    แปลงจาก UTC -> Asia/Bangkok แล้ว format DD/MM/YYYY HH:mm
+    ผลของ fn() สำหรับ cache key ck
+    - ปิดโหมดเบื้องหลัง: เรียก fn() ตรง ๆ
+    - ยังไม่เสร็จ: แสดง progress + ปุ่มยกเลิก แล้วหยุด script รอบนี้ (fragment poll แล้ว rerun เมื่อเสร็จ)
+    - error ใน job: raise ต่อในหน้าเว็บเหมือนเรียกตรง
     """
-    try:
-        utc_dt = dt.datetime.fromisoformat(t.replace("Z", "+00:00"))
-        bkk_tz = pytz.timezone("Asia/Bangkok")
-        return utc_dt.astimezone(bkk_tz).strftime("%d/%m/%Y %H:%M")
-    except Exception:
-        return ""
+    if not background_mode():
+        return fn()
+    jobs = session_jobs()
+    job = jobs.get(ck)
+    if job is None:
+        # ขั้นเดียวกันแต่ parameter เปลี่ยน (เลือกตัวเลือกใหม่ระหว่างรอ) → งานเก่าไม่ต้องทำต่อ
+        # (งานเก่าที่เสร็จแล้วก็ปล่อยทิ้ง ผลอยู่ใน cache กลางแล้ว)
+        for other_key, other in list(jobs.items()):
+            if other_key[0] == ck[0]:
+                other.cancel()
+                del jobs[other_key]
+        job = submit_job(job_label(ck[0]), fn, profile=st.session_state.get("profile_mode", False))
+        jobs[ck] = job
+
+    if job.status == "done":
+        forget_job(ck)
+        result, job.result = job.result, None
+        return result
+    if job.status == "error":
+        del jobs[ck]
+        raise job.error
+    if job.status == "cancelled":
+        st.warning(f"⏹ ยกเลิกงานแล้ว: {job.label}")
+        if st.button("▶ เริ่มใหม่", key=f"job_restart_{ck[0]}"):
+            del jobs[ck]
+            st.rerun()
+        st.stop()
+
+    job_progress_panel(ck)
+    st.stop()
+
+def forget_job(ck: tuple):
+    """เอา job ที่เสร็จแล้วของ ck ออกจาก session (ผลอยู่ใน cache กลาง ไม่ต้องค้างใน session_state)"""
+    jobs = session_jobs()
+    job = jobs.get(ck)
+    if job is not None and job.status == "done":
+        del jobs[ck]
+        add_profile_records(job.records)
+        job.records = []
+
+@st.fragment(run_every=JOB_POLL_SEC)
+def job_progress_panel(ck: tuple):
+    """progress bar ของ job ที่อัปเดตเองทุก JOB_POLL_SEC วินาที (rerun เฉพาะ fragment นี้)"""
+    job = session_jobs().get(ck)
+    if job is None or job.done:
+        st.rerun(scope="app")
+    text = f"⏳ {job.label} – {job.message} ({job.elapsed():.0f} วินาที)"
+    st.progress(job.progress, text=text)
+    if job.cancelled:
+        st.caption("กำลังยกเลิก… (หยุดที่จุดตรวจถัดไป)")
+    elif st.button("✖ ยกเลิก", key=f"job_cancel_{ck[0]}"):
+        job.cancel()
+
+# =========================
+# Input Files
+# (upload หรือไฟล์บนเซิร์ฟเวอร์ – ทุกหน้าได้ list ของ CsvSource เหมือนกัน)
+# =========================
+
+class CsvSource:
+    """ไฟล์ CSV 1 ไฟล์ของหน้า: data = bytes (upload) หรือ mmap (ไฟล์บนเซิร์ฟเวอร์)"""
+
+    def __init__(self, name: str, data, digest: str = None, path: str = None):
+        self.name = name
+        self.data = data
+        self.digest = digest or file_digest(data)
+        self.path = path
+
+    @property
+    def ref(self):
+        """สิ่งที่ส่งเข้า process pool ได้: path (mmap pickle ไม่ได้) หรือ bytes"""
+        return self.path or self.data
+
+def data_file_label(path: str) -> str:
+    info = os.stat(path)
+    modified = time.strftime("%d/%m/%Y %H:%M", time.localtime(info.st_mtime))
+    return f"{os.path.basename(path)} ({info.st_size / 1024 / 1024:,.1f} MB, {modified})"
 
-def norm_list(v):
-    if v is None or (isinstance(v, float) and pd.isna(v)):
-        return []
-    if isinstance(v, list):
-        return v
-    return [v]
-
-def safe_sheet_name(name: str) -> str:
-    if name is None:
-        return "Unknown"
-    safe = str(name)[:31]
-    for ch in ['\\', '/', '*', '?', ':', '[', ']']:
-        safe = safe.replace(ch, '-')
-    return safe or "Unknown"
-def safe_json_loads(v):
-    if v is None or (isinstance(v, float) and pd.isna(v)):
-        return None
-    if isinstance(v, (list, dict)):
-        return v
-    if isinstance(v, str):
-        s = v.strip()
-        if not s:
-            return None
+def csv_sources(label: str, key: str) -> list:
+    """
+    ไฟล์ CSV ของหน้านี้: upload หรือ (ถ้าตั้ง WORLDMED_DATA_DIRS) เลือกไฟล์บนเซิร์ฟเวอร์
+    ไฟล์บนเซิร์ฟเวอร์อ่านแบบ memory-mapped: ไม่ติดขนาด upload, ไม่ copy ทั้งไฟล์เข้า RAM,
+    และ cache ผูกกับ path + เวลาแก้ไข (ไม่ต้อง hash ทั้งไฟล์ทุก rerun)
+    """
+    origin = "อัปโหลด"
+    if DATA_DIRS:
+        origin = st.radio("แหล่งไฟล์", ["อัปโหลด", "ไฟล์บนเซิร์ฟเวอร์"], key=f"{key}_origin", horizontal=True)
+    if origin == "อัปโหลด":
+        files = st.file_uploader(label, type=["csv"], key=key, accept_multiple_files=True) or []
+        return [CsvSource(f.name, f.getvalue()) for f in files]
+
+    picked = st.multiselect(
+        "ไฟล์ล่าสุดในโฟลเดอร์ข้อมูล", [path for path, _, _ in list_data_files()],
+        format_func=data_file_label, key=f"{key}_recent",
+        help="เรียงจากไฟล์ที่วางล่าสุด – โฟลเดอร์: " + ", ".join(DATA_DIRS),
+    )
+    typed = st.text_input("หรือระบุ path (หลายไฟล์คั่นด้วย ;)", key=f"{key}_path",
+                          help=f"path สัมพัทธ์นับจาก {DATA_DIRS[0]}")
+    sources = []
+    for path in picked + [p.strip() for p in typed.split(";") if p.strip()]:
         try:
-            return json.loads(s)
-        except Exception:
-            return None
-    return None
+            real = resolve_data_path(path)
+        except ValueError as e:
+            st.error(f"❌ {e}")
+            continue
+        sources.append(CsvSource(os.path.basename(real), map_file(real), path_digest(real), path=real))
+    return sources
 
-def join_list(v, sep=","):
-    if v is None:
-        return ""
-    if isinstance(v, list):
-        return sep.join([str(x) for x in v if x is not None and str(x).strip() != ""])
-    return str(v)
+def filter_controls(key: str) -> dict:
+    """
+    ตัวกรองช่วงวันที่ / treatment / หมอ ของหน้ารายงาน – คืนเฉพาะตัวกรองที่ตั้งค่า
+    (ส่งต่อเข้า build_* และเป็น params ของ cache) ตัวกรองถูกใช้ก่อน parse JSON
+    จึงยิ่งแคบยิ่งเร็ว โดยเฉพาะโหมด chunk และหลายไฟล์
+    """
+    with st.expander("🔎 ตัวกรอง (ก่อนประมวลผล)"):
+        c1, c2 = st.columns(2)
+        since = c1.date_input("ตั้งแต่วันที่", value=None, key=f"{key}_since", format="DD/MM/YYYY")
+        until = c2.date_input("ถึงวันที่", value=None, key=f"{key}_until", format="DD/MM/YYYY")
+        treatment = st.text_input("treatment มีคำว่า", key=f"{key}_treatment").strip()
+        doctors = st.text_input("หมอ (ชื่อตรงตัว หลายคนคั่นด้วย ;)", key=f"{key}_doctors",
+                                help="หมอเจ้าของเคส (practice หรือ order ถ้าไม่มี practice) – เหลือเฉพาะแถวของหมอที่ระบุ")
+    filters = {
+        "since": since,
+        "until": until,
+        "treatment": treatment,
+        "doctors": tuple(d.strip() for d in doctors.split(";") if d.strip()),
+    }
+    return {k: v for k, v in filters.items() if v}
+
+# =========================
+# Excel Download
+# =========================
+
+# รูปแบบไฟล์: (นามสกุล, mime) – สร้างเฉพาะแบบที่ผู้ใช้เลือก
+EXPORT_FORMATS = {
+    "Excel": (".xlsx", XLSX_MIME),
+    "Excel รายหมอ (ZIP)": (".zip", ZIP_MIME),
+    "CSV (ZIP)": (".zip", ZIP_MIME),
+    "Parquet": (".parquet", PARQUET_MIME),
+}
+
+# ชีตสรุป (SUMMARY_MODES ใน core)
+SUMMARY_CHOICES = {
+    "ไม่มี": "none",
+    "สรุป + ข้อมูลดิบ": "include",
+    "เฉพาะสรุป": "only",
+}
+
+def excel_download_button(label: str, sheets_fn, file_name: str, key: str,
+                          step: str, digest: str, streaming: bool = None,
+                          groups_fn=None, summary_fn=None, all_sheet: str = None, **params):
+    """
+    ปุ่มดาวน์โหลดที่ใช้ทุกหน้า มีตัวเลือกรูปแบบไฟล์ (สร้างไฟล์เฉพาะรูปแบบที่เลือก)
+    - Excel ปกติ: สร้าง workbook ใน RAM (cache ไว้เป็น bytes)
+    - Excel โหมด streaming (sidebar หรือ streaming=True): เขียนลงไฟล์ชั่วคราวแบบ constant_memory
+      แล้วให้ปุ่มอ่านไฟล์ตอนกดดาวน์โหลดเท่านั้น
+    - Excel รายหมอ (ZIP, เฉพาะหน้าที่แยกตามหมอ = มี all_sheet): xlsx ไฟล์ละหมอ สร้างใน process pool
+      + ไฟล์ All (เลือกได้)
+    - CSV (ZIP): ชีตละ 1 ไฟล์ CSV (All + รายหมอ) / Parquet: ไฟล์เดียว 1 row group ต่อหมอ (groups_fn)
+      ทุกแบบที่เป็น ZIP/Parquet เขียนลงไฟล์ชั่วคราวเหมือน streaming
+    - summary_fn: ชีตสรุป (ต่อหมอ / treatment / วัน) ใส่เพิ่มหรือใส่แทนข้อมูลดิบได้ใน Excel และ CSV (ZIP)
+      (Excel รายหมอ: ชีตสรุปอยู่ในไฟล์ All)
+    """
+    formats = [f for f in EXPORT_FORMATS
+               if (f != "Parquet" or groups_fn) and (f != "Excel รายหมอ (ZIP)" or all_sheet)]
+    fmt = st.radio("รูปแบบไฟล์", formats, key=f"{key}_format", horizontal=True)
+    suffix, mime = EXPORT_FORMATS[fmt]
+    with_all = True
+    if fmt == "Excel รายหมอ (ZIP)":
+        with_all = st.checkbox(f"รวมไฟล์ {all_sheet}.xlsx (ทุกหมอในไฟล์เดียว)", value=True,
+                               key=f"{key}_with_all")
+        params["with_all"] = with_all
+    if summary_fn and fmt != "Parquet" and with_all:
+        summary = SUMMARY_CHOICES[st.radio(
+            "ชีตสรุป", list(SUMMARY_CHOICES), key=f"{key}_summary", horizontal=True,
+            help="สรุปจำนวนเคสต่อหมอ (ถ่วงน้ำหนักตามจำนวนหมอในรายการ), ต่อ treatment และต่อวัน",
+        )]
+        if summary != "none":
+            raw_sheets_fn = sheets_fn
+            sheets_fn = lambda: with_summary(raw_sheets_fn, summary_fn, summary)
+            params["summary"] = summary
+    if fmt != "Excel":
+        file_name = os.path.splitext(file_name)[0] + suffix
+        label = f"{label} – {fmt}"
+        if fmt == "Parquet":
+            write = lambda path: write_parquet(path, groups_fn())
+        elif fmt == "Excel รายหมอ (ZIP)":
+            write = lambda path: write_workbook_zip(path, sheets_fn(), all_sheet=all_sheet,
+                                                    include_all=with_all)
+        else:
+            write = lambda path: write_csv_zip(path, sheets_fn())
+    else:
+        if streaming is None:
+            streaming = st.session_state.get("streaming_export", False)
+        if not streaming:
+            data = cached_step(step, digest, lambda: sheets_to_excel(sheets_fn()), **params)
+            return st.download_button(label=label, data=data, file_name=file_name,
+                                      mime=mime, key=key)
+        write = lambda path: write_xlsx_streaming(path, sheets_fn())
+
+    path = cached_job(cache_key(f"{step}_file", digest, format=fmt, **params),
+                      lambda: write(export_path(step, suffix=suffix)), valid=os.path.exists)
+    return st.download_button(label=label, data=functools.partial(read_file_bytes, path),
+                              file_name=file_name, mime=mime, key=key)
+
+# =========================
+# Chunked Mode
+# =========================
+
+def cached_spool(step: str, digest: str, fn, **params) -> ChunkSpool:
+    """เหมือน cached_step แต่สร้างใหม่ถ้าโฟลเดอร์ spool ถูกล้างไปแล้ว"""
+    spool = cached_job(cache_key(step, digest, **params), fn,
+                       valid=lambda spool: os.path.isdir(spool.dir))
+    os.utime(spool.dir)  # ยังใช้อยู่ → กันไม่ให้ถูกล้างตามอายุ
+    return spool
+
+def chunked_mode() -> bool:
+    # โหมด incremental ทำงานบน normalized tables ของ store จึงไม่แบ่ง chunk
+    return st.session_state.get("chunked_mode", False) and not incremental_store()
+
+def chunk_rows() -> int:
+    return int(st.session_state.get("chunk_rows", CHUNK_ROWS))
 
 # =========================
 # PAGE 1 – Doctor Monthly Stats
@@ -74,84 +378,75 @@ def page_doctor_stats():
 
     st.write("อัปโหลดไฟล์ CSV ที่มีคอลัมน์ `treatments` เพื่อแปลงเป็น Excel แยกตามแพทย์ (practice)")
 
-    uploaded = st.file_uploader("Upload CSV for Doctor Monthly Stats", type=["csv"], key="stats_uploader")
+    uploaded_files = csv_sources("Upload CSV for Doctor Monthly Stats", key="stats_uploader")
+    filters = filter_controls("stats")
 
-    if not uploaded:
+    if not uploaded_files:
         st.info("⬆️ กรุณาอัปโหลดไฟล์ CSV ด้านบน")
         return
 
-    df = pd.read_csv(uploaded)
-
-    st.subheader("👀 Preview – 5 แถวแรก")
-    st.dataframe(df.head())
+    if len(uploaded_files) > 1:
+        multi_file_export("stats", uploaded_files, file_name="doctor_stats.xlsx", key="stats", **filters)
+        return
+    uploaded = uploaded_files[0]
 
-    rows = []
+    data, digest = uploaded.data, uploaded.digest
+    chunked = chunked_mode()
 
-    for _, row in df.iterrows():
-        raw = row.get("treatments")
-        if pd.isna(raw):
-            continue
-
-        try:
-            treatments = json.loads(raw)
-        except Exception:
-            continue
+    if chunked:
+        df_head = read_csv_head(data)
+    else:
+        tables, digest = page_tables(data, digest)
+        df = tables["visits"]
+        df_head = df.head()
 
-        for t in treatments:
-            practice_list = norm_list(t.get("practice"))
-            order_list = norm_list(t.get("order"))
-            doctor_asst_list = norm_list(t.get("doctor_asst"))
-
-            # นับจำนวนคนที่อยู่ใน practice ถ้าไม่มีให้ใช้ order แทน
-            practice_count = len(practice_list) if practice_list else len(order_list)
-
-            # รายชื่อหมอในแต่ละเคส (ใช้ practice ถ้าไม่มีใช้ order)
-            doctor_list = practice_list if practice_list else order_list or [None]
-
-            time_fmt = parse_time_to_bangkok_iso_str(str(row.get("time", "")))
-
-            for doc in doctor_list:
-                rows.append({
-                    "time": time_fmt,
-                    "HN": row.get("HN", ""),
-                    "patientTitle": row.get("patientTitle", ""),
-                    "patientName": row.get("patientName", ""),
-                    "nationality": row.get("nationality", ""),
-                    "treatment": t.get("treatment", ""),
-                    "area": t.get("area", ""),
-                    "unit": t.get("unit", ""),
-                    "practice": doc,
-                    "practice_count": practice_count,
-                    "order_raw": ",".join(order_list),
-                    "doctor_asst_raw": ",".join(doctor_asst_list),
-                })
-
-    if not rows:
-        st.error("ไม่พบข้อมูลจากคอลัมน์ treatments เลย")
+    st.subheader("👀 Preview – 5 แถวแรก")
+    st.dataframe(df_head)
+
+    if chunked:
+        size = chunk_rows()
+        spool = cached_spool(
+            "doctor_stats_chunked", digest,
+            lambda: run_chunked(data, lambda c: build_doctor_stats_df(c, **filters), key="practice",
+                                chunksize=size, columns=STATS_COLS),
+            chunksize=size,
+            **filters,
+        )
+        n_rows, exp_head = spool.rows, spool.head
+        sheets_fn = lambda: spool.sheets(all_sheet="All")
+        groups_fn = spool.parquet_groups
+        summary_fn = spool.summary_sheets
+    else:
+        exp = cached_step("doctor_stats", digest,
+                          lambda: build_doctor_stats_df(df, treatments_with_doctors(tables), **filters),
+                          **filters)
+        n_rows, exp_head = len(exp), exp
+        sheets_fn = lambda: doctor_sheets(exp, "practice", all_sheet="All")
+        groups_fn = lambda: parquet_groups(exp, "practice")
+        summary_fn = lambda: summary_sheets(exp, "practice")
+
+    if n_rows == 0:
+        st.error("ไม่พบข้อมูลจากคอลัมน์ treatments เลย" + (" (ตามตัวกรอง)" if filters else ""))
         return
 
-    exp = pd.DataFrame(rows)
-
     st.subheader("📋 Preview – Doctor Stats (10 แถวแรก)")
-    st.dataframe(exp.head(10))
-
-    # Export to Excel
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        exp.to_excel(writer, "All", index=False)
-        for doc in sorted(exp["practice"].dropna().unique()):
-            sheet = safe_sheet_name(doc)
-            exp[exp["practice"] == doc].to_excel(writer, sheet_name=sheet, index=False)
-
-    output.seek(0)
+    st.dataframe(exp_head.head(10))
 
     st.success("แปลงสำเร็จ! ดาวน์โหลดไฟล์ด้านล่าง")
-    st.download_button(
+
+    # Export to Excel (โหมด chunk เขียนแบบ streaming เสมอ)
+    excel_download_button(
         label="⬇ Download Doctor Stats Excel",
-        data=output.getvalue(),
+        sheets_fn=sheets_fn,
         file_name="doctor_stats.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key="dl_stats_excel"
+        key="dl_stats_excel",
+        step="doctor_stats_excel",
+        digest=digest,
+        streaming=True if chunked else None,
+        groups_fn=groups_fn,
+        summary_fn=summary_fn,
+        all_sheet="All",
+        **filters,
     )
 
 # =========================
@@ -159,73 +454,6 @@ def page_doctor_stats():
 # (จาก app.py – Doctor Round/Discharge Exporter)
 # =========================
 
-def convert_time_round(val):
-    if pd.isna(val):
-        return None
-
-    # ถ้าเป็น datetime อยู่แล้ว
-    if isinstance(val, (dt.datetime, pd.Timestamp)):
-        try:
-            dt_utc = pd.to_datetime(val).tz_localize("UTC")
-            dt_bkk = dt_utc.tz_convert("Asia/Bangkok")
-            return dt_bkk.strftime("%d/%m/%Y %H:%M")
-        except Exception:
-            return val.strftime("%d/%m/%Y %H:%M")
-
-    # ถ้าเป็น string → parse
-    try:
-        dt_utc = pd.to_datetime(val, utc=True)
-        dt_bkk = dt_utc.tz_convert("Asia/Bangkok")
-        return dt_bkk.strftime("%d/%m/%Y %H:%M")
-    except Exception:
-        return val
-
-def build_all_df_round(df: pd.DataFrame) -> pd.DataFrame:
-    rows = []
-
-    for idx, row in df.iterrows():
-        treatments_raw = row.get("treatments")
-        # parse JSON
-        if isinstance(treatments_raw, str):
-            try:
-                t_list = json.loads(treatments_raw)
-            except Exception:
-                t_list = []
-        else:
-            t_list = []
-
-        doctors = []
-        for t in t_list or []:
-            ord_list = t.get("order") or []
-            for d in ord_list:
-                if d and d not in doctors:
-                    doctors.append(d)
-
-        # ถ้าไม่มีหมอใน order → เก็บใน ALL แบบ order = None, order_count = 0
-        if not doctors:
-            doctors = [None]
-            order_count = 0
-        else:
-            order_count = len(doctors)
-
-        for d in doctors:
-            new_row = {
-                "time": row.get("time"),
-                "ipd_status": row.get("ipd_status"),
-                "patientTitle": row.get("patientTitle"),
-                "patientName": row.get("patientName"),
-                "room": row.get("room"),
-                "nationality": row.get("nationality"),
-                "order": d,
-                "order_count": order_count,
-            }
-            rows.append(new_row)
-
-    all_df = pd.DataFrame(rows)
-    # แปลง time format → GMT+7
-    all_df["time"] = all_df["time"].apply(convert_time_round)
-    return all_df
-
 def page_doctor_round():
     st.header("🏨 Doctor Round / Discharge Exporter")
 
@@ -234,58 +462,80 @@ def page_doctor_round():
 ระบบจะแตกชื่อหมอจาก `order` แล้วทำ Excel แยกชีตตามหมอ
 """)
 
-    uploaded_file = st.file_uploader("📥 เลือกไฟล์ CSV สำหรับ Doctor Round", type=["csv"], key="round_uploader")
+    uploaded_files = csv_sources("📥 เลือกไฟล์ CSV สำหรับ Doctor Round", key="round_uploader")
 
-    if uploaded_file is None:
+    if not uploaded_files:
         st.info("⬆️ กรุณาอัปโหลดไฟล์ CSV ด้านบนก่อน")
         return
 
+    if len(uploaded_files) > 1:
+        multi_file_export("round", uploaded_files,
+                          file_name="Doctor_round_discharge_export.xlsx", key="round")
+        return
+    uploaded_file = uploaded_files[0]
+
     # อ่าน CSV
-    try:
-        df = pd.read_csv(uploaded_file)
-    except UnicodeDecodeError:
-        df = pd.read_csv(uploaded_file, encoding="utf-8-sig")
+    data, digest = uploaded_file.data, uploaded_file.digest
+    chunked = chunked_mode()
+
+    if chunked:
+        df_head = read_csv_head(data)
+    else:
+        tables, digest = page_tables(data, digest)
+        df = tables["visits"]
+        df_head = df.head()
 
     st.subheader("👀 Preview ข้อมูลจาก CSV (5 แถวแรก)")
-    st.dataframe(df.head())
+    st.dataframe(df_head)
 
     # ตรวจว่ามีคอลัมน์ที่ต้องใช้ไหม
-    required_cols = ["time", "ipd_status", "patientTitle", "patientName",
-                     "room", "nationality", "treatments"]
-    missing = [c for c in required_cols if c not in df.columns]
+    missing = [c for c in ROUND_REQUIRED_COLS if c not in df_head.columns]
 
     if missing:
         st.error(f"❌ ขาดคอลัมน์จำเป็นใน CSV: {missing}")
         return
 
-    all_df = build_all_df_round(df)
+    if chunked:
+        size = chunk_rows()
+        spool = cached_spool(
+            "doctor_round_chunked", digest,
+            lambda: run_chunked(data, build_all_df_round, key="order",
+                                chunksize=size, columns=ROUND_REQUIRED_COLS),
+            chunksize=size,
+        )
+        all_head = spool.head if spool.head is not None else pd.DataFrame(columns=spool.columns)
+        doctors = spool.keys()
+        sheets_fn = lambda: spool.sheets(all_sheet="ALL")
+        groups_fn = spool.parquet_groups
+        summary_fn = spool.summary_sheets
+    else:
+        all_df = cached_step("doctor_round", digest,
+                             lambda: build_all_df_round(df, treatments_with_doctors(tables)))
+        all_head = all_df
+        doctors = sorted([d for d in all_df["order"].dropna().unique()])
+        sheets_fn = lambda: doctor_sheets(all_df, "order", all_sheet="ALL")
+        groups_fn = lambda: parquet_groups(all_df, "order")
+        summary_fn = lambda: summary_sheets(all_df, "order")
 
     st.subheader("📋 Preview ตาราง ALL (หลังประมวลผล) - 10 แถวแรก")
-    st.dataframe(all_df.head(10))
+    st.dataframe(all_head.head(10))
 
     # list รายชื่อหมอ
-    doctors = sorted([d for d in all_df["order"].dropna().unique()])
     st.markdown(f"👨‍⚕️ พบแพทย์ทั้งหมด: **{len(doctors)} คน**")
     st.write(doctors)
 
-    # สร้าง Excel ในหน่วยความจำ
-    buffer = BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        all_df.to_excel(writer, sheet_name="ALL", index=False)
-        for doctor in doctors:
-            doc_df = all_df[all_df["order"] == doctor]
-            sheet_name = safe_sheet_name(doctor)
-            doc_df.to_excel(writer, sheet_name=sheet_name, index=False)
-
-    buffer.seek(0)
-
     st.subheader("📤 ดาวน์โหลดไฟล์ Excel")
-    st.download_button(
+    excel_download_button(
         label="⬇️ Download Excel (ALL + แยกตามชื่อหมอ)",
-        data=buffer,
+        sheets_fn=sheets_fn,
         file_name="Doctor_round_discharge_export.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key="dl_round_excel"
+        key="dl_round_excel",
+        step="doctor_round_excel",
+        digest=digest,
+        streaming=True if chunked else None,
+        groups_fn=groups_fn,
+        summary_fn=summary_fn,
+        all_sheet="ALL",
     )
 
 # =========================
@@ -293,119 +543,6 @@ def page_doctor_round():
 # (จาก refer.py)
 # =========================
 
-def parse_json_list_str(s):
-    """แปลง string แบบ '["NAT","NICE"]' -> 'NAT,NICE'"""
-    if s is None or (isinstance(s, float) and pd.isna(s)):
-        return ""
-    if isinstance(s, list):
-        # เผื่อมีกรณีอ่านมาเป็น list อยู่แล้ว
-        return ",".join(map(str, s))
-    try:
-        data = json.loads(s)
-        if isinstance(data, list):
-            return ",".join(map(str, data))
-        return str(data)
-    except Exception:
-        # ถ้า parse ไม่ได้ก็ส่งดิบ ๆ กลับไป
-        return str(s)
-
-def format_time_gmt7_series(series):
-    """
-    แปลง ISO string -> GMT+7 แล้ว format เป็น DD/MM/YYYY HH:mm
-    เช่น 2025-12-01T19:01:55.634Z -> 02/12/2025 02:01 (ถ้าตีว่าเดิมเป็น UTC)
-    """
-    dt_ser = pd.to_datetime(series, utc=True, errors="coerce")
-    dt_ser = dt_ser + pd.Timedelta(hours=7)
-    return dt_ser.dt.strftime("%d/%m/%Y %H:%M")
-
-def expand_refer_rows(df, only_refer=True):
-    """
-    แตก treatments JSON เป็น 1 row ต่อ 1 treatment ต่อ 1 doctor (practice/order)
-    แล้วดึง field refer ที่ต้องใช้ออกมาด้วย
-    """
-    rows = []
-    for _, row in df.iterrows():
-        raw_treat = row.get("treatments")
-        if pd.isna(raw_treat):
-            continue
-        try:
-            treatments = json.loads(raw_treat)
-        except Exception:
-            continue
-
-        for t in treatments:
-            treatment_name = t.get("treatment", "")
-
-            # ถ้าเลือกให้เอาเฉพาะ refer
-            if only_refer and "refer" not in treatment_name.lower():
-                continue
-
-            practice_list = norm_list(t.get("practice"))
-            order_list = norm_list(t.get("order"))
-            doctor_list = practice_list if practice_list else order_list or [None]
-
-            # จำนวนคนใน practice (ถ้า practice ว่าง ใช้จำนวนจาก order)
-            practice_count = len(practice_list) if practice_list else len(order_list) if order_list else 0
-
-            # common fields
-            time_str = row.get("time", "")
-            hn = row.get("HN", "")
-            patient_title = row.get("patientTitle", "")
-            patient_name = row.get("patientName", "")
-            nationality = row.get("nationality", "")
-            refer_to = row.get("referTo", "")
-            type_of_boat = row.get("typeOfBoat", "")
-            shift_val = row.get("shift", "")
-            on_duty_raw = row.get("onDuty", "")
-            on_call_raw = row.get("onCall", "")
-
-            on_duty = parse_json_list_str(on_duty_raw)
-            on_call = parse_json_list_str(on_call_raw)
-
-            order_raw = ",".join(map(str, order_list)) if order_list else ""
-
-            for doc in doctor_list:
-                rows.append({
-                    "time": time_str,
-                    "HN": hn,
-                    "patientTitle": patient_title,
-                    "patientName": patient_name,
-                    "nationality": nationality,
-                    "treatment": treatment_name,
-                    "practice": doc,
-                    "practice_count": practice_count,
-                    "order": order_raw,
-                    "referTo": refer_to,
-                    "typeOfBoat": type_of_boat,
-                    "Shift": shift_val,
-                    "onDuty": on_duty,
-                    "onCall": on_call,
-                })
-
-    result = pd.DataFrame(rows)
-    if not result.empty:
-        result["time"] = format_time_gmt7_series(result["time"])
-    return result
-
-def to_excel_with_sheets(df: pd.DataFrame, file_name="refer_summary.xlsx"):
-    """
-    แปลง DataFrame เป็นไฟล์ Excel แบบมีชีต All + แยกตาม practice
-    """
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        # ชีต All
-        df.to_excel(writer, sheet_name="All", index=False)
-
-        # แยกชีตตาม practice
-        practices = sorted(df["practice"].dropna().unique())
-        for p in practices:
-            sub_df = df[df["practice"] == p]
-            safe_name = safe_sheet_name(p)
-            sub_df.to_excel(writer, sheet_name=safe_name, index=False)
-
-    output.seek(0)
-    return output, file_name
-
 def page_refer_summary():
     st.header("📦 Refer Summary (Practice-based)")
 
@@ -418,33 +555,62 @@ def page_refer_summary():
 - referTo, typeOfBoat, Shift, onDuty, onCall  
 """)
 
-    uploaded = st.file_uploader("อัปโหลดไฟล์ Patient_summary CSV", type=["csv"], key="refer_uploader")
+    uploaded_files = csv_sources("อัปโหลดไฟล์ Patient_summary CSV", key="refer_uploader")
 
     only_refer = st.checkbox("เอาเฉพาะ treatment ที่เป็น Refer เท่านั้น", value=True)
+    filters = filter_controls("refer")
 
-    if uploaded is None:
+    if not uploaded_files:
         st.info("โปรดอัปโหลดไฟล์ CSV ทางด้านบนก่อนครับ 🙂")
         return
 
-    # อ่านไฟล์
-    try:
-        df_raw = pd.read_csv(uploaded, encoding="utf-8-sig")
-    except UnicodeDecodeError:
-        df_raw = pd.read_csv(uploaded, encoding="latin1")
+    if len(uploaded_files) > 1:
+        multi_file_export("refer", uploaded_files, file_name="refer_summary.xlsx", key="refer",
+                          filter_label="เลือก Practice ที่ต้องการดู (เว้นว่าง = ดูทั้งหมด)",
+                          only_refer=only_refer, **filters)
+        return
+    uploaded = uploaded_files[0]
 
-    st.success(f"โหลดข้อมูลสำเร็จ มี {len(df_raw):,} แถว (raw)")
+    # อ่านไฟล์
+    data, digest = uploaded.data, uploaded.digest
+    chunked = chunked_mode()
 
     # แตก refer rows
-    df_refer = expand_refer_rows(df_raw, only_refer=only_refer)
-
-    if df_refer.empty:
+    if chunked:
+        size = chunk_rows()
+        st.success(f"โหลดข้อมูลสำเร็จ (ประมวลผลทีละ {size:,} แถว)")
+        spool = cached_spool(
+            "refer_rows_chunked", digest,
+            lambda: run_chunked(data, lambda c: expand_refer_rows(c, only_refer=only_refer, **filters),
+                                key="practice", chunksize=size, columns=REFER_COLS),
+            only_refer=only_refer,
+            chunksize=size,
+            **filters,
+        )
+        n_refer = spool.rows
+        all_practices = spool.keys()
+    else:
+        tables, digest = page_tables(data, digest)
+        df_raw = tables["visits"]
+        st.success(f"โหลดข้อมูลสำเร็จ มี {len(df_raw):,} แถว (raw)")
+
+        df_refer = cached_step(
+            "refer_rows", digest,
+            lambda: expand_refer_rows(df_raw, only_refer=only_refer,
+                                      tdf=treatments_with_doctors(tables), **filters),
+            only_refer=only_refer,
+            **filters,
+        )
+        n_refer = len(df_refer)
+        all_practices = sorted(df_refer["practice"].dropna().unique()) if n_refer else []
+
+    if n_refer == 0:
         st.warning("ไม่พบข้อมูล refer ตามเงื่อนไขในไฟล์นี้")
         return
 
-    st.info(f"ได้ refer rows ทั้งหมด {len(df_refer):,} แถว")
+    st.info(f"ได้ refer rows ทั้งหมด {n_refer:,} แถว")
 
     # เลือก filter ตาม practice
-    all_practices = sorted(df_refer["practice"].dropna().unique())
     selected_practices = st.multiselect(
         "เลือก Practice ที่ต้องการดู (เว้นว่าง = ดูทั้งหมด)",
         options=all_practices,
@@ -452,336 +618,45 @@ def page_refer_summary():
         key="refer_practice_multi"
     )
 
-    if selected_practices:
-        df_view = df_refer[df_refer["practice"].isin(selected_practices)]
+    if chunked:
+        keys = selected_practices or None
+        df_view = spool.head
+        sheets_fn = lambda: spool.sheets(all_sheet="All", keys=keys)
+        groups_fn = lambda: spool.parquet_groups(keys=keys)
+        summary_fn = lambda: spool.summary_sheets(keys=keys)
     else:
         df_view = df_refer
+        sheets_fn = lambda: doctor_sheets(df_view, "practice", all_sheet="All")
+        groups_fn = lambda: parquet_groups(df_view, "practice")
+        summary_fn = lambda: summary_sheets(df_view, "practice")
+
+    if selected_practices:
+        df_view = df_view[df_view["practice"].isin(selected_practices)]
 
     st.write("ตัวอย่างข้อมูล (top 200 rows):")
     st.dataframe(df_view.head(200))
 
     # ดาวน์โหลดเป็น Excel
-    excel_buffer, fname = to_excel_with_sheets(df_view, file_name="refer_summary.xlsx")
-    st.download_button(
+    excel_download_button(
         label="⬇️ ดาวน์โหลด Refer Summary (Excel)",
-        data=excel_buffer,
-        file_name=fname,
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key="dl_refer_excel"
+        sheets_fn=sheets_fn,
+        file_name="refer_summary.xlsx",
+        key="dl_refer_excel",
+        step="refer_excel",
+        digest=digest,
+        streaming=True if chunked else None,
+        groups_fn=groups_fn,
+        summary_fn=summary_fn,
+        all_sheet="All",
+        only_refer=only_refer,
+        practices=tuple(selected_practices),
+        **filters,
     )
-# ---------- Time helpers ----------
-def format_time_gmt7(val):
-    """
-    รองรับทั้ง ISO string, timestamp, datetime
-    output: DD/MM/YYYY HH:mm (Asia/Bangkok)
-    """
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        return ""
-    try:
-        ts = pd.to_datetime(val, utc=True, errors="coerce")
-        if pd.isna(ts):
-            # เผื่อเป็น datetime ที่ไม่มี tz
-            ts = pd.to_datetime(val, errors="coerce")
-            if pd.isna(ts):
-                return str(val)
-            # assume local? (fallback)
-            return ts.strftime("%d/%m/%Y %H:%M")
-        ts = ts.tz_convert("Asia/Bangkok")
-        return ts.strftime("%d/%m/%Y %H:%M")
-    except Exception:
-        return str(val)
-
-def safe_json_loads(v):
-    if v is None or (isinstance(v, float) and pd.isna(v)):
-        return None
-    if isinstance(v, (list, dict)):
-        return v
-    if isinstance(v, str):
-        s = v.strip()
-        if not s:
-            return None
-        try:
-            return json.loads(s)
-        except Exception:
-            return None
-    return None
-
-def norm_list(v):
-    if v is None or (isinstance(v, float) and pd.isna(v)):
-        return []
-    if isinstance(v, list):
-        return v
-    return [v]
-
-def join_list(v, sep=","):
-    if v is None:
-        return ""
-    if isinstance(v, list):
-        return sep.join([str(x) for x in v if x is not None and str(x).strip() != ""])
-    return str(v)
+
 # =========================
 # PAGE 4 – Patient Summary Clean Export
 # 
 # =========================
-def beautify_patient_summary(
-    df: pd.DataFrame,
-    diag_top_n: int = 10,     # top N diagnosis columns
-    treat_top_n: int = 6      # top N treatments columns
-) -> pd.DataFrame:
-    """
-    - เพิ่ม time (formatted)
-    - diagnosis: ทำทั้ง join string + แตกคอลัมน์แบบ dynamic topN
-    - treatments: ทำทั้ง join string + แตกคอลัมน์แบบ dynamic topN
-    """
-    base_cols = [
-        "time",
-        "HN", "VN", "visit_type", "patientTitle", "patientName", "patientAge", "nationality",
-        "branch", "insurance_name", "assist_insurance", "concessionType",
-        "diagnosis", "medLog", "treatments", "payment_status", "billLog", "rejects", "retry", "note"
-    ]
-    keep = [c for c in base_cols if c in df.columns]
-    out = df[keep].copy()
-
-    # ---------- time ----------
-    if "time" in out.columns:
-        out["time_fmt"] = out["time"].apply(format_time_gmt7)
-    else:
-        out["time_fmt"] = ""
-
-    # เตรียม list เก็บค่าที่จะใส่กลับเข้า out ทีเดียว
-    diag_count = []
-    diag_join = []
-    diag_codes_join, diag_titles_join, diag_cats_join = [], [], []
-
-    treat_count = []
-    treat_join = []
-    treat_names_join, treat_areas_join, treat_units_join = [], [], []
-    treat_order_join, treat_practice_join, treat_asst_join = [], [], []
-
-    # ---------- payment_status (ของเดิมยังใช้ได้) ----------
-    pay_status = []
-    pay_invoice_id = []
-    pay_total_invoiced = []
-    pay_case_type = []
-    pay_reason_not_insurance = []
-
-    # ---------- rejects ----------
-    has_reject = []
-    reject_type = []
-    reject_reason = []
-    reject_problem = []
-
-    # ---------- logs ----------
-    medlog_list = []
-    billlog_list = []
-    retry_list = []
-
-    # เก็บ diagnosis/treatment สำหรับทำ dynamic columns
-    diags_all_rows = []
-    treats_all_rows = []
-
-    def first_of(v):
-        if isinstance(v, list) and v:
-            return v[0]
-        return v
-
-    for _, r in out.iterrows():
-        # ===== diagnosis =====
-        diag = safe_json_loads(r.get("diagnosis"))
-        diag_items = [x for x in diag if isinstance(x, dict)] if isinstance(diag, list) else []
-        diags_all_rows.append(diag_items)
-
-        diag_count.append(len(diag_items))
-
-        # ทำ join string แบบอ่านง่าย + split ได้
-        diag_parts = []
-        codes, titles, cats = [], [], []
-        for x in diag_items:
-            code = str(x.get("code", "") or "").strip()
-            title = str(x.get("title", "") or "").strip()
-            cat = str(x.get("categoryLabel", "") or "").strip()
-
-            if code: codes.append(code)
-            if title: titles.append(title)
-            if cat: cats.append(cat)
-
-            # สไตล์เดียวกับ vue: Code:..., Title:...
-            if code or title or cat:
-                seg = []
-                if code:  seg.append(f"Code:{code}")
-                if title: seg.append(f"Title:{title}")
-                if cat:   seg.append(f"Cat:{cat}")
-                diag_parts.append(", ".join(seg))
-
-        diag_join.append(" | ".join(diag_parts))
-        diag_codes_join.append(",".join(codes))
-        diag_titles_join.append(",".join(titles))
-        diag_cats_join.append(",".join(cats))
-
-        # ===== treatments =====
-        tr = safe_json_loads(r.get("treatments"))
-        tr_items = [x for x in tr if isinstance(x, dict)] if isinstance(tr, list) else []
-        treats_all_rows.append(tr_items)
-
-        treat_count.append(len(tr_items))
-
-        tr_parts = []
-        names, areas, units = [], [], []
-        orders_all, practices_all, assts_all = [], [], []
-
-        for t in tr_items:
-            tname = str(t.get("treatment", "") or "").strip()
-            area  = str(t.get("area", "") or "").strip()
-            unit  = str(t.get("unit", "") or "").strip()
-
-            if tname: names.append(tname)
-            if area:  areas.append(area)
-            if unit:  units.append(unit)
-
-            ords  = norm_list(t.get("order"))
-            pracs = norm_list(t.get("practice"))
-            assts = norm_list(t.get("doctor_asst"))
-
-            # รวมเป็น string ราย treatment
-            ord_s  = join_list(ords)
-            prac_s = join_list(pracs)
-            asst_s = join_list(assts)
-
-            if ord_s:  orders_all.append(ord_s)
-            if prac_s: practices_all.append(prac_s)
-            if asst_s: assts_all.append(asst_s)
-
-            # join แบบคล้าย vue (เอาไป split ด้วย | ได้)
-            seg = [
-                f"Treatment:{tname}",
-                f"Area:{area}",
-                f"Unit:{unit}",
-                f"Order:{ord_s}",
-                f"Practice:{prac_s}",
-                f"Asst:{asst_s}",
-            ]
-            tr_parts.append(", ".join([s for s in seg if not s.endswith(":")]))
-
-        treat_join.append(" | ".join([p for p in tr_parts if p.strip()]))
-        treat_names_join.append(",".join(names))
-        treat_areas_join.append(",".join(areas))
-        treat_units_join.append(",".join(units))
-        treat_order_join.append(" | ".join(orders_all))
-        treat_practice_join.append(" | ".join(practices_all))
-        treat_asst_join.append(" | ".join(assts_all))
-
-        # ===== payment_status =====
-        ps = safe_json_loads(r.get("payment_status"))
-        ps0 = ps[0] if isinstance(ps, list) and ps and isinstance(ps[0], dict) else {}
-
-        pay_status.append(str(first_of(ps0.get("status")) or ""))
-        pay_invoice_id.append(str(first_of(ps0.get("invoice_id")) or ""))
-        pay_total_invoiced.append(first_of(ps0.get("total_invoiced")))
-        pay_case_type.append(str(first_of(ps0.get("case_type")) or ""))
-        pay_reason_not_insurance.append(str(first_of(ps0.get("reasonNotInsurance")) or ""))
-
-        # ===== rejects =====
-        rej = safe_json_loads(r.get("rejects"))
-        rej0 = rej[0] if isinstance(rej, list) and rej and isinstance(rej[0], dict) else {}
-        r_type = str(rej0.get("reject", "") or "").strip()
-        r_reason = str(rej0.get("reason", "") or "").strip()
-        r_prob = str(rej0.get("problem", "") or "").strip()
-
-        has_reject.append(bool(r_type or r_reason or r_prob))
-        reject_type.append(r_type)
-        reject_reason.append(r_reason)
-        reject_problem.append(r_prob)
-
-        # ===== logs =====
-        ml = safe_json_loads(r.get("medLog"))
-        bl = safe_json_loads(r.get("billLog"))
-        rt = safe_json_loads(r.get("retry"))
-
-        ml_list = ml if isinstance(ml, list) else []
-        bl_list = bl if isinstance(bl, list) else []
-        rt_list = rt if isinstance(rt, list) else []
-
-        medlog_list.append(join_list(ml_list))
-        billlog_list.append(join_list(bl_list))
-        retry_list.append(join_list(rt_list))
-
-    # ใส่คอลัมน์ join/summarize
-    out["diag_count"] = diag_count
-    out["diag_join"] = diag_join
-    out["diag_codes"] = diag_codes_join
-    out["diag_titles"] = diag_titles_join
-    out["diag_categories"] = diag_cats_join
-
-    out["treat_count"] = treat_count
-    out["treat_join"] = treat_join
-    out["treat_names"] = treat_names_join
-    out["treat_areas"] = treat_areas_join
-    out["treat_units"] = treat_units_join
-    out["treat_orders"] = treat_order_join
-    out["treat_practices"] = treat_practice_join
-    out["treat_assts"] = treat_asst_join
-
-    out["pay_status"] = pay_status
-    out["pay_invoice_id"] = pay_invoice_id
-    out["pay_total_invoiced"] = pay_total_invoiced
-    out["pay_case_type"] = pay_case_type
-    out["pay_reason_not_insurance"] = pay_reason_not_insurance
-
-    out["has_reject"] = has_reject
-    out["reject_type"] = reject_type
-    out["reject_reason"] = reject_reason
-    out["reject_problem"] = reject_problem
-
-    out["medLog_list"] = medlog_list
-    out["billLog_list"] = billlog_list
-    out["retry_list"] = retry_list
-
-    # ---------- Dynamic TOP-N columns ----------
-    # diagnosis: diag_code_1..N, diag_title_1..N, diag_category_1..N
-    n_diag = min(diag_top_n, max([len(x) for x in diags_all_rows] or [0]))
-    for i in range(n_diag):
-        out[f"diag_code_{i+1}"] = [
-            str(items[i].get("code", "") or "").strip() if i < len(items) else ""
-            for items in diags_all_rows
-        ]
-        out[f"diag_title_{i+1}"] = [
-            str(items[i].get("title", "") or "").strip() if i < len(items) else ""
-            for items in diags_all_rows
-        ]
-        out[f"diag_category_{i+1}"] = [
-            str(items[i].get("categoryLabel", "") or "").strip() if i < len(items) else ""
-            for items in diags_all_rows
-        ]
-
-    # treatments: treat_name_1..N, treat_area_1..N, treat_unit_1..N, treat_order_1..N, treat_practice_1..N
-    n_treat = min(treat_top_n, max([len(x) for x in treats_all_rows] or [0]))
-    for i in range(n_treat):
-        out[f"treat_name_{i+1}"] = [
-            str(items[i].get("treatment", "") or "").strip() if i < len(items) else ""
-            for items in treats_all_rows
-        ]
-        out[f"treat_area_{i+1}"] = [
-            str(items[i].get("area", "") or "").strip() if i < len(items) else ""
-            for items in treats_all_rows
-        ]
-        out[f"treat_unit_{i+1}"] = [
-            str(items[i].get("unit", "") or "").strip() if i < len(items) else ""
-            for items in treats_all_rows
-        ]
-        out[f"treat_order_{i+1}"] = [
-            join_list(norm_list(items[i].get("order"))) if i < len(items) else ""
-            for items in treats_all_rows
-        ]
-        out[f"treat_practice_{i+1}"] = [
-            join_list(norm_list(items[i].get("practice"))) if i < len(items) else ""
-            for items in treats_all_rows
-        ]
-        out[f"treat_asst_{i+1}"] = [
-            join_list(norm_list(items[i].get("doctor_asst"))) if i < len(items) else ""
-            for items in treats_all_rows
-        ]
-
-    return out
 def page_patient_summary_clean_export():
     st.header("🧹 Patient Summary Clean Export – CSV → Excel (Filter-ready)")
 
@@ -790,54 +665,240 @@ def page_patient_summary_clean_export():
 ระบบจะแตกคอลัมน์ JSON/array (diagnosis, treatments, payment_status, rejects) ให้เป็นคอลัมน์ใหม่เพื่อ filter ง่ายใน Excel
 """)
 
-    uploaded = st.file_uploader("Upload Patient_summary CSV", type=["csv"], key="ps_clean_uploader")
-    if uploaded is None:
+    uploaded_files = csv_sources("Upload Patient_summary CSV", key="ps_clean_uploader")
+    if not uploaded_files:
         st.info("⬆️ กรุณาอัปโหลดไฟล์ CSV ด้านบน")
         return
 
+    if len(uploaded_files) > 1:
+        multi_file_export("clean", uploaded_files, file_name="patient_summary_clean.xlsx",
+                          key="ps_clean")
+        return
+    uploaded = uploaded_files[0]
+
     # อ่านไฟล์
-    try:
-        df_raw = pd.read_csv(uploaded, encoding="utf-8-sig")
-    except UnicodeDecodeError:
-        df_raw = pd.read_csv(uploaded, encoding="latin1")
+    data, digest = uploaded.data, uploaded.digest
+    chunked = chunked_mode()
 
-    st.subheader("👀 Preview – Raw (5 แถวแรก)")
-    st.dataframe(df_raw.head())
+    if chunked:
+        df_raw_head = read_csv_head(data)
+    else:
+        tables, digest = page_tables(data, digest)
+        df_raw = tables["visits"]
+        df_raw_head = df_raw.head()
 
-    df_clean = beautify_patient_summary(df_raw)
+    st.subheader("👀 Preview – Raw (5 แถวแรก)")
+    st.dataframe(df_raw_head)
+
+    if chunked:
+        # คอลัมน์ top-N ที่ chunk ไหนไม่มี จะเติม "" ตอนเขียน (เหมือนรันทั้งไฟล์)
+        size = chunk_rows()
+        spool = cached_spool(
+            "patient_summary_clean_chunked", digest,
+            lambda: run_chunked(data, beautify_patient_summary, chunksize=size,
+                                columns=CLEAN_BASE_COLS),
+            chunksize=size,
+        )
+        clean_head = spool.head if spool.head is not None else pd.DataFrame(columns=spool.columns)
+        sheets_fn = lambda: spool.sheets(all_sheet="Clean")
+        groups_fn = spool.parquet_groups
+        summary_fn = lambda: spool.summary_sheets(time_col="time_fmt")
+    else:
+        df_clean = cached_step("patient_summary_clean", digest,
+                               lambda: beautify_patient_summary(df_raw, tables=tables))
+        clean_head = df_clean
+        sheets_fn = lambda: [("Clean", df_clean)]
+        groups_fn = lambda: parquet_groups(df_clean)
+        summary_fn = lambda: summary_sheets(df_clean, time_col="time_fmt")
 
     st.subheader("✨ Preview – Clean (10 แถวแรก)")
-    st.dataframe(df_clean.head(10))
+    st.dataframe(clean_head.head(10))
 
     # Export
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        df_clean.to_excel(writer, sheet_name="Clean", index=False)
-
-    output.seek(0)
-    st.download_button(
+    excel_download_button(
         label="⬇ Download Patient Summary Clean Excel",
-        data=output.getvalue(),
+        sheets_fn=sheets_fn,
         file_name="patient_summary_clean.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        key="dl_ps_clean_excel"
+        key="dl_ps_clean_excel",
+        step="patient_summary_clean_excel",
+        digest=digest,
+        streaming=True if chunked else None,
+        groups_fn=groups_fn,
+        summary_fn=summary_fn,
     )
 
 # =========================
-# SIDEBAR NAVIGATION
+# Multi-file / Parallel
+# (อัปโหลดหลายไฟล์ → แต่ละไฟล์ประมวลผลใน process แยก แล้วรวมหรือแยก export)
 # =========================
 
-st.sidebar.title("🧭 เมนู")
-page = st.sidebar.radio(
-    "เลือกโปรแกรม",
-    ["Doctor Stats", "Doctor Round", "Refer Summary","Patient Summary Clean Export"]
-)
+def multi_file_export(name: str, files: list, file_name: str, key: str,
+                      filter_label: str = None, **kwargs):
+    """
+    หน้าเว็บเมื่ออัปโหลดหลายไฟล์: ประมวลผลทุกไฟล์ใน process pool แล้วให้เลือก
+    - รวมเป็น export เดียว (ต่อแถวตามลำดับไฟล์) หรือ
+    - แยก export ต่อไฟล์
+    filter_label: ถ้ากำหนด จะมี multiselect กรองตามคอลัมน์หมอในโหมดรวม
+    """
+    spec = TRANSFORMS[name]
+    datas = [f.ref for f in files]
+    digests = [f.digest for f in files]
+    digest = file_digest("".join(digests).encode())
+
+    combine = st.radio(
+        "รูปแบบไฟล์ผลลัพธ์",
+        ["รวมเป็นไฟล์เดียว", "แยกไฟล์ละ 1 export"],
+        key=f"{key}_multi_mode",
+        horizontal=True,
+    ) == "รวมเป็นไฟล์เดียว"
+
+    try:
+        results = cached_step(f"{name}_multi", digest,
+                              lambda: run_transform_parallel(name, datas, **kwargs), **kwargs)
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        return
+
+    st.success(f"ประมวลผล {len(files)} ไฟล์ สำเร็จ (ทำพร้อมกันสูงสุด {min(len(files), os.cpu_count() or 1)} process)")
+    if chunked_mode():
+        st.caption("โหมดหลายไฟล์ประมวลผลไฟล์ละ 1 process ทั้งไฟล์ (ไม่แบ่ง chunk)")
+    if incremental_store():
+        st.caption("โหมดหลายไฟล์ไม่ใช้ incremental store – อัปโหลดไฟล์สะสมทีละไฟล์เพื่อรวมเข้า store")
+
+    if not combine:
+        for i, (f, d, res) in enumerate(zip(files, digests, results)):
+            st.markdown(f"**{f.name}** – {len(res):,} แถว")
+            stem = os.path.splitext(f.name)[0]
+            sheets_fn = (lambda res=res: doctor_sheets(res, spec["key"], all_sheet=spec["all_sheet"])) \
+                if spec["key"] else (lambda res=res: [(spec["all_sheet"], res)])
+            excel_download_button(
+                label=f"⬇ Download {f.name}",
+                sheets_fn=sheets_fn,
+                groups_fn=lambda res=res: parquet_groups(res, spec["key"]),
+                summary_fn=lambda res=res: summary_sheets(res, spec["key"], spec["time_col"]),
+                all_sheet=spec["all_sheet"] if spec["key"] else None,
+                file_name=f"{stem}_{file_name}",
+                key=f"{key}_{i}",
+                step=f"{name}_file_excel",
+                digest=d,
+                **kwargs,
+            )
+        return
 
-if page == "Doctor Stats":
-    page_doctor_stats()
-elif page == "Doctor Round":
-    page_doctor_round()
-elif page == "Refer Summary":
-    page_refer_summary()
-elif page == "Patient Summary Clean Export":
-    page_patient_summary_clean_export()
+    merged = cached_step(f"{name}_multi_merged", digest,
+                         lambda: concat_frames(results), **kwargs)
+    st.info(f"รวมทั้งหมด {len(merged):,} แถว")
+
+    selected = []
+    if filter_label and spec["key"]:
+        selected = st.multiselect(filter_label, options=sorted(merged[spec["key"]].dropna().unique()),
+                                  key=f"{key}_multi_filter")
+    view = merged[merged[spec["key"]].isin(selected)] if selected else merged
+
+    st.dataframe(view.head(PREVIEW_ROWS))
+    excel_download_button(
+        label="⬇ Download Excel (รวมทุกไฟล์)",
+        sheets_fn=(lambda: doctor_sheets(view, spec["key"], all_sheet=spec["all_sheet"]))
+        if spec["key"] else (lambda: [(spec["all_sheet"], view)]),
+        groups_fn=lambda: parquet_groups(view, spec["key"]),
+        summary_fn=lambda: summary_sheets(view, spec["key"], spec["time_col"]),
+        all_sheet=spec["all_sheet"] if spec["key"] else None,
+        file_name=file_name,
+        key=f"{key}_combined",
+        step=f"{name}_multi_excel",
+        digest=digest,
+        selected=tuple(selected),
+        **kwargs,
+    )
+
+# =========================
+# Global Config + SIDEBAR NAVIGATION
+# (รันเฉพาะตอน `streamlit run doctor_stats.py` – import เพื่อใช้ฟังก์ชันจะไม่สร้าง UI)
+# =========================
+
+PAGES = {
+    "Doctor Stats": page_doctor_stats,
+    "Doctor Round": page_doctor_round,
+    "Refer Summary": page_refer_summary,
+    "Patient Summary Clean Export": page_patient_summary_clean_export,
+}
+
+def main():
+    st.set_page_config(page_title="Worldmed Tools – Doctor & Refer Stats", layout="wide")
+
+    st.title("🩺 Worldmed Monthly Tools")
+    st.markdown("เลือกเมนูจาก Sidebar ทางซ้ายเพื่อใช้งานแต่ละโปรแกรมได้เลย")
+
+    st.sidebar.title("🧭 เมนู")
+    page = st.sidebar.radio(
+        "เลือกโปรแกรม",
+        list(PAGES)
+    )
+    st.sidebar.checkbox(
+        "💾 Export แบบประหยัดหน่วยความจำ (streaming)",
+        key="streaming_export",
+        help="เขียน Excel ทีละแถวลงไฟล์ชั่วคราวแทนการสร้างทั้งไฟล์ใน RAM เหมาะกับไฟล์ใหญ่",
+    )
+    if st.sidebar.checkbox(
+        "📦 ประมวลผลทีละ chunk (ไฟล์ใหญ่)",
+        key="chunked_mode",
+        help="อ่าน CSV และแตกแถวทีละส่วน แล้วเขียน Excel แบบ streaming จากไฟล์ชั่วคราว "
+             "หน่วยความจำที่ใช้ขึ้นกับขนาด chunk ไม่ใช่ขนาดไฟล์",
+    ):
+        st.sidebar.number_input("จำนวนแถวต่อ chunk", min_value=1_000, step=10_000,
+                                value=CHUNK_ROWS, key="chunk_rows")
+    if st.sidebar.checkbox(
+        "🔁 Incremental (ไฟล์สะสมทั้งเดือน)",
+        key="incremental_mode",
+        help="จำ visit ที่ประมวลผลแล้ว (HN/VN/time) ไฟล์วันถัดไป parse เฉพาะ visit ใหม่หรือที่แก้ไข "
+             "แล้วสร้างรายงานจากข้อมูลที่รวมแล้วทั้งหมด",
+    ):
+        store = st.sidebar.text_input("ชื่อ store (เช่น เดือน)", value=time.strftime("%Y-%m"),
+                                      key="incremental_store")
+        if st.sidebar.button("🗑 ล้าง store", key="incremental_clear"):
+            clear_store(incremental_store_path(store))
+            st.sidebar.success(f"ล้าง store `{store}` แล้ว")
+    st.sidebar.checkbox(
+        "⏳ ประมวลผลเบื้องหลัง",
+        value=True,
+        key="background_jobs",
+        help="งานหนัก (parse, แตกแถว, สร้างไฟล์) รันใน thread แยก: เห็นความคืบหน้า กดยกเลิกได้ "
+             "เปลี่ยนหน้าไปแล้วงานยังทำต่อ และผู้ใช้หลายคนไม่ต้องรอกัน",
+    )
+    profiling = st.sidebar.checkbox(
+        "⏱ จับเวลาแต่ละขั้น (profiling)",
+        key="profile_mode",
+        help="แสดงเวลา จำนวนแถว และ RSS peak ของแต่ละขั้นใน rerun นี้ และเขียน log เป็น JSON "
+             "(logger `worldmed.profile`) – ขั้นที่ได้จาก cache จะไม่ปรากฏ",
+    )
+
+    render_cache_status()
+
+    if not profiling:
+        PAGES[page]()
+        return
+
+    start_profiling(page)
+    try:
+        with profile_stage("page"):
+            PAGES[page]()
+    finally:
+        render_profile_panel(stop_profiling())
+
+def render_cache_status():
+    stats = get_result_cache().stats()
+    mb = lambda n: n / 1024 / 1024
+    text = (f"🗄 cache กลาง: {stats['entries']} รายการ, {mb(stats['nbytes']):,.0f}/{mb(stats['max_bytes']):,.0f} MB")
+    if stats["spill_bytes"]:
+        text += f" (+ ดิสก์ {mb(stats['spill_bytes']):,.0f} MB)"
+    st.sidebar.caption(text)
+
+def render_profile_panel(records: list):
+    with st.sidebar.expander("⏱ Profiling – rerun ล่าสุด", expanded=True):
+        if not records:
+            st.caption("ไม่มีขั้นที่ประมวลผลใหม่ (ใช้ผลจาก cache ทั้งหมด)")
+            return
+        st.dataframe(profile_summary(records), hide_index=True)
+
+if __name__ == "__main__":
+    main()
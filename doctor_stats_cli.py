@@ -0,0 +1,213 @@
+"""
+Worldmed Monthly Tools – รันแบบ command line (ไม่ต้องเปิด Streamlit)
+
+ตัวอย่าง:
+    python doctor_stats_cli.py stats  Patient_summary_2025-12.csv -o out/
+    python doctor_stats_cli.py round  a.csv b.csv --chunksize 50000
+    python doctor_stats_cli.py stats  2025-*.csv -j 0          # ทุก core, ไฟล์ละ 1 process
+    python doctor_stats_cli.py refer  Patient_summary.csv --all-treatments --format csv
+    python doctor_stats_cli.py clean  Patient_summary.csv --streaming
+    python doctor_stats_cli.py stats  Patient_summary.csv --format zip       # All.csv + CSV รายหมอ
+    python doctor_stats_cli.py round  Patient_summary.csv --format parquet   # 1 row group ต่อหมอ
+    python doctor_stats_cli.py stats  Patient_summary.csv --per-doctor       # ZIP ของ xlsx ไฟล์ละหมอ
+    python doctor_stats_cli.py stats  Patient_summary.csv --summary only     # เฉพาะชีตสรุป/pivot
+    python doctor_stats_cli.py stats  Patient_summary_2025-12-05.csv --store 2025-12   # parse เฉพาะ visit ใหม่
+    python doctor_stats_cli.py refer  Patient_summary.csv --since 2025-12-01 --until 2025-12-07 --doctor "Dr. A"
+
+ไฟล์ผลลัพธ์ชื่อ <ชื่อไฟล์ CSV>_<transform>.<format> ในโฟลเดอร์ -o (--per-doctor → .zip)
+"""
+import argparse
+import datetime as dt
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import doctor_stats_core as ds
+
+# ชื่อไฟล์ผลลัพธ์ของแต่ละ transform (ตัว transform เองอยู่ใน ds.TRANSFORMS)
+SUFFIXES = {
+    "stats": "doctor_stats",
+    "round": "doctor_round_discharge",
+    "refer": "refer_summary",
+    "clean": "patient_summary_clean",
+}
+
+# transform ที่รับตัวกรอง since/until/treatment/doctors (กรองก่อน parse JSON)
+FILTERED = ("stats", "refer")
+
+def filter_kwargs(args) -> dict:
+    filters = {
+        "since": args.since,
+        "until": args.until,
+        "treatment": args.treatment.strip(),
+        "doctors": tuple(args.doctor),
+    }
+    return {k: v for k, v in filters.items() if v}
+
+def transform_kwargs(name: str, args) -> dict:
+    filters = filter_kwargs(args) if name in FILTERED else {}
+    if name == "refer":
+        return {"only_refer": not args.all_treatments, **filters}
+    if name == "clean":
+        return {"diag_top_n": args.diag_top_n, "treat_top_n": args.treat_top_n}
+    return filters
+
+def iso_date(text: str) -> dt.date:
+    try:
+        return dt.date.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"วันที่ต้องเป็น YYYY-MM-DD: {text!r}")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="doctor_stats_cli",
+        description="แปลง Patient_summary CSV เป็น Excel/CSV แบบเดียวกับหน้า Streamlit",
+    )
+    parser.add_argument("transform", choices=sorted(ds.TRANSFORMS))
+    parser.add_argument("paths", nargs="+", help="ไฟล์ CSV ต้นทาง (ได้หลายไฟล์)")
+    parser.add_argument("-o", "--out-dir", default=".", help="โฟลเดอร์ปลายทาง (default: .)")
+    parser.add_argument("--format", choices=["xlsx", "csv", "zip", "parquet"], default="xlsx",
+                        help="xlsx = All + แยกชีตตามหมอ, csv = เฉพาะตาราง All, "
+                             "zip = All.csv + CSV รายหมอ, parquet = ไฟล์เดียวแบ่ง row group ตามหมอ")
+    parser.add_argument("--streaming", action="store_true",
+                        help="เขียน xlsx แบบ constant_memory (ประหยัด RAM)")
+    parser.add_argument("--per-doctor", action="store_true",
+                        help="xlsx: ZIP ของ workbook ไฟล์ละหมอ เขียนพร้อมกันใน process pool (+ ไฟล์ All)")
+    parser.add_argument("--no-all", action="store_true",
+                        help="--per-doctor: ไม่ใส่ไฟล์ All (และชีตสรุป) ใน ZIP")
+    parser.add_argument("--chunksize", type=int, default=0,
+                        help="อ่าน CSV ทีละกี่แถว (0 = อ่านทั้งไฟล์); เปิดแล้วจะเขียนแบบ streaming เสมอ")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="จำนวนไฟล์ที่ประมวลผลพร้อมกัน (process pool, 0 = เท่าจำนวน core)")
+    parser.add_argument("--store", default="",
+                        help="ชื่อ incremental store: รวมไฟล์สะสมเข้า store แล้วสร้างผลจากทั้ง store "
+                             "(หลายไฟล์จะรวมทีละไฟล์ตามลำดับ, ไม่ใช้ร่วมกับ --chunksize)")
+    parser.add_argument("--summary", choices=ds.SUMMARY_MODES, default="none",
+                        help="xlsx/zip: ชีตสรุปต่อหมอ/treatment/วัน (include = ใส่ก่อนชีตข้อมูล, only = เฉพาะสรุป)")
+    parser.add_argument("--profile", action="store_true",
+                        help="เขียนเวลา/จำนวนแถว/RSS peak ของแต่ละขั้นเป็น JSON ทีละบรรทัดออก stderr")
+    parser.add_argument("--since", type=iso_date, help="stats/refer: เฉพาะ visit ตั้งแต่วันที่ (YYYY-MM-DD, เวลาไทย)")
+    parser.add_argument("--until", type=iso_date, help="stats/refer: เฉพาะ visit ถึงวันที่ (รวมวันนั้น)")
+    parser.add_argument("--treatment", default="", help="stats/refer: เฉพาะ treatment ที่มีคำนี้ (ไม่สนตัวพิมพ์)")
+    parser.add_argument("--doctor", action="append", default=[],
+                        help="stats/refer: เฉพาะแถวของหมอคนนี้ (ชื่อตรงตัว, ใส่ซ้ำได้หลายคน)")
+    parser.add_argument("--all-treatments", action="store_true",
+                        help="refer: เอาทุก treatment ไม่ใช่เฉพาะ Refer")
+    parser.add_argument("--diag-top-n", type=int, default=10, help="clean: จำนวนคอลัมน์ diagnosis")
+    parser.add_argument("--treat-top-n", type=int, default=6, help="clean: จำนวนคอลัมน์ treatments")
+    return parser
+
+def write_csv(path: str, frames):
+    """เขียน CSV (utf-8-sig ให้ Excel อ่านภาษาไทยได้) จาก df หรือ iterable ของ chunk"""
+    header = True
+    with open(path, "w", encoding="utf-8-sig", newline="") as fh:
+        for frame in frames:
+            frame.to_csv(fh, index=False, header=header)
+            header = False
+
+def run_one(path: str, args) -> tuple:
+    spec = ds.TRANSFORMS[args.transform]
+    kwargs = transform_kwargs(args.transform, args)
+    data = ds.map_file(path)   # memory-mapped: ไม่ copy ทั้งไฟล์เข้า RAM
+    build = lambda df: spec["build"](df, **kwargs)
+    per_doctor = args.per_doctor and args.format == "xlsx" and spec["key"]
+    ext = "zip" if per_doctor else args.format
+    out_path = os.path.join(args.out_dir, f"{Path(path).stem}_{SUFFIXES[args.transform]}.{ext}")
+
+    required = spec.get("required_cols")
+    if required:
+        head = ds.read_csv_head(data)
+        missing = [c for c in required if c not in head.columns]
+        if missing:
+            raise ValueError(f"ขาดคอลัมน์จำเป็นใน CSV: {missing}")
+
+    if args.chunksize and not args.store:
+        spool = ds.run_chunked(data, build, key=spec["key"], chunksize=args.chunksize,
+                               columns=spec["columns"])
+        try:
+            if args.format == "csv":
+                write_csv(out_path, spool.iter_all())
+            elif args.format == "parquet":
+                ds.write_parquet(out_path, spool.parquet_groups())
+            else:
+                sheets = ds.with_summary(lambda: spool.sheets(all_sheet=spec["all_sheet"]),
+                                         lambda: spool.summary_sheets(spec["time_col"]), args.summary)
+                if args.format == "zip":
+                    ds.write_csv_zip(out_path, sheets)
+                elif per_doctor:
+                    ds.write_workbook_zip(out_path, sheets, all_sheet=spec["all_sheet"], include_all=not args.no_all)
+                else:
+                    ds.write_xlsx_streaming(out_path, sheets)
+        finally:
+            spool.close()
+        return out_path, spool.rows
+
+    result = ds.run_transform(args.transform, data, store=args.store or None, **kwargs)
+    if args.format == "csv":
+        write_csv(out_path, [result])
+        return out_path, len(result)
+    if args.format == "parquet":
+        ds.write_parquet(out_path, ds.parquet_groups(result, spec["key"]))
+        return out_path, len(result)
+
+    if spec["key"]:
+        raw_sheets = lambda: ds.doctor_sheets(result, spec["key"], all_sheet=spec["all_sheet"])
+    else:
+        raw_sheets = lambda: [(spec["all_sheet"], result)]
+    sheets = ds.with_summary(raw_sheets, lambda: ds.summary_sheets(result, spec["key"], spec["time_col"]),
+                             args.summary)
+    if args.format == "zip":
+        ds.write_csv_zip(out_path, sheets)
+    elif per_doctor:
+        ds.write_workbook_zip(out_path, sheets, all_sheet=spec["all_sheet"], include_all=not args.no_all)
+    elif args.streaming:
+        ds.write_xlsx_streaming(out_path, sheets)
+    else:
+        with open(out_path, "wb") as fh:
+            fh.write(ds.sheets_to_excel(sheets))
+    return out_path, len(result)
+
+def _timed_run(path: str, args) -> tuple:
+    if args.profile:
+        ds.start_profiling(path)
+    started = time.perf_counter()
+    try:
+        with ds.profile_stage("file"):
+            out_path, rows = run_one(path, args)
+    finally:
+        ds.stop_profiling()
+    return out_path, rows, time.perf_counter() - started
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    jobs = args.jobs or os.cpu_count() or 1
+    if jobs > 1 and len(args.paths) > 1 and not args.store:
+        pool = ProcessPoolExecutor(max_workers=min(jobs, len(args.paths)))
+        futures = [pool.submit(_timed_run, path, args) for path in args.paths]
+    else:
+        pool = None
+        futures = None
+
+    failed = 0
+    for i, path in enumerate(args.paths):
+        try:
+            if futures:
+                out_path, rows, elapsed = futures[i].result()
+            else:
+                out_path, rows, elapsed = _timed_run(path, args)
+        except Exception as e:
+            failed += 1
+            print(f"❌ {path}: {e}", file=sys.stderr)
+            continue
+        print(f"✅ {path} → {out_path} ({rows:,} แถว, {elapsed:.1f}s)")
+
+    if pool:
+        pool.shutdown()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2571 @@
+"""
+Worldmed Monthly Tools – core (ไม่ import streamlit)
+
+transform ทั้ง 4 หน้า, explode engine, normalized/incremental cache, Excel export และ chunked pipeline
+ใช้ร่วมกันระหว่างหน้า Streamlit (doctor_stats.py), CLI (doctor_stats_cli.py), process pool และ bench
+dependency หนักที่ใช้เฉพาะตอน export/cache (xlsxwriter, pyarrow) import ตอนเรียกใช้ครั้งแรก
+"""
+import pandas as pd
+import json
+import os
+import re
+import codecs
+import pickle
+import shutil
+import sys
+import time
+import hashlib
+import tempfile
+import functools
+import itertools
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+import io
+import mmap
+from io import BytesIO
+
+# =========================
+# Profiling
+# (จับเวลา / จำนวนแถว / RSS peak ของแต่ละขั้น เฉพาะตอนเปิด – ปิดอยู่เหลือแค่เช็ค flag)
+# =========================
+
+PROFILE_LOG = logging.getLogger("worldmed.profile")
+if not PROFILE_LOG.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    PROFILE_LOG.addHandler(_handler)
+    PROFILE_LOG.setLevel(logging.INFO)
+    PROFILE_LOG.propagate = False
+
+# แยกตาม thread: Streamlit รันแต่ละ session คนละ thread
+_profile = threading.local()
+
+def _proc_status_kb(field: str):
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _reset_peak() -> bool:
+    """Linux: เขียน 5 ลง clear_refs เพื่อ reset VmHWM ให้เท่ากับ RSS ปัจจุบัน"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        return True
+    except OSError:
+        return False
+
+def _maxrss_kb() -> int:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+def _peak_rss_kb(reset: bool = False) -> tuple:
+    """
+    คืน (peak ก่อน reset, rss ปัจจุบัน) เป็น kB
+    Linux reset VmHWM ได้ผ่าน clear_refs; OS อื่นใช้ ru_maxrss ซึ่ง reset ไม่ได้ (ค่าประมาณ)
+    หมายเหตุ: peak เป็นของทั้ง process – ถ้ามีหลาย session ทำงานพร้อมกันค่าจะปนกัน
+    """
+    hwm = _proc_status_kb("VmHWM")
+    if hwm is None:
+        rss = _maxrss_kb()
+        return rss, rss
+    if reset:
+        _reset_peak()
+    return hwm, _proc_status_kb("VmRSS") or hwm
+
+def start_profiling(context: str = ""):
+    """เริ่มเก็บ record ของ thread นี้ (เช่น 1 rerun ของหน้า หรือ 1 ไฟล์ใน CLI)"""
+    _profile.records = []
+    _profile.stack = []
+    _profile.seq = 0
+    _profile.context = context
+
+def stop_profiling() -> list:
+    records = getattr(_profile, "records", None) or []
+    _profile.records = None
+    return records
+
+def _nrows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, list, tuple, np.ndarray)):
+        return len(value)
+    return None
+
+class profile_stage:
+    """
+    with profile_stage("excel_write", rows_in=len(df)) as rec: ...; rec["rows_out"] = n
+    ตอนปิด profiling จะไม่วัดอะไรเลย (rec เป็น dict ทิ้ง)
+    """
+
+    def __init__(self, name: str, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.records = getattr(_profile, "records", None)
+
+    def __enter__(self) -> dict:
+        if self.records is None:
+            return {}
+        stack = _profile.stack
+        hwm, rss = _peak_rss_kb(reset=True)
+        if stack:
+            stack[-1]["_peak_kb"] = max(stack[-1]["_peak_kb"], hwm)
+        self.rec = {
+            "seq": _profile.seq,
+            "stage": self.name,
+            "path": "/".join([r["stage"] for r in stack] + [self.name]),
+            "depth": len(stack),
+            "rows_in": self.rows_in,
+            "rows_out": None,
+            "_start_kb": rss,
+            "_peak_kb": rss,
+        }
+        _profile.seq += 1
+        stack.append(self.rec)
+        self.started = time.perf_counter()
+        return self.rec
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.records is None:
+            return False
+        rec = self.rec
+        rec["seconds"] = round(time.perf_counter() - self.started, 4)
+        hwm, _ = _peak_rss_kb()
+        peak = max(rec.pop("_peak_kb"), hwm)
+        rec["rss_peak_delta_mb"] = round(max(peak - rec.pop("_start_kb"), 0) / 1024, 1)
+        if exc_type is not None:
+            rec["error"] = exc_type.__name__
+        stack = _profile.stack
+        stack.pop()
+        if stack:
+            stack[-1]["_peak_kb"] = max(stack[-1]["_peak_kb"], peak)
+        self.records.append(rec)
+        PROFILE_LOG.info(json.dumps({"event": "stage", "context": _profile.context, "ts": round(time.time(), 3),
+                                     **rec}, ensure_ascii=False))
+        return False
+
+def profiled(name: str):
+    """decorator: วัดทั้งฟังก์ชันเป็น 1 stage (rows_in จาก argument แรก, rows_out จากผลลัพธ์)"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if getattr(_profile, "records", None) is None:
+                return fn(*args, **kwargs)
+            with profile_stage(name, rows_in=_nrows(args[0]) if args else None) as rec:
+                out = fn(*args, **kwargs)
+                rec["rows_out"] = _nrows(out)
+            return out
+        return wrapper
+    return deco
+
+def profile_summary(records: list) -> pd.DataFrame:
+    """รวม record ที่ path เดียวกัน (เช่น json_parse หลายคอลัมน์) เรียงตามลำดับที่เริ่ม"""
+    if not records:
+        return pd.DataFrame(columns=["stage", "calls", "seconds", "rows_in", "rows_out", "peak_mb"])
+    df = pd.DataFrame(records)
+    total = lambda s: pd.to_numeric(s).sum(min_count=1)
+    out = df.groupby("path", sort=False).agg(
+        seq=("seq", "min"),
+        depth=("depth", "first"),
+        stage=("stage", "first"),
+        calls=("stage", "size"),
+        seconds=("seconds", "sum"),
+        rows_in=("rows_in", total),
+        rows_out=("rows_out", total),
+        peak_mb=("rss_peak_delta_mb", "max"),
+    ).sort_values("seq")
+    out["stage"] = ["\u00a0\u00a0" * d + s for d, s in zip(out["depth"], out["stage"])]
+    return out.reset_index(drop=True).drop(columns=["seq", "depth"])
+
+def add_profile_records(records: list):
+    """ต่อ record ที่วัดจาก thread อื่น (เช่น background job) เข้ากับ rerun ปัจจุบัน (ถ้าเปิด profiling)"""
+    current = getattr(_profile, "records", None)
+    if current is not None and records:
+        current.extend(records)
+
+# =========================
+# Background Jobs
+# (งานหนักรันใน thread pool กลางของ process: หน้าเว็บแค่ poll ความคืบหน้า กดยกเลิกได้
+#  ฟังก์ชันใน core รายงานความคืบหน้าผ่าน job_progress() – นอก job ไม่ทำอะไร)
+# =========================
+
+JOB_WORKERS = max(2, min(4, os.cpu_count() or 1))   # งานพร้อมกันทั้ง process (ทุก session รวมกัน)
+
+class JobCancelled(Exception):
+    """ผู้ใช้กดยกเลิก – ยกขึ้นจาก job_progress() ในจุดตรวจถัดไป"""
+
+class Job:
+    """
+    งาน 1 ชิ้นใน thread pool
+    status: queued → running → done / error / cancelled
+    progress 0..1, message = ขั้นที่กำลังทำ, result / error เมื่อจบ
+    """
+
+    def __init__(self, label: str, profile: bool = False):
+        self.label = label
+        self.profile = profile
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = "รอคิว"
+        self.result = None
+        self.error = None
+        self.records = []
+        self.span = (0.0, 1.0)   # ช่วงของ progress ที่ขั้นปัจจุบันรายงานลงไป (ดู job_span)
+        self.started = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def cancel(self):
+        self._cancel.set()
+        if self.status == "queued":
+            self.message = "กำลังยกเลิก"
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def elapsed(self) -> float:
+        return (self.finished or time.time()) - self.started
+
+    def _run(self, fn, args, kwargs):
+        _job_local.job = self
+        if self.profile:
+            start_profiling(self.label)
+        try:
+            if self.cancelled:
+                raise JobCancelled()
+            self.status, self.message = "running", "เริ่มทำงาน"
+            self.result = fn(*args, **kwargs)
+            self.status, self.progress = "done", 1.0
+        except JobCancelled:
+            self.status, self.message = "cancelled", "ยกเลิกแล้ว"
+        except BaseException as e:
+            self.status, self.error = "error", e
+        finally:
+            if self.profile:
+                self.records = stop_profiling()
+            _job_local.job = None
+            self.finished = time.time()
+
+_job_local = threading.local()
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+def submit_job(label: str, fn, *args, profile: bool = False, **kwargs) -> Job:
+    """ส่ง fn(*args, **kwargs) เข้า thread pool กลาง คืน Job ไว้ poll"""
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="worldmed-job")
+    job = Job(label, profile=profile)
+    _job_pool.submit(job._run, fn, args, kwargs)
+    return job
+
+def _job_running() -> bool:
+    return getattr(_job_local, "job", None) is not None
+
+def job_progress(fraction: float = None, message: str = None):
+    """
+    รายงานความคืบหน้าของ job ที่ thread นี้กำลังทำ (fraction 0..1 ของขั้นปัจจุบัน, None = ไม่เปลี่ยน)
+    และเป็นจุดตรวจการยกเลิก: ถ้าผู้ใช้กดยกเลิกจะ raise JobCancelled
+    """
+    job = getattr(_job_local, "job", None)
+    if job is None:
+        return
+    if job._cancel.is_set():
+        raise JobCancelled()
+    if fraction is not None:
+        lo, hi = job.span
+        job.progress = lo + (hi - lo) * min(max(float(fraction), 0.0), 1.0)
+    if message is not None:
+        job.message = message
+
+class job_span:
+    """
+    with job_span(0.2, 0.6): ... → progress 0..1 ที่รายงานข้างในถูกย่อลงช่วง 20–60% ของขั้นปัจจุบัน
+    ซ้อนกันได้ (เช่น chunk → parse JSON ใน chunk นั้น); นอก job ไม่ทำอะไร
+    """
+
+    def __init__(self, lo: float, hi: float, message: str = None):
+        self.lo, self.hi, self.message = lo, hi, message
+        self.job = getattr(_job_local, "job", None)
+
+    def __enter__(self):
+        if self.job is not None:
+            self.prev = self.job.span
+            a, b = self.prev
+            self.job.span = (a + (b - a) * self.lo, a + (b - a) * self.hi)
+            job_progress(0.0, self.message)
+        return self
+
+    def __exit__(self, *exc):
+        if self.job is not None:
+            self.job.span = self.prev
+        return False
+
+# =========================
+# Common Helpers
+# =========================
+
+BANGKOK_TZ = "Asia/Bangkok"
+TIME_FMT = "%d/%m/%Y %H:%M"
+
+def to_bangkok_datetime(values) -> pd.Series:
+    """
+    แปลงเวลาทั้ง Series จาก UTC -> Asia/Bangkok ในครั้งเดียว
+    รองรับ ISO string (มี/ไม่มี Z หรือ offset), string ทั่วไป, datetime, Timestamp ปนกันได้
+    ค่าที่ไม่มี timezone ถือว่าเป็น UTC, ค่าที่แปลงไม่ได้ → NaT
+    """
+    s = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    # รอบแรก: ISO8601 (เร็ว, ครอบคลุม export ปกติ)
+    parsed = pd.to_datetime(s, utc=True, errors="coerce", format="ISO8601")
+    # รอบสอง: เฉพาะแถวที่ไม่ผ่าน ลอง parse แบบยืดหยุ่น
+    retry = parsed.isna() & s.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(s[retry], utc=True, errors="coerce", format="mixed")
+    return parsed.dt.tz_convert(BANGKOK_TZ)
+
+@profiled("time_convert")
+def format_bangkok_time(values, fmt: str = TIME_FMT, missing="", invalid="keep") -> pd.Series:
+    """
+    แปลงเวลาเป็น Asia/Bangkok แล้ว format (ค่าเริ่มต้น DD/MM/YYYY HH:mm)
+    - missing: ค่าที่ใส่แทนช่องว่าง/NaN
+    - invalid: ค่าที่ใส่แทนแถวที่แปลงไม่ได้ ("keep" = คืนค่าเดิม)
+    """
+    s = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    bkk = to_bangkok_datetime(s)
+
+    # format เฉพาะค่าที่ไม่ซ้ำ แล้วกระจายกลับ (เวลาในไฟล์เดือนหนึ่งซ้ำกันเยอะ)
+    codes, uniques = pd.factorize(bkk)
+    formatted = np.asarray(uniques.strftime(fmt), dtype=object)
+    out = np.empty(len(s), dtype=object)
+    ok = codes >= 0
+    out[ok] = formatted[codes[ok]]
+
+    is_missing = s.isna().to_numpy()
+    failed = ~ok & ~is_missing
+    out[is_missing] = missing
+    if failed.any():
+        out[failed] = s.to_numpy(dtype=object)[failed] if invalid == "keep" else invalid
+    return pd.Series(out.tolist(), index=s.index)
+
+def norm_list(v):
+    if v is None or (isinstance(v, float) and pd.isna(v)):
+        return []
+    if isinstance(v, list):
+        return v
+    return [v]
+
+def safe_sheet_name(name: str) -> str:
+    if name is None:
+        return "Unknown"
+    safe = str(name)[:31]
+    for ch in ['\\', '/', '*', '?', ':', '[', ']']:
+        safe = safe.replace(ch, '-')
+    return safe or "Unknown"
+def safe_json_loads(v):
+    if v is None or (isinstance(v, float) and pd.isna(v)):
+        return None
+    if isinstance(v, (list, dict)):
+        return v
+    if isinstance(v, str):
+        s = v.strip()
+        if not s:
+            return None
+        try:
+            return json.loads(s)
+        except Exception:
+            return None
+    return None
+
+def join_list(v, sep=","):
+    if v is None:
+        return ""
+    if isinstance(v, list):
+        return sep.join([str(x) for x in v if x is not None and str(x).strip() != ""])
+    return str(v)
+
+def first_of(v):
+    if isinstance(v, list) and v:
+        return v[0]
+    return v
+
+def item_text(d: dict, k: str) -> str:
+    """ค่าของ key ใน item JSON เป็น string ที่ strip แล้ว (ไม่มี / None → "")"""
+    return str(d.get(k, "") or "").strip()
+
+# =========================
+# Result Cache
+# (เก็บผลลัพธ์ข้าม rerun ของ Streamlit, key = hash ไฟล์ + parameter
+#  หน้าเว็บใช้ cache กลางตัวเดียวทั้ง process: ไฟล์เดียวกันจากหลาย session ใช้ผลชุดเดียวกัน)
+# =========================
+
+CACHE_MAX_ENTRIES = 32
+CACHE_MAX_BYTES = 512 * 1024 * 1024  # 512 MB
+SHARED_CACHE_MAX_ENTRIES = 128
+SHARED_CACHE_MAX_BYTES = int(os.environ.get("WORLDMED_CACHE_MB", "2048")) * 1024 * 1024
+SHARED_CACHE_SPILL_BYTES = int(os.environ.get("WORLDMED_CACHE_SPILL_MB", "4096")) * 1024 * 1024  # 0 = ไม่ spill
+
+_MISSING = object()
+
+def file_digest(data: bytes) -> str:
+    """hash ของไฟล์ที่อัปโหลด ใช้เป็น key ของ cache"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def estimate_nbytes(value) -> int:
+    """ประมาณขนาดหน่วยความจำของค่าที่จะเก็บใน cache"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, BytesIO):
+        return value.getbuffer().nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(v) for v in value.values())
+    return sys.getsizeof(value)
+
+def spillable(value) -> bool:
+    """
+    ค่าที่ควรเขียนลงดิสก์ตอนถูกไล่ออกจาก RAM: DataFrame / bytes หรือ list/tuple/dict ของสิ่งเหล่านี้
+    (path ไฟล์ export / ChunkSpool อยู่บนดิสก์อยู่แล้ว ไม่ spill)
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, bytes)):
+        return True
+    if isinstance(value, (list, tuple)):
+        items = list(value)
+    elif isinstance(value, dict):
+        items = list(value.values())
+    else:
+        return False
+    heavy = [spillable(v) for v in items]
+    return any(heavy) and all(h or isinstance(v, (str, int, float, type(None))) for h, v in zip(heavy, items))
+
+class ResultCache:
+    """
+    LRU cache แบบจำกัดทั้งจำนวน entry และขนาดหน่วยความจำรวม
+    entry ที่ใช้ล่าสุดจะถูกย้ายไปท้ายสุด ตัวที่เก่าที่สุดถูกลบก่อน
+    - thread-safe: ใช้ร่วมกันได้ทุก session / background job
+    - get_or_compute: key เดียวกันคำนวณครั้งเดียว ผู้ขอพร้อมกันรอผลชุดเดียวกัน
+    - spill_max_bytes > 0: entry ที่ถูกไล่ออก (เฉพาะที่ spillable) ถูก pickle ลงดิสก์
+      แล้วโหลดกลับเมื่อถูกขออีก แทนการคำนวณใหม่ (ไฟล์ spill ใช้ได้เฉพาะ process นี้)
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES,
+                 spill_max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_dir = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.RLock()
+        self._pending = {}          # key -> Lock ของการคำนวณที่กำลังทำอยู่
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        value = self._load_spilled(key)
+        if value is _MISSING:
+            with self._lock:
+                self.misses += 1
+            return default
+        with self._lock:
+            self.hits += 1
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = estimate_nbytes(value)
+        evicted = []
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            if size > self.max_bytes:
+                # ใหญ่เกิน budget ทั้งก้อน → ไม่เก็บใน RAM (ยัง spill ลงดิสก์ได้)
+                evicted.append((key, value, size))
+            else:
+                self._data[key] = (value, size)
+                self.nbytes += size
+                while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+                    old_key, (old_value, old_size) = self._data.popitem(last=False)
+                    self.nbytes -= old_size
+                    evicted.append((old_key, old_value, old_size))
+        if evicted and self.spill_max_bytes > 0:
+            self._spill(evicted)
+
+    def get_or_compute(self, key, fn):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            pending = self._pending.setdefault(key, threading.Lock())
+        try:
+            with pending:
+                value = self.get(key, _MISSING)
+                if value is _MISSING:
+                    value = fn()
+                    self.put(key, value)
+        finally:
+            with self._lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+        return value
+
+    def discard(self, key):
+        """ลบ entry ของ key (ทั้งใน RAM และไฟล์ spill) เช่นเมื่อไฟล์ที่ entry ชี้ไปถูกลบแล้ว"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+            spill_dir = self.spill_dir
+        if spill_dir:
+            try:
+                os.remove(self._spill_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+            if self.spill_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+                self.spill_dir = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._data), "nbytes": self.nbytes, "max_bytes": self.max_bytes,
+                    "spill_bytes": self._spill_usage()[0], "hits": self.hits, "misses": self.misses}
+
+    # ---------- spill ลงดิสก์ ----------
+
+    def _spill_path(self, key) -> str:
+        name = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.spill_dir, name + ".pkl")
+
+    def _spill_usage(self) -> tuple:
+        """(ขนาดรวม, [(mtime, size, path), ...]) ของไฟล์ spill"""
+        if not self.spill_dir:
+            return 0, []
+        files = []
+        try:
+            for entry in os.scandir(self.spill_dir):
+                if entry.name.endswith(".pkl"):
+                    st_ = entry.stat()
+                    files.append((st_.st_mtime, st_.st_size, entry.path))
+        except OSError:
+            pass
+        return sum(f[1] for f in files), files
+
+    @profiled("cache_spill")
+    def _spill(self, evicted):
+        """เขียน entry ที่ถูกไล่ออกลงดิสก์ (นอก lock) แล้วลบไฟล์เก่าสุดจนไม่เกิน spill_max_bytes"""
+        with self._lock:
+            if self.spill_dir is None:
+                os.makedirs(EXPORT_DIR, exist_ok=True)
+                self.spill_dir = tempfile.mkdtemp(prefix="cache_spill_", dir=EXPORT_DIR)
+            spill_dir = self.spill_dir
+        os.makedirs(spill_dir, exist_ok=True)  # อาจถูกล้างตามอายุพร้อมไฟล์ export
+        for key, value, size in evicted:
+            if size > self.spill_max_bytes or not spillable(value):
+                continue
+            path = self._spill_path(key)
+            if os.path.exists(path):
+                os.utime(path)
+                continue
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=spill_dir)
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        total, files = self._spill_usage()
+        for _, size, path in sorted(files):
+            if total <= self.spill_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def _load_spilled(self, key):
+        if not self.spill_dir:
+            return _MISSING
+        path = self._spill_path(key)
+        if not os.path.exists(path):
+            return _MISSING
+        try:
+            with profile_stage("cache_unspill"), open(path, "rb") as fh:
+                value = pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return _MISSING
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+def cache_key(step: str, digest: str, **params) -> tuple:
+    return (step, digest, tuple(sorted(params.items())))
+
+# =========================
+# CSV Ingestion
+# (ทุกหน้าอ่านผ่านชุดนี้: เลือก encoding ครั้งเดียวจาก BOM/หัวไฟล์, อ่านเฉพาะคอลัมน์ที่ใช้, dtype ข้อความกำหนดเอง)
+# =========================
+
+# ลองตามลำดับ: UTF-8 (มี/ไม่มี BOM) → Thai Windows (TIS-620) → latin1 (decode ได้ทุก byte = fallback)
+CSV_ENCODINGS = ("utf-8-sig", "cp874", "latin1")
+ENCODING_PROBE_BYTES = 1 << 20   # ใช้หัวไฟล์กี่ byte ตัดสิน encoding
+
+# คอลัมน์ข้อความ/JSON: อ่านเป็น str เลย ไม่ต้องเดาชนิด (HN, VN, patientAge, room ยังให้ pandas เดา
+# เพื่อให้ตัวเลขใน Excel เป็นตัวเลขเหมือนเดิม)
+STRING_COLUMNS = (
+    "time", "visit_type", "patientTitle", "patientName", "nationality", "branch",
+    "insurance_name", "assist_insurance", "concessionType", "ipd_status",
+    "diagnosis", "medLog", "treatments", "payment_status", "billLog", "rejects", "retry", "note",
+    "referTo", "typeOfBoat", "shift", "onDuty", "onCall",
+)
+
+def pick_encoding(data, encodings=CSV_ENCODINGS, probe_bytes: int = ENCODING_PROBE_BYTES):
+    """
+    เลือก encoding: มี UTF-8 BOM → utf-8-sig ทันที ไม่งั้นหา encoding แรกที่ decode หัวไฟล์
+    probe_bytes แรกได้ (None = ทั้งไฟล์) ตัวสุดท้ายใช้เป็น fallback
+    decode ทีละช่วงด้วย incremental decoder จึงไม่สร้าง string ขนาดเท่าไฟล์
+    """
+    view = memoryview(data)
+    if view[:3] == codecs.BOM_UTF8:
+        return "utf-8-sig"
+    whole = probe_bytes is None or probe_bytes >= len(view)
+    if not whole:
+        view = view[:probe_bytes]
+    step = 1 << 20
+    for enc in encodings[:-1]:
+        decoder = codecs.getincrementaldecoder(enc or "utf-8")()
+        try:
+            for i in range(0, len(view), step):
+                decoder.decode(view[i:i + step])
+            # หัวไฟล์อาจตัดกลางตัวอักษรหลาย byte → ไม่ final ถ้ายังไม่ถึงท้ายไฟล์
+            decoder.decode(b"", final=whole)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return encodings[-1]
+
+class MemoryReader(io.RawIOBase):
+    """
+    file-like แบบอ่านอย่างเดียวบน buffer (bytes / mmap) โดยไม่ copy ทั้งก้อน
+    แต่ละตัวมีตำแหน่งอ่านของตัวเอง → หลาย thread อ่าน mmap เดียวกันพร้อมกันได้
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        n = max(min(len(buf), len(self._view) - self._pos), 0)
+        buf[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(base + offset, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+def csv_stream(data):
+    """stream สำหรับ pd.read_csv จาก bytes หรือ mmap (ไฟล์บนเซิร์ฟเวอร์)"""
+    return io.BufferedReader(MemoryReader(data), buffer_size=1 << 20)
+
+def count_lines(data, step: int = 16 << 20) -> int:
+    """จำนวน \n ใน bytes / mmap (mmap ไม่มี .count → นับทีละช่วง)"""
+    if isinstance(data, (bytes, bytearray)):
+        return data.count(b"\n")
+    view = memoryview(data).cast("B")
+    return sum(bytes(view[i:i + step]).count(b"\n") for i in range(0, len(view), step))
+
+def csv_options(columns=None) -> dict:
+    """
+    argument ของ pd.read_csv ที่ใช้ร่วมกัน
+    columns: อ่านเฉพาะคอลัมน์เหล่านี้ (usecols แบบ callable → คอลัมน์ที่ไฟล์ไม่มีไม่ error)
+    """
+    opts = {"dtype": {c: "str" for c in STRING_COLUMNS}}
+    if columns is not None:
+        wanted = frozenset(columns)
+        opts["usecols"] = wanted.__contains__
+    return opts
+
+@profiled("read_csv")
+def read_uploaded_csv(data: bytes, encodings=CSV_ENCODINGS, columns=None) -> pd.DataFrame:
+    """อ่าน CSV จาก bytes ในรอบเดียว (encoding จาก pick_encoding, คอลัมน์ตาม columns)"""
+    enc = pick_encoding(data, encodings)
+    try:
+        return pd.read_csv(csv_stream(data), encoding=enc, **csv_options(columns))
+    except UnicodeDecodeError:
+        # หัวไฟล์ decode ได้แต่ช่วงหลังไม่ได้ (พบน้อย) → ตรวจทั้งไฟล์แล้วอ่านใหม่
+        fallback = pick_encoding(data, encodings, probe_bytes=None)
+        if fallback == enc:
+            raise
+        return pd.read_csv(csv_stream(data), encoding=fallback, **csv_options(columns))
+
+# ---------- ไฟล์บนเซิร์ฟเวอร์ (อ่านจากดิสก์ตรง ไม่ผ่าน upload) ----------
+
+# โฟลเดอร์ที่อนุญาตให้หน้าเว็บอ่าน (คั่นด้วย os.pathsep) – ไม่ตั้ง = ใช้ได้แค่ upload
+DATA_DIRS = tuple(d for d in os.environ.get("WORLDMED_DATA_DIRS", "").split(os.pathsep) if d)
+RECENT_FILES = 20
+
+def list_data_files(dirs=DATA_DIRS, limit: int = RECENT_FILES) -> list:
+    """ไฟล์ .csv ในโฟลเดอร์ที่ตั้งไว้ (ชั้นบนสุด) ใหม่สุดก่อน: [(path, size, mtime), ...]"""
+    files = []
+    for d in dirs:
+        try:
+            for entry in os.scandir(d):
+                if entry.is_file() and entry.name.lower().endswith(".csv"):
+                    st_ = entry.stat()
+                    files.append((entry.path, st_.st_size, st_.st_mtime))
+        except OSError:
+            continue
+    files.sort(key=lambda f: f[2], reverse=True)
+    return files[:limit]
+
+def resolve_data_path(path: str, dirs=DATA_DIRS) -> str:
+    """path จริงของไฟล์ที่ผู้ใช้ระบุ – ต้องอยู่ใต้โฟลเดอร์ที่ตั้งไว้ (กัน ../ และ symlink ออกนอก)"""
+    path = os.path.expanduser(path)
+    if not os.path.isabs(path) and dirs:
+        path = os.path.join(dirs[0], path)   # path สั้น ๆ นับจากโฟลเดอร์แรก
+    real = os.path.realpath(path)
+    roots = [os.path.realpath(d) for d in dirs]
+    if not any(os.path.commonpath([real, root]) == root for root in roots):
+        raise ValueError(f"ไม่อนุญาตให้อ่านไฟล์นอกโฟลเดอร์ข้อมูล: {path}")
+    if not os.path.isfile(real):
+        raise ValueError(f"ไม่พบไฟล์: {path}")
+    return real
+
+def map_file(path: str):
+    """
+    เปิดไฟล์แบบ memory-mapped (อ่านอย่างเดียว) ใช้แทน bytes ได้ทุกฟังก์ชันอ่าน CSV
+    OS โหลดหน้าไฟล์ตามที่อ่านจริง ไม่มีสำเนาทั้งไฟล์ใน heap และ process อื่นใช้ page cache ร่วมกัน
+    """
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+def path_digest(path: str) -> str:
+    """key ของ cache สำหรับไฟล์บนเซิร์ฟเวอร์: path + ขนาด + เวลาแก้ไข (ไม่ต้อง hash ทั้งไฟล์ทุก rerun)"""
+    st_ = os.stat(path)
+    return file_digest(f"{os.path.realpath(path)}:{st_.st_size}:{st_.st_mtime_ns}".encode())
+
+# =========================
+# Treatments Explode Engine
+# (ใช้ร่วมกันทุกหน้า: parse treatments ครั้งเดียวทั้งคอลัมน์ แล้วแตกแบบ columnar)
+# =========================
+
+JSON_PROGRESS_ROWS = 50_000   # parse ครบกี่แถวรายงานความคืบหน้า (background job) 1 ครั้ง
+
+@profiled("json_parse")
+def parse_json_column(values, label: str = "JSON") -> list:
+    """
+    parse JSON ทั้งคอลัมน์ในรอบเดียว (ไม่ผ่าน iterrows)
+    แถวที่ว่าง / ไม่ใช่ string / parse ไม่ได้ → None
+    """
+    loads = json.loads
+    out = []
+    append = out.append
+    values = values if isinstance(values, list) else list(values)
+    n = len(values)
+    for start in range(0, n, JSON_PROGRESS_ROWS):
+        # ก้อนเดียว (เช่น 1 chunk) ไม่ทับข้อความของขั้นที่ครอบอยู่ แค่เป็นจุดตรวจการยกเลิก
+        job_progress(start / n, f"parse {label} {start:,}/{n:,} แถว" if n > JSON_PROGRESS_ROWS else None)
+        for v in values[start:start + JSON_PROGRESS_ROWS]:
+            if isinstance(v, str):
+                try:
+                    append(loads(v))
+                except ValueError:
+                    append(None)
+            elif isinstance(v, (list, dict)):
+                append(v)
+            else:
+                append(None)
+    return out
+
+@profiled("explode_treatments")
+def explode_treatments(df: pd.DataFrame, column: str = "treatments") -> pd.DataFrame:
+    """
+    แตก treatments JSON เป็น 1 row ต่อ 1 treatment
+    - _visit: ตำแหน่งแถว (0..n-1) ใน df ต้นทาง ใช้ดึงคอลัมน์ของ visit กลับมา
+    - treatment, area, unit: ค่าตามที่อยู่ใน JSON (ไม่มี key → "")
+    - practice_list, order_list, doctor_asst_list: list เสมอ (ผ่าน norm_list)
+    """
+    if column in df.columns:
+        parsed = parse_json_column(df[column].tolist(), column)
+    else:
+        parsed = [None] * len(df)
+
+    s = pd.Series(parsed, dtype=object)
+    s = s[s.map(lambda v: isinstance(v, list))].explode()
+    s = s[s.map(lambda t: isinstance(t, dict))]
+    items = s.tolist()
+
+    return pd.DataFrame({
+        "_visit": s.index.to_numpy(dtype="int64"),
+        "treatment": as_category([t.get("treatment", "") for t in items]),
+        "area": as_category([t.get("area", "") for t in items]),
+        "unit": as_category([t.get("unit", "") for t in items]),
+        "practice_list": [norm_list(t.get("practice")) for t in items],
+        "order_list": [norm_list(t.get("order")) for t in items],
+        "doctor_asst_list": [norm_list(t.get("doctor_asst")) for t in items],
+    })
+
+@profiled("explode_doctors")
+def explode_doctors(tdf: pd.DataFrame,
+                    primary: str = "practice_list",
+                    fallback: str = "order_list") -> pd.DataFrame:
+    """
+    แตกต่อเป็น 1 row ต่อ 1 หมอ (ใช้ practice ถ้าไม่มีใช้ order, ไม่มีทั้งคู่ → None)
+    - doctor: ชื่อหมอ
+    - doctor_count: จำนวนคนใน practice (ถ้า practice ว่าง ใช้จำนวนจาก order)
+    """
+    prim = tdf[primary].tolist()
+    fb = tdf[fallback].tolist()
+    doctors = [p if p else (f or [None]) for p, f in zip(prim, fb)]
+    counts = [len(p) if p else len(f) for p, f in zip(prim, fb)]
+    out = tdf.assign(doctor=doctors, doctor_count=counts).explode("doctor")
+    return out.reset_index(drop=True)
+
+def take_visit_columns(df: pd.DataFrame, visits, cols, default="") -> dict:
+    """
+    ดึงคอลัมน์ของ visit ตาม _visit (คอลัมน์ไหนไม่มีใน df ใช้ default)
+    คอลัมน์ข้อความได้เป็น categorical: แถวที่แตกจาก visit เดียวกันใช้ code ร่วมกันแทนการ copy string
+    """
+    out = {}
+    for c in cols:
+        if c not in df.columns:
+            out[c] = pd.Series([default] * len(visits), dtype=object)
+        elif pd.api.types.is_numeric_dtype(df[c].dtype) or pd.api.types.is_bool_dtype(df[c].dtype):
+            out[c] = df[c].iloc[visits].reset_index(drop=True)
+        else:
+            out[c] = pd.Series(take_category(df[c], visits))
+    return out
+
+# ---------- Categorical (dictionary-encoded) columns ----------
+
+def as_category(values) -> pd.Categorical:
+    """
+    dictionary-encode: เก็บ code ต่อแถว + ค่าไม่ซ้ำครั้งเดียว แทน string ซ้ำ ๆ ทุกแถว
+    ค่าเหมือนเดิมทุกแถว (None/NaN → NaN) และ categories เรียงตามค่า
+    → sort / partition ตาม code ได้ลำดับเดียวกับ sort ตาม string
+    """
+    if isinstance(values, pd.Series) and isinstance(values.dtype, pd.CategoricalDtype):
+        return values.array
+    if isinstance(values, pd.Categorical):
+        return values
+    if isinstance(values, (list, tuple)):
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = values
+        values = arr
+    try:
+        codes, uniques = pd.factorize(values, sort=True)
+    except TypeError:
+        # ค่าหลายชนิดปนกัน (เช่น 2 กับ "2") เรียงไม่ได้ → ใช้ลำดับที่เจอ
+        codes, uniques = pd.factorize(values)
+    return pd.Categorical.from_codes(codes, categories=uniques)
+
+def take_category(values, positions) -> pd.Categorical:
+    """as_category(values)[positions] โดย encode แค่ระดับ visit แล้วหยิบ code"""
+    cat = as_category(values)
+    return pd.Categorical.from_codes(cat.codes[positions], dtype=cat.dtype)
+
+def category_mask(values, pred) -> np.ndarray:
+    """pred(ค่า) ของทุกแถว โดยเรียก pred แค่ครั้งละค่าไม่ซ้ำ (+ 1 ครั้งสำหรับ NaN)"""
+    cat = as_category(values)
+    flags = [bool(pred(v)) for v in cat.categories] + [bool(pred(None))]
+    # code -1 (NaN) ชี้ไปที่ตัวสุดท้าย = pred(None)
+    return np.array(flags, dtype=bool)[cat.codes]
+
+def map_category(values, fn) -> pd.Categorical:
+    """fn(ค่า) ของทุกแถว เรียก fn ครั้งละค่าไม่ซ้ำ แล้ว encode ผลใหม่ (fn(None) ใช้กับแถว NaN)"""
+    cat = as_category(values)
+    mapped = [fn(v) for v in cat.categories] + [fn(None)]
+    return take_category(mapped, cat.codes)
+
+def concat_categorical(frames: list, **kwargs) -> pd.DataFrame:
+    """pd.concat ที่คอลัมน์ categorical ยังเป็น categorical (รวม categories ของทุกก้อน)"""
+    out = pd.concat(frames, **kwargs)
+    for c in out.columns:
+        if isinstance(out[c].dtype, pd.CategoricalDtype):
+            continue
+        if any(c in f.columns and isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames):
+            out[c] = as_category(out[c])
+    return out
+
+# =========================
+# Normalized Tables + Persistent Cache
+# (ทุกคอลัมน์ JSON parse ครั้งเดียวต่อไฟล์เป็นตาราง relational ที่ทุกหน้าใช้ร่วมกัน:
+#  visits / treatments / treatment_doctors / diagnoses / payments / rejects / logs
+#  เก็บเป็นไฟล์ Arrow ตาม hash ไฟล์ เปิดรายงานซ้ำกับไฟล์เดิมจะโหลดกลับจากดิสก์แทนการ parse ใหม่)
+# =========================
+
+NORMALIZED_CACHE_DIR = os.environ.get(
+    "WORLDMED_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "worldmed")
+)
+NORMALIZED_CACHE_MAX_ENTRIES = 24   # เก็บไฟล์ล่าสุดกี่ไฟล์ (0 = ปิด cache บนดิสก์)
+NORMALIZED_FORMAT = 4               # เพิ่มเมื่อ dtype/schema ของตารางเปลี่ยน → cache เก่าถูกข้าม
+NORMALIZED_TABLES = ("visits", "treatments", "treatment_doctors", "diagnoses", "payments", "rejects", "logs")
+# ตารางลูกที่ชี้กลับไปที่ visit ด้วย _visit (treatment_doctors ชี้ไปที่ treatments ด้วย _tid)
+VISIT_CHILD_TABLES = ("treatments", "diagnoses", "payments", "rejects", "logs")
+LOG_COLUMNS = ("medLog", "billLog", "retry")
+
+# role ใน treatment_doctors -> คอลัมน์ list ใน treatments
+DOCTOR_ROLES = {
+    "practice": "practice_list",
+    "order": "order_list",
+    "doctor_asst": "doctor_asst_list",
+}
+
+def treatment_doctors_table(tdf: pd.DataFrame) -> pd.DataFrame:
+    """แตก practice/order/doctor_asst ของทุก treatment เป็นตารางยาว: _tid, role, pos, doctor"""
+    parts = []
+    for role, col in DOCTOR_ROLES.items():
+        lists = tdf[col].tolist()
+        lens = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+        doctors = list(itertools.chain.from_iterable(lists))
+        parts.append(pd.DataFrame({
+            "_tid": np.repeat(np.arange(len(lists), dtype=np.int64), lens),
+            "role": role,
+            "pos": np.arange(len(doctors), dtype=np.int64) - np.repeat(np.cumsum(lens) - lens, lens),
+            "doctor": as_category(doctors),
+        }))
+    out = concat_categorical(parts, ignore_index=True)
+    out["role"] = as_category(out["role"])
+    return out
+
+def attach_doctor_lists(treatments: pd.DataFrame, td: pd.DataFrame) -> pd.DataFrame:
+    """กลับด้านของ treatment_doctors_table: ใส่คอลัมน์ list กลับเข้า treatments"""
+    out = treatments.copy()
+    n = len(out)
+    for role, col in DOCTOR_ROLES.items():
+        sub = td[td["role"] == role].sort_values(["_tid", "pos"], kind="stable")
+        counts = np.bincount(sub["_tid"].to_numpy(dtype=np.int64), minlength=n)
+        # null ใน JSON เป็น NaN ใน categorical → คืนเป็น None เหมือนผลของ explode_treatments
+        it = iter(sub["doctor"].astype(object).where(sub["doctor"].notna(), None).tolist())
+        out[col] = [list(itertools.islice(it, c)) for c in counts]
+    return out
+
+@profiled("explode_diagnoses")
+def explode_diagnoses(df: pd.DataFrame, column: str = "diagnosis") -> pd.DataFrame:
+    """แตก diagnosis JSON เป็น 1 row ต่อ 1 diagnosis: _visit, _item, code, title, categoryLabel (string ที่ strip แล้ว)"""
+    parsed = parse_json_column(df[column].tolist(), column) if column in df.columns else [None] * len(df)
+    s = pd.Series(parsed, dtype=object)
+    s = s[s.map(lambda v: isinstance(v, list))].explode()
+    s = s[s.map(lambda d: isinstance(d, dict))]
+    items = s.tolist()
+    visits = s.index.to_numpy(dtype="int64")
+    out = pd.DataFrame({"_visit": visits})
+    out["_item"] = out.groupby("_visit").cumcount()
+    for k in ("code", "title", "categoryLabel"):
+        out[k] = [str(d.get(k, "") or "").strip() for d in items]
+    return out
+
+def json_list_items(df: pd.DataFrame, column: str, keep=None) -> tuple:
+    """
+    แตก JSON list ของคอลัมน์เป็นรายการ: (_visit, ลำดับใน list เดิม, item)
+    แถวที่ว่าง / parse ไม่ได้ / ไม่ใช่ list ไม่มีรายการ, keep(item) = False → ข้าม item นั้น
+    """
+    parsed = parse_json_column(df[column].tolist(), column) if column in df.columns else [None] * len(df)
+    visits, positions, items = [], [], []
+    for v, value in enumerate(parsed):
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                if keep is None or keep(item):
+                    visits.append(v)
+                    positions.append(i)
+                    items.append(item)
+    return np.array(visits, dtype=np.int64), np.array(positions, dtype=np.int64), items
+
+def is_dict(v) -> bool:
+    return isinstance(v, dict)
+
+@profiled("explode_payments")
+def explode_payments(df: pd.DataFrame, column: str = "payment_status") -> pd.DataFrame:
+    """
+    payment_status JSON → 1 row ต่อ 1 รายการ (dict): _visit, _item (ลำดับใน list เดิม)
+    แต่ละ field เก็บค่าแรกถ้าเป็น list (total_invoiced เก็บค่าตามจริง, ไม่มี → None)
+    """
+    visits, positions, items = json_list_items(df, column, keep=is_dict)
+    return pd.DataFrame({
+        "_visit": visits,
+        "_item": positions,
+        "status": as_category([str(first_of(d.get("status")) or "") for d in items]),
+        "invoice_id": [str(first_of(d.get("invoice_id")) or "") for d in items],
+        "total_invoiced": pd.Series([first_of(d.get("total_invoiced")) for d in items], dtype=object),
+        "case_type": as_category([str(first_of(d.get("case_type")) or "") for d in items]),
+        "reasonNotInsurance": as_category([str(first_of(d.get("reasonNotInsurance")) or "") for d in items]),
+    })
+
+@profiled("explode_rejects")
+def explode_rejects(df: pd.DataFrame, column: str = "rejects") -> pd.DataFrame:
+    """rejects JSON → 1 row ต่อ 1 รายการ (dict): _visit, _item (ลำดับใน list เดิม), reject, reason, problem"""
+    visits, positions, items = json_list_items(df, column, keep=is_dict)
+    return pd.DataFrame({
+        "_visit": visits,
+        "_item": positions,
+        **{k: as_category([item_text(d, k) for d in items]) for k in ("reject", "reason", "problem")},
+    })
+
+@profiled("explode_logs")
+def explode_logs(df: pd.DataFrame, columns=LOG_COLUMNS) -> pd.DataFrame:
+    """medLog / billLog / retry (JSON list) → 1 row ต่อ 1 ค่าที่ไม่ว่าง: _visit, log (ชื่อคอลัมน์), _item, value"""
+    parts = []
+    for column in columns:
+        visits, positions, items = json_list_items(
+            df, column, keep=lambda x: x is not None and str(x).strip() != "")
+        parts.append(pd.DataFrame({
+            "_visit": visits,
+            "log": column,
+            "_item": positions,
+            "value": [str(x) for x in items],
+        }))
+    out = pd.concat(parts, ignore_index=True)
+    out["log"] = as_category(out["log"])
+    return out
+
+@profiled("normalize")
+def normalize_visits(df: pd.DataFrame) -> dict:
+    """parse JSON ทุกคอลัมน์ครั้งเดียว แล้วแยกเป็นตารางแบบ relational (ทุกหน้าเป็น projection ของชุดนี้)"""
+    with job_span(0.0, 0.6):
+        tdf = explode_treatments(df)
+    treatments = tdf.drop(columns=list(DOCTOR_ROLES.values()))
+    treatments.insert(1, "_item", tdf.groupby("_visit").cumcount())
+    with job_span(0.6, 0.75):
+        diagnoses = explode_diagnoses(df)
+    with job_span(0.75, 1.0):
+        payments = explode_payments(df)
+        rejects = explode_rejects(df)
+        logs = explode_logs(df)
+    return {
+        "visits": df,
+        "treatments": treatments,
+        "treatment_doctors": treatment_doctors_table(tdf),
+        "diagnoses": diagnoses,
+        "payments": payments,
+        "rejects": rejects,
+        "logs": logs,
+    }
+
+def treatments_with_doctors(tables: dict) -> pd.DataFrame:
+    """treatments + คอลัมน์ list ของหมอ (รูปแบบเดียวกับ explode_treatments)"""
+    return attach_doctor_lists(tables["treatments"], tables["treatment_doctors"])
+
+def _arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    คอลัมน์ object ที่มีค่าหลายชนิดปนกัน (เช่น 1 กับ "1") Arrow เก็บไม่ได้ → แปลงเป็น string
+    (คอลัมน์ category ยังเป็น category – แปลงเฉพาะค่าของ category)
+    """
+    fixed = {}
+    for c in df.columns:
+        col = df[c]
+        categorical = isinstance(col.dtype, pd.CategoricalDtype)
+        if categorical:
+            values = col.cat.categories.tolist()
+            col = col.astype(object)
+        elif col.dtype == object:
+            values = col.dropna().tolist()
+        else:
+            continue
+        types = {type(v) for v in values}
+        if len(types) > 1:
+            col = col.map(lambda v: v if v is None or isinstance(v, str) or v != v else str(v))
+            fixed[c] = col.astype("category") if categorical else col
+    return df.assign(**fixed) if fixed else df
+
+def _normalized_cache_path(digest: str, encodings) -> str:
+    tag = "-".join(e or "default" for e in encodings)
+    return os.path.join(NORMALIZED_CACHE_DIR, f"{digest}-{tag}-v{NORMALIZED_FORMAT}")
+
+def _prune_normalized_cache():
+    try:
+        entries = sorted((e for e in os.scandir(NORMALIZED_CACHE_DIR) if e.name != STORES_DIRNAME),
+                         key=lambda e: e.stat().st_mtime, reverse=True)
+    except OSError:
+        return
+    for entry in entries[NORMALIZED_CACHE_MAX_ENTRIES:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+@profiled("cache_save")
+def save_normalized(path: str, tables: dict, names=NORMALIZED_TABLES):
+    """
+    เขียนทุกตารางเป็น Arrow IPC (ไม่บีบอัด → อ่านกลับได้เร็ว) แบบ atomic
+    ถ้ามีของเดิมอยู่ (เช่น incremental store) จะสลับเป็นชุดใหม่แล้วค่อยลบชุดเก่า
+    """
+    import pyarrow.feather as feather
+
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".tmp_", dir=parent)
+    backup = path + ".old"
+    try:
+        for name in names:
+            frame = _arrow_safe(tables[name].reset_index(drop=True))
+            feather.write_feather(frame, os.path.join(tmp, f"{name}.arrow"), compression="uncompressed")
+        if os.path.isdir(path):
+            shutil.rmtree(backup, ignore_errors=True)
+            os.replace(path, backup)
+        os.replace(tmp, path)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    shutil.rmtree(backup, ignore_errors=True)
+
+@profiled("cache_load")
+def load_normalized(path: str, names=NORMALIZED_TABLES) -> dict:
+    """
+    โหลดตารางที่ save_normalized เขียนไว้กลับเป็น DataFrame
+    อ่านไฟล์ผ่าน memory map แต่ to_pandas copy ทุกคอลัมน์เข้า RAM – DataFrame ไม่ได้อ้างอิงไฟล์
+    (เร็วเพราะไม่ต้อง parse CSV/JSON ซ้ำ ไม่ใช่เพราะประหยัดหน่วยความจำ)
+    """
+    import pyarrow.feather as feather
+
+    tables = {}
+    for name in names:
+        table = feather.read_table(os.path.join(path, f"{name}.arrow"), memory_map=True)
+        tables[name] = table.to_pandas()
+    return tables
+
+def _read_normalized(data: bytes, encodings=CSV_ENCODINGS) -> dict:
+    job_progress(0.0, "อ่าน CSV")
+    df = read_uploaded_csv(data, encodings=encodings, columns=INGEST_COLUMNS)
+    with job_span(0.2, 1.0):
+        return normalize_visits(df)
+
+def normalized_tables(data: bytes, digest: str, encodings=CSV_ENCODINGS) -> dict:
+    """
+    ตาราง normalized ของไฟล์: ถ้าเคย parse ไฟล์นี้แล้ว (hash เดิม) โหลดจากดิสก์
+    ไม่งั้น read_csv (เฉพาะ INGEST_COLUMNS) + parse แล้วเขียนเก็บไว้ (เขียนไม่สำเร็จก็ยังคืนผลปกติ)
+    ทุกหน้าใช้ encoding ชุดเดียวกัน → ไฟล์เดียวกัน parse ครั้งเดียวใช้ได้ทุกหน้า
+    """
+    if NORMALIZED_CACHE_MAX_ENTRIES <= 0:
+        return _read_normalized(data, encodings)
+
+    path = _normalized_cache_path(digest, encodings)
+    if os.path.isdir(path):
+        try:
+            tables = load_normalized(path)
+            os.utime(path)
+            return tables
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+
+    tables = _read_normalized(data, encodings)
+    try:
+        save_normalized(path, tables)
+        _prune_normalized_cache()
+    except Exception:
+        pass
+    return tables
+
+# =========================
+# Incremental Store
+# (ไฟล์ export จากระบบเป็นแบบสะสมทั้งเดือน: เก็บ visit ที่ parse แล้วไว้ตาม HN/VN/time
+#  ไฟล์วันถัดไป parse เฉพาะ visit ใหม่/ที่เนื้อหาเปลี่ยน แล้วสร้างรายงานจาก store ที่รวมแล้ว)
+# =========================
+
+STORES_DIRNAME = "stores"
+VISIT_KEY_COLS = ("HN", "VN", "time")
+STORE_TABLES = NORMALIZED_TABLES + ("visit_keys",)
+
+_store_locks = {}
+_store_locks_lock = threading.Lock()
+
+def store_lock(path: str) -> threading.RLock:
+    """lock ของ store ต่อ path – เขียน store ได้ทีละงาน (os.replace ทับโฟลเดอร์เดิมพร้อมกันไม่ได้)"""
+    with _store_locks_lock:
+        return _store_locks.setdefault(os.path.abspath(path), threading.RLock())
+
+def incremental_store_path(name: str) -> str:
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name.strip())
+    return os.path.join(NORMALIZED_CACHE_DIR, STORES_DIRNAME, safe or "default")
+
+def store_stamp(path: str) -> int:
+    """เปลี่ยนทุกครั้งที่ store ถูกเขียนใหม่ (0 = ยังไม่มี store)"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+def load_store(path: str):
+    """
+    โหลด store (None ถ้ายังไม่มี) – ถ้าสลับไฟล์ค้างกลางทางจะใช้ชุดเก่า
+    store รุ่นเก่าที่ยังไม่มีบางตาราง: parse ตารางลูกและ key ใหม่จาก visits (ไม่เสีย visit ที่สะสมไว้)
+    """
+    for candidate in (path, path + ".old"):
+        if os.path.isdir(candidate):
+            if all(os.path.exists(os.path.join(candidate, f"{name}.arrow")) for name in STORE_TABLES):
+                return load_normalized(candidate, STORE_TABLES)
+            stored = load_normalized(candidate, ("visits", "visit_keys"))
+            keys = stored["visit_keys"].assign(_key=visit_keys(stored["visits"]).to_numpy())
+            return {**normalize_visits(stored["visits"]), "visit_keys": keys}
+    return None
+
+def clear_store(path: str):
+    with store_lock(path):
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.rmtree(path + ".old", ignore_errors=True)
+
+def visit_keys(df: pd.DataFrame) -> pd.Series:
+    """key ของแต่ละ visit = HN|VN|time (+ ลำดับที่ ถ้าไฟล์มีหลายแถว key เดียวกัน)"""
+    cols = [c for c in VISIT_KEY_COLS if c in df.columns]
+    if not cols:
+        raise ValueError(f"โหมด incremental ต้องมีคอลัมน์อย่างน้อยหนึ่งตัวจาก {list(VISIT_KEY_COLS)}")
+    # astype(str) ของ pandas คง NaN ไว้ → ต้องเติมค่าว่าง ไม่งั้น visit ที่ไม่มี time ได้ key เป็น NaN ซ้ำกัน
+    key = df[cols[0]].astype(str).fillna("")
+    for c in cols[1:]:
+        key = key + "|" + df[c].astype(str).fillna("")
+    return key + "#" + key.groupby(key).cumcount().astype(str)
+
+def _remap_rows(ids: pd.Series, mapping: np.ndarray):
+    """แถวลูกที่ parent ยังอยู่ เรียงตาม id ใหม่ของ parent (stable): คืน (ตำแหน่งแถว, id ใหม่)"""
+    new_ids = mapping[ids.to_numpy(dtype=np.int64)]
+    rows = np.flatnonzero(new_ids >= 0)
+    rows = rows[np.argsort(new_ids[rows], kind="stable")]
+    return rows, new_ids[rows]
+
+def take_visits(tables: dict, idx) -> dict:
+    """เลือก visit ตามตำแหน่ง idx (ตามลำดับที่ให้) พร้อมแถวลูก แล้วเรียง _visit/_tid ใหม่ตั้งแต่ 0"""
+    idx = np.asarray(idx, dtype=np.int64)
+    visit_map = np.full(len(tables["visits"]), -1, dtype=np.int64)
+    visit_map[idx] = np.arange(len(idx))
+
+    t = tables["treatments"]
+    rows, new_visit = _remap_rows(t["_visit"], visit_map)
+    tid_map = np.full(len(t), -1, dtype=np.int64)
+    tid_map[rows] = np.arange(len(rows))
+
+    td = tables["treatment_doctors"]
+    td_rows, new_tid = _remap_rows(td["_tid"], tid_map)
+
+    out = {
+        "visits": tables["visits"].iloc[idx].reset_index(drop=True),
+        "treatments": t.iloc[rows].reset_index(drop=True).assign(_visit=new_visit),
+        "treatment_doctors": td.iloc[td_rows].reset_index(drop=True).assign(_tid=new_tid),
+    }
+    for name in VISIT_CHILD_TABLES[1:]:
+        child = tables[name]
+        child_rows, child_visit = _remap_rows(child["_visit"], visit_map)
+        out[name] = child.iloc[child_rows].reset_index(drop=True).assign(_visit=child_visit)
+    if "visit_keys" in tables:
+        out["visit_keys"] = tables["visit_keys"].iloc[idx].reset_index(drop=True)
+    return out
+
+def concat_tables(a: dict, b: dict) -> dict:
+    """ต่อ normalized tables สองชุด (id ของชุดหลังเลื่อนต่อจากชุดแรก)"""
+    nv, nt = len(a["visits"]), len(a["treatments"])
+    shifted = {
+        "visits": b["visits"],
+        "treatment_doctors": b["treatment_doctors"].assign(_tid=b["treatment_doctors"]["_tid"] + nt),
+        "visit_keys": b["visit_keys"],
+        **{name: b[name].assign(_visit=b[name]["_visit"] + nv) for name in VISIT_CHILD_TABLES},
+    }
+    return {name: concat_categorical([a[name], shifted[name]], ignore_index=True) for name in STORE_TABLES}
+
+@profiled("incremental_merge")
+def update_store(path: str, data: bytes, encodings=CSV_ENCODINGS) -> tuple:
+    """
+    รวมไฟล์ CSV เข้า store: parse เฉพาะ visit ที่ key ไม่เคยเห็นหรือเนื้อหาแถวเปลี่ยน
+    ลำดับ visit = ของใน store ที่ไม่มีในไฟล์นี้ (ตามลำดับเดิม) ตามด้วยลำดับแถวในไฟล์
+    → ไฟล์สะสมให้ผลเหมือนประมวลผลทั้งไฟล์ใหม่
+    คืน (tables ของ store หลังรวม, จำนวน visit ที่ parse ใหม่)
+    """
+    job_progress(0.0, "อ่าน CSV")
+    df = read_uploaded_csv(data, encodings=encodings, columns=INGEST_COLUMNS)
+    keys = visit_keys(df)
+    hashes = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+    with store_lock(path):
+        return _merge_into_store(path, df, keys, hashes)
+
+def _merge_into_store(path: str, df: pd.DataFrame, keys: pd.Series, hashes: np.ndarray) -> tuple:
+    stored = load_store(path)
+    if stored is None:
+        n_old = 0
+        pos = np.full(len(df), -1, dtype=np.int64)
+        same = np.zeros(len(df), dtype=bool)
+    else:
+        n_old = len(stored["visits"])
+        pos = pd.Index(stored["visit_keys"]["_key"]).get_indexer(keys)
+        old_hashes = stored["visit_keys"]["_hash"].to_numpy(dtype=np.uint64)
+        same = (pos >= 0) & (old_hashes[np.maximum(pos, 0)] == hashes) if n_old else pos >= 0
+
+    fresh = np.flatnonzero(~same)
+    if stored is not None and len(fresh) == 0:
+        return stored, 0
+
+    with job_span(0.2, 0.9, f"parse visit ใหม่ {len(fresh):,} visit"):
+        new_tables = normalize_visits(df.iloc[fresh].reset_index(drop=True))
+    new_tables["visit_keys"] = pd.DataFrame({"_key": keys.iloc[fresh].to_numpy(), "_hash": hashes[fresh]})
+    merged = concat_tables(stored, new_tables) if stored is not None else new_tables
+
+    current = np.where(same, pos, -1)
+    current[fresh] = n_old + np.arange(len(fresh))
+    in_file = np.zeros(n_old, dtype=bool)
+    in_file[pos[pos >= 0]] = True
+    tables = take_visits(merged, np.concatenate([np.flatnonzero(~in_file), current]))
+
+    save_normalized(path, tables, STORE_TABLES)
+    return tables, len(fresh)
+
+# =========================
+# Excel Export
+# (แบ่งชีตตามหมอด้วยการ sort ครั้งเดียว ใช้ร่วมกันทุกหน้า)
+# =========================
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXCEL_MAX_ROWS = 1_048_576       # แถวต่อชีตสูงสุดของ Excel (รวม header) เกินแล้วต่อชีตใหม่ "<ชื่อ> (2)"
+SHEET_NAME_MAX = 31
+
+def unique_sheet_name(name: str, used: set) -> str:
+    """
+    ชื่อชีตที่ผ่าน safe_sheet_name และไม่ซ้ำกับ used (Excel ไม่สนตัวพิมพ์เล็ก/ใหญ่): name, name (2), ...
+    ตัดท้ายชื่อให้พอใส่ " (n)" โดยยาวไม่เกิน 31 ตัว → หมอที่ชื่อยาวแล้วถูกตัดเหลือเหมือนกันได้คนละชีต
+    และชีตที่ต่อเมื่อเกิน EXCEL_MAX_ROWS ก็ใช้ชื่อชุดเดียวกันนี้
+    """
+    base = safe_sheet_name(name)
+    candidate, n = base, 1
+    while candidate.lower() in used:
+        n += 1
+        suffix = f" ({n})"
+        candidate = base[:SHEET_NAME_MAX - len(suffix)] + suffix
+    used.add(candidate.lower())
+    return candidate
+
+def partition_by(df: pd.DataFrame, key: str) -> list:
+    """
+    แบ่ง df ตามค่าในคอลัมน์ key → [(value, sub_df), ...] เรียงตามชื่อ
+    sort ครั้งเดียวแล้ว slice เป็นช่วงต่อเนื่อง แทนการ filter df[df[key] == v] ทีละค่า
+    ลำดับแถวภายในแต่ละกลุ่มเหมือนต้นฉบับ, ค่า NaN/None ไม่ถูกนับเป็นกลุ่ม
+    """
+    sub = df[df[key].notna()]
+    if sub.empty:
+        return []
+    sub = sub.sort_values(key, kind="stable")
+    col = sub[key]
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        # เทียบ code (int) แทน string; categories เรียงตามค่าอยู่แล้ว
+        codes = col.cat.codes.to_numpy()
+        values = col.cat.categories.to_numpy(dtype=object)[codes]
+    else:
+        codes = values = col.to_numpy()
+    bounds = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(values)]))
+    return [(values[a], sub.iloc[a:b]) for a, b in zip(starts, ends)]
+
+def doctor_sheets(df: pd.DataFrame, key: str, all_sheet: str = "All"):
+    """ชีตรวม (All) ตามด้วย 1 ชีตต่อหมอ ตามค่าในคอลัมน์ key"""
+    yield all_sheet, df
+    for value, part in partition_by(df, key):
+        yield safe_sheet_name(value), part
+
+@profiled("excel_write")
+def sheets_to_excel(sheets) -> bytes:
+    """
+    เขียน [(sheet_name, df), ...] เป็นไฟล์ xlsx ในหน่วยความจำ
+    ชื่อชีตไม่ซ้ำกัน (unique_sheet_name), df ที่เกิน EXCEL_MAX_ROWS แบ่งเป็น "<ชื่อ> (2)", "<ชื่อ> (3)", ...
+    """
+    output = BytesIO()
+    sheets = list(sheets)
+    used = set()
+    step = EXCEL_MAX_ROWS - 1
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        for i, (name, frame) in enumerate(sheets):
+            job_progress(i / len(sheets), f"เขียน Excel ชีต {name} ({i + 1}/{len(sheets)})")
+            for start in range(0, max(len(frame), 1), step):
+                frame.iloc[start:start + step].to_excel(
+                    writer, sheet_name=unique_sheet_name(name, used), index=False)
+        job_progress(1.0, "บีบอัดไฟล์ Excel")
+    return output.getvalue()
+
+# ---------- Streaming (constant memory) ----------
+
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "worldmed_exports")
+EXPORT_MAX_AGE_SEC = 12 * 3600   # ไฟล์ export เก่ากว่านี้ถูกลบทิ้ง
+STREAM_BATCH_ROWS = 50_000       # แปลงค่าทีละกี่แถวก่อนส่งให้ xlsxwriter
+
+def export_path(prefix: str, suffix: str = ".xlsx") -> str:
+    """สร้าง path ไฟล์ชั่วคราวสำหรับ export (และล้างไฟล์เก่าที่ค้างอยู่)"""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    now = time.time()
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if now - entry.stat().st_mtime > EXPORT_MAX_AGE_SEC:
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+        except OSError:
+            pass
+    fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix=suffix, dir=EXPORT_DIR)
+    os.close(fd)
+    return path
+
+def frame_rows(frame: pd.DataFrame):
+    """แถวของ df เป็น tuple ของค่า Python ธรรมดา (NaN → None = ช่องว่าง) ทีละ batch"""
+    for start in range(0, len(frame), STREAM_BATCH_ROWS):
+        part = frame.iloc[start:start + STREAM_BATCH_ROWS]
+        cols = [part[c].astype(object).where(part[c].notna(), None).tolist() for c in part.columns]
+        yield from zip(*cols)
+
+@profiled("excel_write_streaming")
+def write_xlsx_streaming(path: str, sheets) -> str:
+    """
+    เขียน xlsx ด้วย xlsxwriter โหมด constant_memory: แต่ละแถวถูก flush ลงไฟล์ชั่วคราวทันที
+    sheets: [(sheet_name, df หรือ iterable ของ df chunk), ...] ได้ layout เหมือน sheets_to_excel
+    (ครบ EXCEL_MAX_ROWS แล้วเขียนต่อในชีตใหม่ "<ชื่อ> (2)" พร้อม header ระหว่าง stream)
+    """
+    import xlsxwriter
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "tmpdir": EXPORT_DIR})
+    # header แบบเดียวกับ pandas.to_excel
+    header_fmt = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    sheets = list(sheets)
+    used = set()
+    max_rows = EXCEL_MAX_ROWS
+    try:
+        for i, (name, frames) in enumerate(sheets):
+            message = f"เขียน Excel ชีต {name} ({i + 1}/{len(sheets)})"
+            job_progress(i / len(sheets), message)
+            ws = workbook.add_worksheet(unique_sheet_name(name, used))
+            if isinstance(frames, pd.DataFrame):
+                frames = [frames]
+            row = written = 0
+            header = None
+            for frame in frames:
+                if header is None:
+                    header = [str(c) for c in frame.columns]
+                    ws.write_row(0, 0, header, header_fmt)
+                    row = 1
+                for values in frame_rows(frame):
+                    if row == max_rows:
+                        ws = workbook.add_worksheet(unique_sheet_name(name, used))
+                        ws.write_row(0, 0, header, header_fmt)
+                        row = 1
+                    ws.write_row(row, 0, values)
+                    row += 1
+                    written += 1
+                    if written % STREAM_BATCH_ROWS == 0:
+                        job_progress(message=f"{message}: {written:,} แถว")
+    finally:
+        workbook.close()
+    return path
+
+# ---------- CSV ZIP / Parquet (เร็วกว่า xlsx มาก สำหรับนำไปใช้ต่อในโปรแกรมอื่น) ----------
+
+ZIP_MIME = "application/zip"
+PARQUET_MIME = "application/vnd.apache.parquet"
+ZIP_COMPRESSLEVEL = 1            # deflate ระดับต่ำสุด: CSV ยังเล็กลงมาก แต่เร็วกว่าค่า default หลายเท่า
+
+def zip_member_name(name: str, suffix: str, used: set) -> str:
+    """ชื่อไฟล์ใน zip ที่ไม่ซ้ำ (ไม่สนตัวพิมพ์เล็ก/ใหญ่): name.csv, name (2).csv, ..."""
+    member, n = f"{name}{suffix}", 1
+    while member.lower() in used:
+        n += 1
+        member = f"{name} ({n}){suffix}"
+    used.add(member.lower())
+    return member
+
+@profiled("csv_zip_write")
+def write_csv_zip(path: str, sheets) -> str:
+    """
+    เขียน ZIP ที่มี CSV 1 ไฟล์ต่อชีต (<sheet_name>.csv, utf-8-sig ให้ Excel อ่านภาษาไทยได้)
+    sheets: layout เดียวกับ write_xlsx_streaming – ข้อมูลถูกเขียนลง zip ทีละ chunk ไม่ถือทั้งไฟล์ใน RAM
+    """
+    import zipfile
+
+    used = set()
+    sheets = list(sheets)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=ZIP_COMPRESSLEVEL) as zf:
+        for i, (name, frames) in enumerate(sheets):
+            job_progress(i / len(sheets), f"เขียน CSV {name} ({i + 1}/{len(sheets)})")
+            member = zip_member_name(name, ".csv", used)
+            if isinstance(frames, pd.DataFrame):
+                frames = [frames]
+            with zf.open(member, "w", force_zip64=True) as raw:
+                fh = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+                header = True
+                for frame in frames:
+                    if header or not frame.empty:
+                        frame.to_csv(fh, index=False, header=header)
+                        header = False
+                fh.flush()
+                fh.detach()
+    return path
+
+# ---------- Excel แยกไฟล์ต่อหมอ (ZIP) ----------
+
+def _write_workbook(path: str, name: str, frame: pd.DataFrame) -> str:
+    """งานใน process pool: workbook 1 ชีต (ต้องอยู่ระดับ module เพื่อให้ pickle ได้)"""
+    return write_xlsx_streaming(path, [(name, frame)])
+
+@profiled("workbook_zip_write")
+def write_workbook_zip(path: str, sheets, all_sheet: str = "All", include_all: bool = True,
+                       max_workers: int = None) -> str:
+    """
+    เขียน ZIP ที่มี xlsx 1 ไฟล์ต่อหมอ (<ชื่อหมอ>.xlsx) แทน workbook ก้อนเดียวหลายสิบชีต
+    sheets: layout ของ doctor_sheets / with_summary – ชีตจนถึง all_sheet (ชีตสรุป + All) รวมเป็น
+    <all_sheet>.xlsx (เฉพาะเมื่อ include_all) ชีตหลังจากนั้นแยกไฟล์ละหมอ
+    - ไฟล์รวมเขียนแบบ streaming ใน process นี้ (ข้อมูล chunked ไม่ต้องโหลดทั้งก้อน)
+    - ไฟล์รายหมอเขียนใน process pool (ไม่เกินจำนวน core) ส่งงานทีละช่วงเพื่อไม่ถือข้อมูลทุกหมอพร้อมกัน
+    - xlsx บีบอัดมาแล้ว จึงเก็บใน zip แบบ ZIP_STORED และลบไฟล์ชั่วคราวทันทีที่ใส่ลง zip
+    """
+    import zipfile
+    from collections import deque
+
+    sheets = list(sheets)
+    names = [name for name, _ in sheets]
+    split = names.index(all_sheet) + 1 if all_sheet in names else len(sheets)
+    combined, doctors = sheets[:split], sheets[split:]
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(doctors)))
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix="workbooks_", dir=EXPORT_DIR)
+    used = set()
+    pool = None
+    try:
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            if include_all and combined:
+                # โหมดเฉพาะสรุปไม่มีชีต All → ตั้งชื่อไฟล์ตามชีตแรก
+                combined_name = all_sheet if all_sheet in names else combined[0][0]
+                with job_span(0.0, 0.3 if doctors else 1.0, f"เขียน {combined_name}.xlsx"):
+                    member = zip_member_name(combined_name, ".xlsx", used)
+                    tmp = write_xlsx_streaming(os.path.join(tmp_dir, "all.xlsx"), combined)
+                    zf.write(tmp, member)
+                    os.remove(tmp)
+            if not doctors:
+                return path
+
+            with job_span(0.3 if include_all and combined else 0.0, 1.0):
+                if workers > 1:
+                    pool = process_pool(workers)
+                pending = deque()
+                finished = 0
+
+                def finish(member, result):
+                    nonlocal finished
+                    tmp = result.result() if pool else result
+                    zf.write(tmp, member)
+                    os.remove(tmp)
+                    finished += 1
+                    job_progress(finished / len(doctors), f"เขียนไฟล์รายหมอ {finished}/{len(doctors)}")
+
+                for i, (name, frames) in enumerate(doctors):
+                    frame = frames if isinstance(frames, pd.DataFrame) else concat_frames(list(frames))
+                    member = zip_member_name(name, ".xlsx", used)
+                    tmp = os.path.join(tmp_dir, f"{i}.xlsx")
+                    if pool:
+                        pending.append((member, pool.submit(_write_workbook, tmp, name, frame)))
+                        # ใส่ลง zip ตามลำดับเดิม: รอไฟล์เก่าสุดเมื่องานค้างครบ 2 เท่าของ worker
+                        while len(pending) >= 2 * workers:
+                            finish(*pending.popleft())
+                    else:
+                        finish(member, _write_workbook(tmp, name, frame))
+                while pending:
+                    finish(*pending.popleft())
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return path
+
+def parquet_groups(df: pd.DataFrame, key: str = None):
+    """
+    แบ่ง df เป็นกลุ่มสำหรับ write_parquet: 1 กลุ่มต่อค่าใน key (เรียงตามชื่อ) แล้วตามด้วยแถวที่ไม่มีค่า key
+    ไม่มี key → ทั้ง df เป็นกลุ่มเดียว
+    """
+    if not key:
+        yield df
+        return
+    for _, part in partition_by(df, key):
+        yield part
+    rest = df[df[key].isna()]
+    if not rest.empty:
+        yield rest
+
+def _parquet_type(field_type):
+    """ชนิดของคอลัมน์ในไฟล์: dictionary index เป็น int32 เสมอ, None = ยังไม่รู้ (chunk นี้ว่างทั้งคอลัมน์)"""
+    import pyarrow as pa
+
+    if pa.types.is_dictionary(field_type):
+        if pa.types.is_null(field_type.value_type):
+            return None
+        return pa.dictionary(pa.int32(), field_type.value_type)
+    return None if pa.types.is_null(field_type) else field_type
+
+def _merge_parquet_type(current, new):
+    """
+    ชนิดที่รับได้ทั้งสอง chunk: chunk ก่อนเป็นตัวเลขล้วน chunk หลังมี string (เช่น 2 กับ "1 box")
+    → string แบบเดียวกับที่ _arrow_safe ให้เมื่อเจอชนิดปนกันในไฟล์เดียว (คอลัมน์ category → dictionary ของ string)
+    """
+    import pyarrow as pa
+
+    if current is None or current == new:
+        return new
+    if new is None:
+        return current
+    if pa.types.is_dictionary(current) or pa.types.is_dictionary(new):
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.large_string()
+
+def _parquet_schema(names: list, types: dict, dict_names: set):
+    """schema ของไฟล์: คอลัมน์ที่ยังว่างทั้งหมดเป็น string (คอลัมน์ category → dictionary ของ string)"""
+    import pyarrow as pa
+
+    fields = []
+    for name in names:
+        t = types[name]
+        if t is None:
+            t = pa.dictionary(pa.int32(), pa.string()) if name in dict_names else pa.string()
+        fields.append(pa.field(name, t))
+    return pa.schema(fields)
+
+def _conform_column(col, target):
+    """แปลงคอลัมน์ให้เป็นชนิด target – ค่าที่ต้องกลายเป็น string ใช้ str(v) เหมือน _arrow_safe"""
+    import pyarrow as pa
+
+    if col.type == target:
+        return col
+    if col.null_count == len(col):
+        return pa.nulls(len(col), target)
+    is_text = lambda t: pa.types.is_string(t) or pa.types.is_large_string(t)
+    value_type = target.value_type if pa.types.is_dictionary(target) else target
+    source_type = col.type.value_type if pa.types.is_dictionary(col.type) else col.type
+    if is_text(value_type) and not is_text(source_type):
+        col = pa.array([v if v is None or isinstance(v, str) else str(v) for v in col.to_pylist()], value_type)
+        return col.dictionary_encode().cast(target) if pa.types.is_dictionary(target) else col
+    return col.cast(target)
+
+def _conform_table(table, schema):
+    import pyarrow as pa
+
+    table = table.select(schema.names)
+    return pa.table([_conform_column(table[f.name].combine_chunks(), f.type) for f in schema], schema=schema)
+
+def _copy_row_groups(source_path: str, writer, schema):
+    """คัดลอก row group ที่เขียนไปแล้วลง writer ใหม่ที่ schema กว้างขึ้น (คงการแบ่ง row group เดิม)"""
+    import pyarrow.parquet as pq
+
+    source = pq.ParquetFile(source_path)
+    try:
+        for i in range(source.num_row_groups):
+            group = source.read_row_group(i)
+            writer.write_table(_conform_table(group, schema), row_group_size=max(group.num_rows, 1))
+    finally:
+        source.close()
+    os.remove(source_path)
+
+@profiled("parquet_write")
+def write_parquet(path: str, groups) -> str:
+    """
+    เขียน Parquet ไฟล์เดียว โดยแต่ละกลุ่มใน groups (df หรือ iterable ของ chunk) เป็น row group ของตัวเอง
+    แบ่งตามหมอแล้ว (parquet_groups) → สถิติ min/max ของคอลัมน์หมอในแต่ละ row group ทำให้
+    pyarrow/duckdb/Power BI อ่านเฉพาะหมอที่ต้องการได้โดยไม่ต้องสแกนทั้งไฟล์
+    คอลัมน์ category เก็บเป็น dictionary encoding
+    schema ไม่ล็อกตาม chunk แรก: chunk หลังมีชนิดที่ขัดกัน (เช่น 1 กับ "1 box") → ขยายชนิด แล้วคัดลอก
+    row group ที่เขียนไปแล้วลงไฟล์ใหม่ (ParquetWriter เขียนต่อท้ายไฟล์เดิมไม่ได้) ผลจึงเหมือนเขียนทั้งไฟล์ทีเดียว
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = out = schema = names = None
+    types, dict_names = {}, set()
+    groups = list(groups)
+    try:
+        for i, group in enumerate(groups):
+            job_progress(i / len(groups), f"เขียน Parquet row group {i + 1}/{len(groups)}")
+            frames = [group] if isinstance(group, pd.DataFrame) else list(group)
+            frames = [f for f in frames if not f.empty] or frames[:1]
+            if not frames:
+                continue
+            tables = [pa.Table.from_pandas(_arrow_safe(f), preserve_index=False) for f in frames]
+            if names is None:
+                names = tables[0].schema.names
+                types = dict.fromkeys(names)
+                dict_names = {f.name for f in tables[0].schema if pa.types.is_dictionary(f.type)}
+            for t in tables:
+                for name in names:
+                    types[name] = _merge_parquet_type(types[name], _parquet_type(t.schema.field(name).type))
+            merged = _parquet_schema(names, types, dict_names)
+            if merged != schema:
+                previous = out
+                if writer is not None:
+                    writer.close()
+                out = path + ".widen" if previous == path else path
+                schema = merged
+                writer = pq.ParquetWriter(out, schema, compression="snappy")
+                if previous is not None:
+                    _copy_row_groups(previous, writer, schema)
+            table = pa.concat_tables([_conform_table(t, schema) for t in tables])
+            if table.num_rows:
+                writer.write_table(table, row_group_size=table.num_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pq.write_table(pa.table({}), path)
+    elif out != path:
+        os.replace(out, path)
+    return path
+
+def read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as fh:
+        return fh.read()
+
+# =========================
+# Summary Sheets
+# (ตารางสรุป/pivot คำนวณด้วย groupby บนตารางที่แตกแล้ว แทนการให้ผู้ใช้ pivot ชีต All เองใน Excel
+#  ผลรวมทุกตัวบวกกันได้ → โหมด chunk รวมผลทีละ chunk ได้โดยไม่ต้องโหลดทั้งไฟล์)
+# =========================
+
+SUMMARY_MODES = ("none", "include", "only")   # ไม่มีชีตสรุป / ชีตสรุป + ข้อมูลดิบ / เฉพาะชีตสรุป
+DAY_FMT = "%d/%m/%Y"                          # ส่วนวันที่ของ TIME_FMT
+
+def row_weights(df: pd.DataFrame, key: str = None) -> np.ndarray:
+    """
+    น้ำหนักต่อแถว = 1 / จำนวนหมอในรายการเดียวกัน (คอลัมน์ <key>_count เช่น practice_count)
+    treatment ที่มีหมอ 3 คนจึงนับเป็น 1/3 ต่อหมอ และรวมกันได้ 1 รายการพอดี
+    แถวที่ไม่มีหมอ (count = 0) มีน้ำหนัก 1
+    """
+    count_col = f"{key}_count" if key else None
+    if count_col and count_col in df.columns:
+        n = pd.to_numeric(df[count_col], errors="coerce").fillna(0).to_numpy(dtype=np.float64)
+        return 1.0 / np.maximum(n, 1.0)
+    return np.ones(len(df))
+
+def _category_values(values, convert) -> np.ndarray:
+    """แปลงค่าระดับ category (ครั้งละค่าที่ไม่ซ้ำ) แล้วกระจายกลับทุกแถวด้วย code"""
+    cat = as_category(values)
+    n = len(cat.categories)
+    # ตำแหน่งท้ายสุด (code -1 = ค่าว่าง) reindex เติม NaN/NaT ตามชนิดผลลัพธ์
+    converted = convert(pd.Series(cat.categories, dtype=object)).reset_index(drop=True).reindex(range(n + 1))
+    return converted.to_numpy()[np.where(cat.codes < 0, n, cat.codes)]
+
+def summary_parts(df: pd.DataFrame, key: str = None, time_col: str = "time") -> dict:
+    """
+    ผลรวมย่อยของตารางสรุป (ยังไม่คิด %) → รวมข้าม chunk ด้วย merge_summary_parts
+    - doctor: ต่อหมอ → cases (จำนวนแถว), weighted (ถ่วงด้วย 1/<key>_count), units
+    - treatment: ต่อ treatment → weighted, units
+    - day: ต่อ (วัน, หมอ) → cases, weighted
+    """
+    weights = row_weights(df, key)
+    frame = pd.DataFrame({"cases": np.ones(len(df), dtype=np.int64), "weighted": weights})
+    if "unit" in df.columns:
+        units = _category_values(df["unit"], lambda s: pd.to_numeric(s, errors="coerce"))
+        frame["units"] = np.nan_to_num(units.astype(np.float64)) * weights
+    by = {}
+    if key and key in df.columns:
+        by["doctor"] = [as_category(df[key])]
+    if "treatment" in df.columns:
+        by["treatment"] = [as_category(df["treatment"])]
+    if time_col in df.columns:
+        day = _category_values(df[time_col], lambda s: pd.to_datetime(
+            s.astype(str).str[:10], format=DAY_FMT, errors="coerce"))
+        by["day"] = [pd.Series(day, dtype="datetime64[ns]")]
+        if key and key in df.columns:
+            by["day"].append(as_category(df[key]))
+
+    parts = {}
+    for name, keys in by.items():
+        keys = [pd.Series(k, name=f"k{i}").reset_index(drop=True) for i, k in enumerate(keys)]
+        cols = ["cases", "weighted"] + (["units"] if "units" in frame and name != "day" else [])
+        parts[name] = frame[cols].groupby(keys, observed=True, dropna=name == "doctor").sum()
+    return parts
+
+def merge_summary_parts(parts_list) -> dict:
+    """รวม summary_parts หลายชุด (เช่น ทีละ chunk) เป็นชุดเดียว"""
+    merged = {}
+    for parts in parts_list:
+        for name, part in parts.items():
+            merged.setdefault(name, []).append(part)
+    out = {}
+    for name, parts in merged.items():
+        frame = pd.concat(parts)
+        out[name] = frame.groupby(level=list(range(frame.index.nlevels)), dropna=False).sum()
+    return out
+
+def _share_pct(values: pd.Series) -> pd.Series:
+    total = values.sum()
+    return (values / total * 100).round(2) if total else values * 0.0
+
+def summary_from_parts(parts: dict, key: str = None) -> list:
+    """[(sheet_name, df), ...]: Summary (ต่อหมอ), By Treatment, By Day (pivot วัน × หมอ)"""
+    sheets = []
+    if "doctor" in parts:
+        doc = parts["doctor"].reset_index()
+        doc.columns = [key] + list(doc.columns[1:])
+        doc[key] = doc[key].astype(object)
+        doc["share_pct"] = _share_pct(doc["weighted"])
+        doc["weighted"] = doc["weighted"].round(2)
+        if "units" in doc:
+            doc["units"] = doc["units"].round(2)
+        doc = doc.sort_values(["weighted", key], ascending=[False, True], kind="stable")
+        sheets.append(("Summary", doc.reset_index(drop=True)))
+    if "treatment" in parts:
+        tr = parts["treatment"].drop(columns="cases").reset_index()
+        tr.columns = ["treatment"] + list(tr.columns[1:])
+        tr["treatment"] = tr["treatment"].astype(object)
+        tr["share_pct"] = _share_pct(tr["weighted"])
+        tr = tr.rename(columns={"weighted": "count"}).round(2)
+        tr = tr.sort_values(["count", "treatment"], ascending=[False, True], kind="stable")
+        sheets.append(("By Treatment", tr.reset_index(drop=True)))
+    if "day" in parts:
+        day = parts["day"]
+        total = day["weighted"].groupby(level=0, dropna=False).sum().round(2)
+        if day.index.nlevels > 1:
+            pivot = day["cases"].unstack(level=1, fill_value=0)
+            pivot = pivot.reindex(columns=sorted(c for c in pivot.columns if c == c))
+            pivot = pivot.groupby(level=0, dropna=False).sum()
+            pivot.columns = pd.Index([str(c) for c in pivot.columns])
+        else:
+            pivot = pd.DataFrame(index=total.index)
+        pivot.insert(0, "total", total.reindex(pivot.index))
+        pivot = pivot.sort_index(na_position="last")
+        labels = pd.Series(pivot.index).dt.strftime(DAY_FMT).fillna("")
+        pivot.index = pd.Index(labels, name="day")
+        sheets.append(("By Day", pivot.reset_index()))
+    return sheets
+
+@profiled("build_summary")
+def summary_sheets(df: pd.DataFrame, key: str = None, time_col: str = "time") -> list:
+    """ชีตสรุปของ df ทั้งก้อน (ดู summary_parts / summary_from_parts)"""
+    return summary_from_parts(summary_parts(df, key, time_col), key)
+
+def with_summary(sheets, summary_fn, mode: str = "none"):
+    """
+    ประกอบชีตตามโหมด SUMMARY_MODES: ชีตสรุปขึ้นก่อน (เปิดไฟล์มาเห็นทันที) ตามด้วยชีตข้อมูลดิบ
+    sheets / summary_fn เป็น callable → ไม่สร้างส่วนที่ไม่ได้ใช้
+    """
+    if mode not in SUMMARY_MODES:
+        raise ValueError(f"summary mode ต้องเป็น {SUMMARY_MODES}")
+    if mode != "none":
+        yield from summary_fn()
+    if mode != "only":
+        yield from sheets()
+
+# =========================
+# Chunked Pipeline
+# (อ่าน CSV ทีละ chunk → แตกแถว → spool ลงดิสก์แยกตามหมอ → streaming writer)
+# =========================
+
+CHUNK_ROWS = 50_000
+PREVIEW_ROWS = 200
+
+def read_csv_head(data: bytes, encodings=CSV_ENCODINGS, nrows: int = 5) -> pd.DataFrame:
+    """อ่านเฉพาะหัวไฟล์ ทุกคอลัมน์ (ใช้ preview / เช็คคอลัมน์ในโหมด chunk)"""
+    return pd.read_csv(csv_stream(data), encoding=pick_encoding(data, encodings), nrows=nrows,
+                       **csv_options())
+
+def iter_csv_chunks(data: bytes, chunksize: int = CHUNK_ROWS, encodings=CSV_ENCODINGS, columns=None):
+    # อ่านไปแล้วหลาย chunk ค่อยเจอ byte ที่ decode ไม่ได้จะย้อนไม่ได้ → ตรวจ encoding ทั้งไฟล์ก่อน
+    enc = pick_encoding(data, encodings, probe_bytes=None)
+    with pd.read_csv(csv_stream(data), encoding=enc, chunksize=chunksize, **csv_options(columns)) as reader:
+        yield from reader
+
+def merge_columns(columns: list, new_columns: list) -> list:
+    """
+    รวมชื่อคอลัมน์จาก chunk ใหม่ โดยแทรกคอลัมน์ที่ยังไม่เคยเห็นไว้ถัดจากคอลัมน์ก่อนหน้าใน chunk นั้น
+    (เช่น diag_code_3 ที่เพิ่งโผล่ใน chunk หลัง จะต่อท้าย diag_category_2 เหมือนรันทั้งไฟล์)
+    """
+    merged = list(columns)
+    seen = set(merged)
+    prev = None
+    for c in new_columns:
+        if c not in seen:
+            pos = merged.index(prev) + 1 if prev is not None else 0
+            merged.insert(pos, c)
+            seen.add(c)
+        prev = c
+    return merged
+
+def concat_frames(frames: list, fill_value="") -> pd.DataFrame:
+    """ต่อ df หลายก้อนโดยเรียงคอลัมน์แบบ merge_columns และเติม fill_value ในคอลัมน์ที่บางก้อนไม่มี"""
+    columns = []
+    for frame in frames:
+        columns = merge_columns(columns, list(frame.columns))
+    aligned = [f if list(f.columns) == columns else f.reindex(columns=columns, fill_value=fill_value)
+               for f in frames]
+    return concat_categorical(aligned, ignore_index=True) if aligned else pd.DataFrame()
+
+class ChunkSpool:
+    """
+    เก็บผลลัพธ์ที่แตกแล้วทีละ chunk ลงดิสก์ (pickle ต่อท้ายไฟล์)
+    - ไฟล์ All 1 ไฟล์ + ไฟล์ต่อค่าใน key (เช่น practice) เพื่อเขียนชีตรายหมอทีหลัง
+    - ในหน่วยความจำเก็บแค่ชื่อคอลัมน์, จำนวนแถว และ preview
+    """
+
+    def __init__(self, key: str = None, fill_value=""):
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix="spool_", dir=EXPORT_DIR)
+        self.key = key
+        self.fill_value = fill_value
+        self.rows = 0
+        self.columns = []
+        self.head = None
+        self._all_path = os.path.join(self.dir, "all.pkl")
+        self._parts = {}  # ค่าใน key -> path
+
+    def _dump(self, path: str, frame: pd.DataFrame):
+        with open(path, "ab") as fh:
+            pickle.dump(frame, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def append(self, frame: pd.DataFrame):
+        self.columns = merge_columns(self.columns, list(frame.columns))
+        if frame.empty:
+            return
+        if self.head is None:
+            self.head = frame.head(PREVIEW_ROWS)
+        self.rows += len(frame)
+        self._dump(self._all_path, frame)
+        if self.key:
+            for value, part in partition_by(frame, self.key):
+                if value not in self._parts:
+                    self._parts[value] = os.path.join(self.dir, f"part_{len(self._parts):05d}.pkl")
+                self._dump(self._parts[value], part)
+
+    def keys(self) -> list:
+        return sorted(self._parts)
+
+    def close(self):
+        """ลบไฟล์ spool ทิ้ง (ใช้ตอนรัน batch ที่ไม่ต้องเก็บผลไว้ซ้ำ)"""
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _load(self, path: str):
+        if os.path.exists(path):
+            with open(path, "rb") as fh:
+                while True:
+                    try:
+                        frame = pickle.load(fh)
+                    except EOFError:
+                        break
+                    if list(frame.columns) != self.columns:
+                        frame = frame.reindex(columns=self.columns, fill_value=self.fill_value)
+                    yield frame
+        # ให้มี header เสมอแม้ไม่มีข้อมูล
+        yield pd.DataFrame(columns=self.columns)
+
+    def iter_all(self, keys=None):
+        for frame in self._load(self._all_path):
+            if keys is not None:
+                frame = frame[frame[self.key].isin(keys)]
+            yield frame
+
+    def sheets(self, all_sheet: str = "All", keys=None):
+        """[(sheet_name, iterable ของ chunk)] layout เดียวกับ doctor_sheets"""
+        yield all_sheet, self.iter_all(keys)
+        if self.key:
+            for value in self.keys():
+                if keys is None or value in keys:
+                    yield safe_sheet_name(value), self._load(self._parts[value])
+
+    def summary_sheets(self, time_col: str = "time", keys=None) -> list:
+        """ชีตสรุปแบบเดียวกับ summary_sheets() โดยรวมผลย่อยทีละ chunk"""
+        parts = (summary_parts(frame, self.key, time_col) for frame in self.iter_all(keys))
+        return summary_from_parts(merge_summary_parts(parts), self.key)
+
+    def parquet_groups(self, keys=None):
+        """กลุ่มสำหรับ write_parquet แบบเดียวกับ parquet_groups(): 1 กลุ่มต่อหมอ + แถวที่ไม่มีค่า key"""
+        if not self.key:
+            yield self.iter_all()
+            return
+        for value in self.keys():
+            if keys is None or value in keys:
+                yield self._load(self._parts[value])
+        if keys is None:
+            yield (frame[frame[self.key].isna()] for frame in self._load(self._all_path))
+
+@profiled("chunked_run")
+def run_chunked(data: bytes, transform, key: str = None, chunksize: int = CHUNK_ROWS,
+                encodings=CSV_ENCODINGS, fill_value="", columns=None) -> ChunkSpool:
+    """อ่าน CSV ทีละ chunk (เฉพาะ columns) แล้วส่งผล transform(chunk) ลง ChunkSpool ทันที"""
+    spool = ChunkSpool(key=key, fill_value=fill_value)
+    # จำนวนแถวโดยประมาณ (นับขึ้นบรรทัด – JSON ที่มีขึ้นบรรทัดทำให้เกินจริงเล็กน้อย) ไว้แสดงความคืบหน้า
+    total = max(count_lines(data) - 1, 1) if _job_running() else None
+    done = 0
+    for i, chunk in enumerate(iter_csv_chunks(data, chunksize=chunksize, encodings=encodings, columns=columns)):
+        if total:
+            lo, hi = min(done / total, 0.99), min((done + len(chunk)) / total, 0.99)
+            with job_span(lo, hi, f"chunk {i + 1}: {done:,}/~{total:,} แถว"):
+                spool.append(transform(chunk))
+        else:
+            spool.append(transform(chunk))
+        done += len(chunk)
+    return spool
+
+# =========================
+# Filters (predicate pushdown)
+# (ตัวกรองช่วงวันที่ / ชื่อ treatment / ชื่อหมอ ตรวจกับ time และ string JSON ดิบก่อน parse:
+#  เฉพาะ visit ที่อาจผ่านเท่านั้นที่ต้อง json.loads + แตกแถว แล้วค่อยกรองแบบแม่นยำอีกรอบหลัง parse)
+# =========================
+
+FILTER_KEYS = ("since", "until", "treatment", "doctors")
+
+def has_filters(kwargs: dict) -> bool:
+    return any(kwargs.get(k) for k in FILTER_KEYS)
+
+def json_text_forms(text: str) -> list:
+    """รูปแบบที่ text อาจปรากฏใน JSON ดิบ: ตัวเอง, escape แบบ ensure_ascii (\\uXXXX), / → \\/"""
+    forms = {text, json.dumps(text)[1:-1], json.dumps(text, ensure_ascii=False)[1:-1]}
+    forms |= {f.replace("/", "\\/") for f in forms}
+    return sorted(forms)
+
+def raw_contains(values: pd.Series, texts) -> np.ndarray:
+    """แถวที่ string ดิบมีข้อความใดข้อความหนึ่งใน texts (ไม่สนตัวพิมพ์) – เป็นเงื่อนไขหยาบ (อาจเกินจริง)"""
+    pattern = "|".join(re.escape(f) for t in texts for f in json_text_forms(t))
+    s = values if values.dtype == "str" else values.astype("str")
+    return s.str.contains(pattern, case=False, regex=True, na=False).to_numpy(dtype=bool)
+
+def visit_time_mask(values, since=None, until=None) -> np.ndarray:
+    """เวลา visit (Asia/Bangkok) อยู่ในช่วงวันที่ since..until รวมทั้งสองวัน (None = ไม่จำกัด, เวลาว่าง = ไม่ผ่าน)"""
+    day = to_bangkok_datetime(values).dt.tz_localize(None).dt.normalize()
+    mask = day.notna()
+    if since:
+        mask &= day >= pd.Timestamp(since)
+    if until:
+        mask &= day <= pd.Timestamp(until)
+    return mask.to_numpy(dtype=bool)
+
+def treatment_name_mask(tdf: pd.DataFrame, text: str) -> np.ndarray:
+    text = text.lower()
+    return category_mask(tdf["treatment"], lambda v: isinstance(v, str) and text in v.lower())
+
+@profiled("pushdown")
+def prefilter_visits(df: pd.DataFrame, since=None, until=None, treatments=(), doctors=(),
+                     column: str = "treatments") -> pd.DataFrame:
+    """
+    visit ที่อาจผ่านตัวกรอง โดยดูแค่ time และ string treatments ดิบ (ยังไม่ parse JSON)
+    treatments: ทุกคำต้องอยู่ในข้อความ, doctors: มีชื่อใดชื่อหนึ่ง – ผลเรียงตามเดิม index ใหม่ 0..n-1
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if (since or until) and "time" in df.columns:
+        mask &= visit_time_mask(df["time"], since, until)
+    if column in df.columns:
+        raw = df[column]
+        for text in treatments:
+            idx = np.flatnonzero(mask)
+            mask[idx] = raw_contains(raw.iloc[idx], [text])
+        if doctors:
+            idx = np.flatnonzero(mask)
+            mask[idx] = raw_contains(raw.iloc[idx], doctors)
+    if mask.all():
+        return df
+    return df[mask].reset_index(drop=True)
+
+def filtered_treatments(df: pd.DataFrame, tdf: pd.DataFrame = None, since=None, until=None,
+                        treatments=(), doctors=()) -> tuple:
+    """
+    (df, tdf) หลังกรอง สำหรับ builder ของแต่ละหน้า
+    - ไม่มี tdf (chunk / CLI): pushdown บน string ดิบก่อน แล้วค่อย parse เฉพาะ visit ที่เหลือ
+    - มี tdf (normalized tables parse ไว้แล้ว): กรองแถว treatment ก่อนแตกตามหมอ
+    ชื่อหมอกรองแบบแม่นยำหลัง explode_doctors (ดู filter_doctors)
+    """
+    treatments = [t for t in treatments if t]
+    if tdf is None:
+        df = prefilter_visits(df, since, until, treatments, doctors)
+        tdf = explode_treatments(df)
+    elif (since or until) and "time" in df.columns:
+        tdf = tdf[visit_time_mask(df["time"], since, until)[tdf["_visit"].to_numpy()]]
+    for text in treatments:
+        tdf = tdf[treatment_name_mask(tdf, text)]
+    return df, tdf
+
+def filter_doctors(exp: pd.DataFrame, doctors=(), column: str = "doctor") -> pd.DataFrame:
+    if not doctors:
+        return exp
+    return exp[exp[column].isin(list(doctors))].reset_index(drop=True)
+
+# =========================
+# PAGE 1 – Doctor Monthly Stats
+# (จาก doctor_stats_app.py)
+# =========================
+
+STATS_COLS = ["time", "HN", "patientTitle", "patientName", "nationality", "treatments"]
+
+@profiled("build_stats")
+def build_doctor_stats_df(df: pd.DataFrame, tdf: pd.DataFrame = None,
+                          since=None, until=None, treatment: str = "", doctors=()) -> pd.DataFrame:
+    """since/until/treatment/doctors: ตัวกรอง (ดู filtered_treatments) – ค่าว่างทั้งหมด = ผลเดิมทุกแถว"""
+    df, tdf = filtered_treatments(df, tdf, since, until, [treatment], doctors)
+    # join รายชื่อทีละ treatment (ก่อนแตกตามหมอ) → แถวที่แตกออกมาใช้ code ร่วมกัน
+    tdf = tdf.assign(
+        order_raw=as_category([",".join(map(str, v)) for v in tdf["order_list"].tolist()]),
+        doctor_asst_raw=as_category([",".join(map(str, v)) for v in tdf["doctor_asst_list"].tolist()]),
+    )
+    exp = filter_doctors(explode_doctors(tdf, primary="practice_list", fallback="order_list"), doctors)
+    visits = exp["_visit"].to_numpy()
+
+    # format เวลาทีละ visit แล้วค่อยกระจายไปตามแถวที่แตกออกมา
+    if "time" in df.columns:
+        time_fmt = format_bangkok_time(df["time"], missing="", invalid="")
+    else:
+        time_fmt = pd.Series([""] * len(df), dtype=object)
+
+    cols = take_visit_columns(df, visits, ["HN", "patientTitle", "patientName", "nationality"])
+
+    return pd.DataFrame({
+        "time": take_category(time_fmt, visits),
+        **cols,
+        "treatment": as_category(exp["treatment"]),
+        "area": as_category(exp["area"]),
+        "unit": as_category(exp["unit"]),
+        "practice": as_category(exp["doctor"]),
+        "practice_count": exp["doctor_count"],
+        "order_raw": exp["order_raw"],
+        "doctor_asst_raw": exp["doctor_asst_raw"],
+    })
+
+# =========================
+# PAGE 2 – Doctor Round / Discharge
+# (จาก app.py – Doctor Round/Discharge Exporter)
+# =========================
+
+ROUND_REQUIRED_COLS = ["time", "ipd_status", "patientTitle", "patientName",
+                       "room", "nationality", "treatments"]
+
+@profiled("build_round")
+def build_all_df_round(df: pd.DataFrame, tdf: pd.DataFrame = None) -> pd.DataFrame:
+    if tdf is None:
+        tdf = explode_treatments(df)
+
+    # รวมหมอจาก order ของทุก treatment ใน visit เดียวกัน (ไม่ซ้ำ, เรียงตามที่เจอ)
+    pairs = tdf[["_visit", "order_list"]].explode("order_list")
+    pairs = pairs[pairs["order_list"].notna() & pairs["order_list"].map(bool)]
+    pairs = pairs.drop_duplicates(["_visit", "order_list"]).rename(columns={"order_list": "order"})
+    pairs["order_count"] = pairs.groupby("_visit")["order"].transform("size")
+
+    # ถ้าไม่มีหมอใน order → เก็บใน ALL แบบ order = None, order_count = 0
+    # setdiff1d คืน int64 เสมอ (ไฟล์ว่างได้ array ว่างที่ยัง index ได้ ไม่ใช่ object)
+    no_doctor = pd.DataFrame({"_visit": np.setdiff1d(np.arange(len(df)), pairs["_visit"].to_numpy())})
+    no_doctor["order"] = None
+    no_doctor["order_count"] = 0
+
+    exp = pd.concat([pairs, no_doctor], ignore_index=True)
+    exp = exp.sort_values("_visit", kind="stable").reset_index(drop=True)
+    visits = exp["_visit"].to_numpy()
+
+    cols = take_visit_columns(
+        df, visits,
+        ["ipd_status", "patientTitle", "patientName", "room", "nationality"],
+        default=None,
+    )
+    # แปลง time format → GMT+7 ทีละ visit (แปลงไม่ได้ → เก็บค่าเดิม)
+    if "time" in df.columns:
+        time_fmt = take_category(format_bangkok_time(df["time"], missing=None, invalid="keep"), visits)
+    else:
+        time_fmt = pd.Series([None] * len(visits), dtype=object)
+    return pd.DataFrame({
+        "time": time_fmt,
+        **cols,
+        "order": as_category(exp["order"].tolist()),
+        "order_count": exp["order_count"].astype("int64"),
+    })
+
+# =========================
+# PAGE 3 – Refer Summary
+# (จาก refer.py)
+# =========================
+
+def parse_json_list_str(s):
+    """แปลง string แบบ '["NAT","NICE"]' -> 'NAT,NICE'"""
+    if s is None or (isinstance(s, float) and pd.isna(s)):
+        return ""
+    if isinstance(s, list):
+        # เผื่อมีกรณีอ่านมาเป็น list อยู่แล้ว
+        return ",".join(map(str, s))
+    try:
+        data = json.loads(s)
+        if isinstance(data, list):
+            return ",".join(map(str, data))
+        return str(data)
+    except Exception:
+        # ถ้า parse ไม่ได้ก็ส่งดิบ ๆ กลับไป
+        return str(s)
+
+REFER_COLS = ["time", "HN", "patientTitle", "patientName", "nationality", "treatments",
+              "referTo", "typeOfBoat", "shift", "onDuty", "onCall"]
+
+@profiled("build_refer")
+def expand_refer_rows(df, only_refer=True, tdf=None, since=None, until=None, treatment="", doctors=()):
+    """
+    แตก treatments JSON เป็น 1 row ต่อ 1 treatment ต่อ 1 doctor (practice/order)
+    แล้วดึง field refer ที่ต้องใช้ออกมาด้วย
+    tdf: ผลของ explode_treatments(df) ที่มีอยู่แล้ว (เช่นจาก normalized cache)
+    only_refer: treatment ต้องมีคำว่า refer – ไม่มี tdf จะกรองจาก JSON ดิบก่อน parse
+    (เคส refer มีไม่กี่ % ของ visit) ตัวกรองอื่นดู filtered_treatments
+    """
+    needles = (["refer"] if only_refer else []) + [treatment]
+    df, tdf = filtered_treatments(df, tdf, since, until, needles, doctors)
+
+    tdf = tdf.assign(order=as_category([",".join(map(str, v)) for v in tdf["order_list"].tolist()]))
+    exp = filter_doctors(explode_doctors(tdf, primary="practice_list", fallback="order_list"), doctors)
+    visits = exp["_visit"].to_numpy()
+
+    cols = take_visit_columns(
+        df, visits,
+        ["HN", "patientTitle", "patientName", "nationality", "referTo", "typeOfBoat"],
+    )
+    shift_val = take_visit_columns(df, visits, ["shift"])["shift"]
+
+    # time / onDuty / onCall แปลงทีละ visit แล้วกระจายตามแถว
+    def visit_col(c):
+        return df[c] if c in df.columns else pd.Series([""] * len(df), dtype=object)
+
+    time_fmt = format_bangkok_time(visit_col("time"), missing=np.nan, invalid=np.nan)
+    visit_cols = {c: take_category(map_category(visit_col(c), parse_json_list_str), visits)
+                  for c in ["onDuty", "onCall"]}
+
+    return pd.DataFrame({
+        "time": take_category(time_fmt, visits),
+        "HN": cols["HN"],
+        "patientTitle": cols["patientTitle"],
+        "patientName": cols["patientName"],
+        "nationality": cols["nationality"],
+        "treatment": as_category(exp["treatment"]),
+        "practice": as_category(exp["doctor"]),
+        "practice_count": exp["doctor_count"],
+        "order": exp["order"],
+        "referTo": cols["referTo"],
+        "typeOfBoat": cols["typeOfBoat"],
+        "Shift": shift_val,
+        "onDuty": visit_cols["onDuty"],
+        "onCall": visit_cols["onCall"],
+    })
+
+def to_excel_with_sheets(df: pd.DataFrame, file_name="refer_summary.xlsx"):
+    """
+    แปลง DataFrame เป็นไฟล์ Excel แบบมีชีต All + แยกตาม practice
+    """
+    # ชีต All + แยกชีตตาม practice
+    return sheets_to_excel(doctor_sheets(df, "practice", all_sheet="All")), file_name
+
+# =========================
+# PAGE 4 – Patient Summary Clean Export
+# 
+# =========================
+CLEAN_BASE_COLS = [
+    "time",
+    "HN", "VN", "visit_type", "patientTitle", "patientName", "patientAge", "nationality",
+    "branch", "insurance_name", "assist_insurance", "concessionType",
+    "diagnosis", "medLog", "treatments", "payment_status", "billLog", "rejects", "retry", "note"
+]
+
+def join_by_id(ids: np.ndarray, values, n: int, sep: str) -> list:
+    """
+    รวม values ของแต่ละ id 0..n-1 (_visit หรือ _tid ของแถวลูก) ตามลำดับแถวด้วย sep ข้ามค่าว่าง
+    id ที่ไม่มีค่าได้ ""
+    """
+    out = [""] * n
+    keep = [k for k, value in enumerate(values) if value]
+    if not keep:
+        return out
+    ids = ids[keep]
+    values = [values[k] for k in keep]
+    # ตารางลูกเรียงตาม id อยู่แล้ว → join ทีละช่วงที่ id ติดกัน (ไม่สร้าง list ต่อ id; ไม่ติดกันก็ต่อท้ายให้)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)]
+    for i, start, end in zip(ids[starts].tolist(), starts.tolist(), ends.tolist()):
+        joined = sep.join(values[start:end])
+        out[i] = out[i] + sep + joined if out[i] else joined
+    return out
+
+def spread_by_id(ids: np.ndarray, values, n: int, default="") -> list:
+    """ค่าต่อ id 0..n-1 จากแถวที่ id ไม่ซ้ำกัน – id ที่ไม่มีแถวได้ default"""
+    out = [default] * n
+    for i, value in zip(ids.tolist(), values):
+        out[i] = value
+    return out
+
+def top_n_columns(table: pd.DataFrame, fields: dict, top_n: int, n: int) -> dict:
+    """
+    คอลัมน์ <prefix>_1..N จาก item ลำดับที่ _item (0..top_n-1) ของแต่ละ visit
+    fields: prefix -> list ค่าต่อแถวของ table, สร้างเฉพาะลำดับที่มีอย่างน้อย 1 visit
+    """
+    items = table["_item"].to_numpy()
+    visits = table["_visit"].to_numpy()
+    count = min(top_n, int(items.max()) + 1 if len(items) else 0)
+    columns = {}
+    for i in range(count):
+        rows = np.flatnonzero(items == i)
+        for prefix, values in fields.items():
+            columns[f"{prefix}_{i+1}"] = spread_by_id(visits[rows], [values[r] for r in rows], n)
+    return columns
+
+@profiled("build_clean")
+def beautify_patient_summary(
+    df: pd.DataFrame,
+    diag_top_n: int = 10,     # top N diagnosis columns
+    treat_top_n: int = 6,     # top N treatments columns
+    tables: dict = None,
+) -> pd.DataFrame:
+    """
+    - เพิ่ม time (formatted)
+    - diagnosis: ทำทั้ง join string + แตกคอลัมน์แบบ dynamic topN
+    - treatments: ทำทั้ง join string + แตกคอลัมน์แบบ dynamic topN
+    - payment_status / rejects: ค่าจากรายการแรก, medLog / billLog / retry: join เป็น string
+    tables: normalized tables ของ df (เช่นจาก normalized cache) – ไม่ส่งมาจะ normalize_visits(df) ให้
+    ทุกคอลัมน์เป็น projection ของ tables ไม่ parse JSON ซ้ำ
+    """
+    keep = [c for c in CLEAN_BASE_COLS if c in df.columns]
+    out = df[keep].copy()
+
+    # ---------- time ----------
+    if "time" in out.columns:
+        out["time_fmt"] = format_bangkok_time(out["time"], missing="", invalid="keep")
+    else:
+        out["time_fmt"] = ""
+
+    n = len(out)
+    if tables is None:
+        tables = normalize_visits(df)
+
+    # ===== diagnosis =====
+    dg = tables["diagnoses"]
+    dg_visits = dg["_visit"].to_numpy()
+    codes, titles, cats = dg["code"].tolist(), dg["title"].tolist(), dg["categoryLabel"].tolist()
+
+    # สไตล์เดียวกับ vue: Code:..., Title:...
+    diag_parts = []
+    for code, title, cat in zip(codes, titles, cats):
+        seg = []
+        if code:  seg.append(f"Code:{code}")
+        if title: seg.append(f"Title:{title}")
+        if cat:   seg.append(f"Cat:{cat}")
+        diag_parts.append(", ".join(seg))
+
+    # ===== treatments =====
+    tdf = tables["treatments"]
+    tr_visits = tdf["_visit"].to_numpy()
+    text = lambda v: str(v or "").strip()
+    names = map_category(tdf["treatment"], text).tolist()
+    areas = map_category(tdf["area"], text).tolist()
+    units = map_category(tdf["unit"], text).tolist()
+
+    # รายชื่อหมอต่อ treatment (join_list ของ order/practice/doctor_asst) จาก treatment_doctors ตรง ๆ
+    td = tables["treatment_doctors"]
+    td_tids = td["_tid"].to_numpy()
+    doctor_text = map_category(td["doctor"], lambda v: "" if v is None or str(v).strip() == "" else str(v)).tolist()
+    def doctors_join(role):
+        rows = np.flatnonzero((td["role"] == role).to_numpy())
+        return join_by_id(td_tids[rows], [doctor_text[r] for r in rows], len(tdf), ",")
+    orders, practices, assts = doctors_join("order"), doctors_join("practice"), doctors_join("doctor_asst")
+
+    # join แบบคล้าย vue (เอาไป split ด้วย | ได้)
+    tr_parts = []
+    for tname, area, unit, ord_s, prac_s, asst_s in zip(names, areas, units, orders, practices, assts):
+        seg = [
+            f"Treatment:{tname}",
+            f"Area:{area}",
+            f"Unit:{unit}",
+            f"Order:{ord_s}",
+            f"Practice:{prac_s}",
+            f"Asst:{asst_s}",
+        ]
+        part = ", ".join([s for s in seg if not s.endswith(":")])
+        tr_parts.append(part if part.strip() else "")
+
+    # ===== payment_status / rejects: รายการแรกของ visit (ต้องเป็น dict) =====
+    pay = tables["payments"]
+    pay = pay[pay["_item"].to_numpy() == 0]
+    pay_visits = pay["_visit"].to_numpy()
+    rej = tables["rejects"]
+    rej = rej[rej["_item"].to_numpy() == 0]
+    rej_visits = rej["_visit"].to_numpy()
+    reject_type = spread_by_id(rej_visits, rej["reject"].tolist(), n)
+    reject_reason = spread_by_id(rej_visits, rej["reason"].tolist(), n)
+    reject_problem = spread_by_id(rej_visits, rej["problem"].tolist(), n)
+
+    # ===== logs =====
+    logs = tables["logs"]
+    def log_join(column):
+        sub = logs[(logs["log"] == column).to_numpy()]
+        return join_by_id(sub["_visit"].to_numpy(), sub["value"].tolist(), n, ",")
+
+    columns = {
+        "diag_count": np.bincount(dg_visits, minlength=n).tolist(),
+        "diag_join": join_by_id(dg_visits, diag_parts, n, " | "),
+        "diag_codes": join_by_id(dg_visits, codes, n, ","),
+        "diag_titles": join_by_id(dg_visits, titles, n, ","),
+        "diag_categories": join_by_id(dg_visits, cats, n, ","),
+
+        "treat_count": np.bincount(tr_visits, minlength=n).tolist(),
+        "treat_join": join_by_id(tr_visits, tr_parts, n, " | "),
+        "treat_names": join_by_id(tr_visits, names, n, ","),
+        "treat_areas": join_by_id(tr_visits, areas, n, ","),
+        "treat_units": join_by_id(tr_visits, units, n, ","),
+        "treat_orders": join_by_id(tr_visits, orders, n, " | "),
+        "treat_practices": join_by_id(tr_visits, practices, n, " | "),
+        "treat_assts": join_by_id(tr_visits, assts, n, " | "),
+
+        "pay_status": spread_by_id(pay_visits, pay["status"].tolist(), n),
+        "pay_invoice_id": spread_by_id(pay_visits, pay["invoice_id"].tolist(), n),
+        "pay_total_invoiced": spread_by_id(pay_visits, pay["total_invoiced"].tolist(), n, None),
+        "pay_case_type": spread_by_id(pay_visits, pay["case_type"].tolist(), n),
+        "pay_reason_not_insurance": spread_by_id(pay_visits, pay["reasonNotInsurance"].tolist(), n),
+
+        "has_reject": [bool(t or r or p) for t, r, p in zip(reject_type, reject_reason, reject_problem)],
+        "reject_type": reject_type,
+        "reject_reason": reject_reason,
+        "reject_problem": reject_problem,
+
+        "medLog_list": log_join("medLog"),
+        "billLog_list": log_join("billLog"),
+        "retry_list": log_join("retry"),
+    }
+
+    # ---------- Dynamic TOP-N columns ----------
+    # diagnosis: diag_code_1..N, diag_title_1..N, diag_category_1..N
+    columns.update(top_n_columns(
+        dg, {"diag_code": codes, "diag_title": titles, "diag_category": cats}, diag_top_n, n))
+    # treatments: treat_name_1..N, treat_area_1..N, treat_unit_1..N, treat_order_1..N, treat_practice_1..N
+    columns.update(top_n_columns(
+        tdf, {"treat_name": names, "treat_area": areas, "treat_unit": units,
+              "treat_order": orders, "treat_practice": practices, "treat_asst": assts}, treat_top_n, n))
+
+    return pd.concat([out, pd.DataFrame(columns, index=out.index)], axis=1)
+
+# =========================
+# Multi-file / Parallel
+# (อัปโหลดหลายไฟล์ → แต่ละไฟล์ประมวลผลใน process แยก แล้วรวมหรือแยก export)
+# =========================
+
+# transform ของแต่ละหน้า: ใช้ร่วมกันระหว่างหน้า Streamlit, process pool และ CLI
+TRANSFORMS = {
+    "stats": {
+        "build": build_doctor_stats_df,
+        "uses_treatments": True,
+        "key": "practice",
+        "all_sheet": "All",
+        "time_col": "time",
+        "columns": STATS_COLS,
+    },
+    "round": {
+        "build": build_all_df_round,
+        "uses_treatments": True,
+        "key": "order",
+        "all_sheet": "ALL",
+        "time_col": "time",
+        "columns": ROUND_REQUIRED_COLS,
+        "required_cols": ROUND_REQUIRED_COLS,
+    },
+    "refer": {
+        "build": expand_refer_rows,
+        "uses_treatments": True,
+        "key": "practice",
+        "all_sheet": "All",
+        "time_col": "time",
+        "columns": REFER_COLS,
+    },
+    "clean": {
+        "build": beautify_patient_summary,
+        "key": None,
+        "uses_tables": True,
+        "all_sheet": "Clean",
+        "time_col": "time_fmt",
+        "columns": CLEAN_BASE_COLS,
+    },
+}
+
+# คอลัมน์ที่อ่านเข้า normalized tables = ที่หน้าไหนก็ได้ใช้ + key ของ incremental store + diagnosis
+INGEST_COLUMNS = tuple(dict.fromkeys(
+    [c for spec in TRANSFORMS.values() for c in spec["columns"]] + list(VISIT_KEY_COLS) + ["diagnosis"]
+))
+
+def run_transform(name: str, data, store: str = None, **kwargs) -> pd.DataFrame:
+    """
+    อ่าน CSV (bytes, mmap หรือ path ของไฟล์) แล้วรัน transform ตามชื่อ – เป็น worker ของ process pool และ CLI
+    (ส่ง path เข้า process pool แทน mmap ซึ่ง pickle ไม่ได้ แล้วค่อย map ไฟล์ใน worker)
+    ใช้ normalized cache บนดิสก์ ไฟล์ที่เคยประมวลผลแล้วจึงไม่ต้อง parse ใหม่
+    store: ชื่อ incremental store → รวมไฟล์เข้า store แล้วสร้างผลจากทั้ง store
+    """
+    spec = TRANSFORMS[name]
+    if isinstance(data, str):
+        data = map_file(data)
+    pushdown = not store and has_filters(kwargs)
+    if store:
+        tables, _ = update_store(incremental_store_path(store), data)
+    elif pushdown:
+        # มีตัวกรอง → ไม่ต้อง parse ทั้งไฟล์เข้า normalized cache: อ่านเฉพาะคอลัมน์ของหน้านี้
+        # แล้วให้ builder กรองจาก string ดิบก่อน parse
+        tables = {"visits": read_uploaded_csv(data, columns=spec["columns"])}
+    else:
+        tables = normalized_tables(data, file_digest(data))
+    df = tables["visits"]
+    missing = [c for c in spec.get("required_cols", []) if c not in df.columns]
+    if missing:
+        raise ValueError(f"ขาดคอลัมน์จำเป็นใน CSV: {missing}")
+    if spec.get("uses_treatments") and not pushdown:
+        kwargs["tdf"] = treatments_with_doctors(tables)
+    if spec.get("uses_tables"):
+        kwargs["tables"] = tables
+    return spec["build"](df, **kwargs)
+
+def process_pool(workers: int):
+    """
+    ProcessPoolExecutor ที่เริ่ม worker ด้วย forkserver (หรือ spawn ถ้าไม่มี)
+    ไม่ fork ตรงจาก process ของ Streamlit ที่มีหลาย thread – fork ขณะ thread อื่นถือ lock อยู่ทำให้ worker ค้าง
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+def run_transform_parallel(name: str, datas: list, max_workers: int = None, **kwargs) -> list:
+    """รัน transform กับหลายไฟล์พร้อมกัน (1 process ต่อไฟล์, ไม่เกินจำนวน core) ผลเรียงตามลำดับไฟล์"""
+    if len(datas) == 1:
+        return [run_transform(name, datas[0], **kwargs)]
+    from concurrent.futures import as_completed
+    workers = max_workers or min(len(datas), os.cpu_count() or 1)
+    pool = process_pool(workers)
+    try:
+        futures = [pool.submit(run_transform, name, data, **kwargs) for data in datas]
+        for k, _ in enumerate(as_completed(futures), 1):
+            job_progress(k / len(futures), f"เสร็จ {k}/{len(futures)} ไฟล์")
+        return [f.result() for f in futures]
+    finally:
+        # ยกเลิก (JobCancelled) / error → ไม่เริ่มไฟล์ที่ยังรอคิว
+        pool.shutdown(cancel_futures=True)
@@ -0,0 +1,158 @@
+"""ทดสอบ doctor_stats_core: python -m pytest -q"""
+import json
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import doctor_stats_core as ds
+
+HEADER = ("time,HN,VN,patientTitle,patientName,nationality,ipd_status,room,"
+          "diagnosis,treatments,payment_status,rejects,referTo,typeOfBoat,shift,onDuty,onCall\n")
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """normalized cache / export ของแต่ละ test อยู่ใน tmp_path ไม่ปนกับของเครื่อง"""
+    monkeypatch.setattr(ds, "NORMALIZED_CACHE_DIR", str(tmp_path / "normalized"))
+    monkeypatch.setattr(ds, "EXPORT_DIR", str(tmp_path / "exports"))
+
+@pytest.mark.parametrize("name", list(ds.TRANSFORMS))
+def test_header_only_csv(name):
+    out = ds.run_transform(name, HEADER.encode("utf-8"))
+    assert len(out) == 0
+
+# =========================
+# ผลแบบ columnar / normalized tables ต้องเท่ากับ logic เดิมที่ทำทีละแถว
+# =========================
+
+def _visit(time, treatments="", diagnosis="", payment_status="", rejects="", medLog=""):
+    dump = lambda v: v if isinstance(v, str) else json.dumps(v)
+    return {"time": time, "HN": "1", "VN": "V", "patientTitle": "Mr", "patientName": "P",
+            "nationality": "TH", "ipd_status": "opd", "room": "1",
+            "diagnosis": dump(diagnosis), "treatments": dump(treatments),
+            "payment_status": dump(payment_status), "rejects": dump(rejects), "medLog": dump(medLog)}
+
+VISITS = [
+    # หลายหมอ + order เป็น string เดี่ยว + หมอซ้ำข้าม treatment
+    _visit("2025-12-01T02:18:00Z",
+           [{"treatment": "Consult", "area": "Arm", "unit": "2", "practice": ["Dr. A", "Dr. B"],
+             "order": ["Dr. C", "Dr. A"], "doctor_asst": ["Dr. D"]},
+            {"treatment": " Wound ", "order": "Dr. C", "practice": []}],
+           diagnosis=[{"code": "A92", "title": "Fever", "categoryLabel": None}, "x", {"code": " B1 "}],
+           payment_status=[{"status": ["paid"], "invoice_id": "INV1", "total_invoiced": 1200}],
+           rejects=[{"reject": "doc", "reason": "missing"}], medLog=["a", "", "b"]),
+    _visit("2025-12-02T10:00:00Z", [{"treatment": "Dressing", "order": "Dr. E"}]),
+    _visit("2025-12-03T00:00:00Z", "[]", diagnosis="[]", payment_status="[]", rejects="[]", medLog="[]"),
+    _visit("not a time", "[{bad", diagnosis="{x", payment_status="nope", rejects="[", medLog="oops"),
+    _visit(""),
+]
+
+def _loads(v):
+    if not isinstance(v, str) or not v.strip():
+        return None
+    try:
+        return json.loads(v)
+    except ValueError:
+        return None
+
+def _dicts(v):
+    return [x for x in v if isinstance(x, dict)] if isinstance(v, list) else []
+
+def _list_or_empty(v):
+    return v if isinstance(v, list) else []
+
+def _lst(v):
+    return [] if v is None else v if isinstance(v, list) else [v]
+
+def _join(v):
+    return ",".join(str(x) for x in v if x is not None and str(x).strip() != "")
+
+def _s(d, key):
+    return str(d.get(key, "") or "").strip()
+
+def _bkk(v, missing, keep):
+    if not isinstance(v, str) or not v:
+        return missing
+    try:
+        return pd.to_datetime(v, utc=True).tz_convert("Asia/Bangkok").strftime("%d/%m/%Y %H:%M")
+    except ValueError:
+        return v if keep else ""
+
+def _per_row(df):
+    """logic เดิมก่อนแปลงเป็น columnar: วนทีละ visit / treatment"""
+    stats, rounds, clean = [], [], []
+    for r in df.to_dict("records"):
+        visit = {c: r[c] for c in ("HN", "patientTitle", "patientName", "nationality")}
+        treats = _dicts(_loads(r["treatments"]))
+        doctors = []
+        for t in treats:
+            practice, order, asst = (_lst(t.get(k)) for k in ("practice", "order", "doctor_asst"))
+            doctors += [d for d in order if d and d not in doctors]
+            for doc in practice or order or [None]:
+                stats.append({"time": _bkk(r["time"], "", False), **visit, "treatment": t.get("treatment", ""),
+                              "area": t.get("area", ""), "unit": t.get("unit", ""), "practice": doc,
+                              "practice_count": len(practice or order), "order_raw": ",".join(order),
+                              "doctor_asst_raw": ",".join(asst)})
+        for doc in doctors or [None]:
+            rounds.append({"time": _bkk(r["time"], None, True), "ipd_status": r["ipd_status"],
+                           "patientTitle": r["patientTitle"], "patientName": r["patientName"],
+                           "room": r["room"], "nationality": r["nationality"],
+                           "order": doc, "order_count": len(doctors)})
+        diags = _dicts(_loads(r["diagnosis"]))
+        pay = (_dicts(_loads(r["payment_status"])) or [{}])[0]
+        rej = (_dicts(_loads(r["rejects"])) or [{}])[0]
+        first = lambda v: v[0] if isinstance(v, list) and v else v
+        row = {"time_fmt": _bkk(r["time"], "", True),
+               "diag_count": len(diags), "diag_codes": ",".join(filter(None, (_s(d, "code") for d in diags))),
+               "treat_count": len(treats), "treat_names": ",".join(filter(None, (_s(t, "treatment") for t in treats))),
+               "treat_orders": " | ".join(filter(None, (_join(_lst(t.get("order"))) for t in treats))),
+               "pay_status": str(first(pay.get("status")) or ""), "pay_total_invoiced": first(pay.get("total_invoiced")),
+               "has_reject": any(_s(rej, k) for k in ("reject", "reason", "problem")),
+               "reject_reason": _s(rej, "reason"), "medLog_list": _join(_list_or_empty(_loads(r["medLog"])))}
+        for i, d in enumerate(diags[:10], 1):
+            row[f"diag_code_{i}"] = _s(d, "code")
+        for i, t in enumerate(treats[:6], 1):
+            row[f"treat_order_{i}"] = _join(_lst(t.get("order")))
+            row[f"treat_practice_{i}"] = _join(_lst(t.get("practice")))
+        clean.append(row)
+    clean = pd.DataFrame(clean)
+    top_n = clean.filter(regex=r"_\d+$").columns   # visit ที่มีน้อยกว่า N รายการ → ช่องที่เหลือเป็น ""
+    clean[top_n] = clean[top_n].fillna("")
+    return {"stats": pd.DataFrame(stats), "round": pd.DataFrame(rounds), "clean": clean}
+
+def test_columnar_matches_per_row():
+    data = pd.DataFrame(VISITS).to_csv(index=False).encode("utf-8")
+    expected = _per_row(ds.read_uploaded_csv(data))
+    plain = lambda d: d.astype(object).where(d.notna(), None).reset_index(drop=True)
+    for name, want in expected.items():
+        got = ds.run_transform(name, data)[list(want.columns)]
+        pd.testing.assert_frame_equal(plain(got), plain(want), check_dtype=False, obj=name)
+
+@pytest.mark.parametrize("name", ["stats", "clean"])
+def test_chunked_parquet_mixed_types(name, tmp_path):
+    """chunk แรกเป็นตัวเลขล้วน chunk หลังเป็น string → Parquet แบบ chunk ต้องเท่ากับแบบทั้งไฟล์"""
+    import pyarrow.parquet as pq
+
+    visits = [_visit(f"2025-12-0{1 + i // 5}T02:00:00Z",
+                     [{"treatment": "Consult", "unit": 2 if i < 5 else "1 box", "practice": ["Dr. A"]}],
+                     payment_status=[{"status": "paid", "total_invoiced": 100 if i < 5 else "n/a"}])
+              for i in range(10)]
+    data = pd.DataFrame(visits).to_csv(index=False).encode("utf-8")
+    spec = ds.TRANSFORMS[name]
+
+    spool = ds.run_chunked(data, spec["build"], key=spec["key"], chunksize=5, columns=spec["columns"])
+    try:
+        ds.write_parquet(str(tmp_path / "chunked.parquet"), spool.parquet_groups())
+    finally:
+        spool.close()
+    ds.write_parquet(str(tmp_path / "whole.parquet"),
+                     ds.parquet_groups(ds.run_transform(name, data), spec["key"]))
+
+    chunked = pq.read_table(tmp_path / "chunked.parquet")
+    whole = pq.read_table(tmp_path / "whole.parquet")
+    assert chunked.schema == whole.schema
+    # ลำดับค่าใน dictionary ของแต่ละ row group ไม่ต้องตรงกัน เทียบเฉพาะค่า
+    pd.testing.assert_frame_equal(chunked.to_pandas(), whole.to_pandas(), check_categorical=False)